@@ -0,0 +1,36 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper() # DEBUG also logs answers and quizzes; WARNING for quiet production
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+ROOT_LOGGER = 'researchio'
+
+_listener: logging.handlers.QueueListener = None
+_lock = threading.Lock()
+
+def _configure() -> None:
+    # callers only put records on a queue; a background thread formats and writes them
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        log_queue = queue.SimpleQueue()
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        _listener = logging.handlers.QueueListener(log_queue, handler)
+        _listener.start()
+        atexit.register(_listener.stop) # flushes what is still queued
+
+        logger = logging.getLogger(ROOT_LOGGER)
+        logger.setLevel(LOG_LEVEL)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        logger.propagate = False
+
+def get_logger(name: str) -> logging.Logger:
+    _configure()
+    return logging.getLogger(f'{ROOT_LOGGER}.{name}')
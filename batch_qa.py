@@ -0,0 +1,127 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from app_logging import get_logger
+from rag_engine import get_engine
+
+logger = get_logger(__name__)
+
+PROMPT_FILE = 'question.prompt.txt'
+UTF_8_ENCODING = 'utf-8'
+REPORT_INTERVAL_SECONDS = 10
+
+class RateLimiter:
+    '''Spaces request starts evenly so that at most `requests_per_minute` start per minute.'''
+
+    def __init__(self, requests_per_minute: float):
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_at)
+            self._next_at = start_at + self.interval
+        await asyncio.sleep(start_at - now)
+
+def _read_questions(path: str) -> list[dict]:
+    '''Questions with an `id` (default: line number), `question` and optional `title` filter.'''
+    questions = []
+    with open(path, 'r', encoding=UTF_8_ENCODING) as f:
+        for i, line in enumerate(f, start=1):
+            if line.strip():
+                item: dict = json.loads(line)
+                questions.append({'id': str(item.get('id', i)), 'question': item['question'], 'title': item.get('title')})
+    return questions
+
+def _done_ids(path: str) -> set[str]:
+    '''Ids already answered without error by an earlier, possibly interrupted, run.'''
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path, 'r', encoding=UTF_8_ENCODING) as f:
+        for line in f:
+            try:
+                result: dict = json.loads(line)
+            except json.JSONDecodeError:
+                continue # partial last line of an interrupted run
+            if not result.get('error'):
+                done.add(result['id'])
+    return done
+
+async def _answer(item: dict, max_docs: int|None, use_cache: bool) -> dict:
+    filter = {'title': item['title']} if item['title'] else {}
+    timings: dict[str, float|bool] = {}
+    started = time.perf_counter()
+    result = {**item, 'answer': None}
+    try:
+        async for answer in get_engine().astream(PROMPT_FILE, item['question'], filter, max_docs, use_cache, timings=timings):
+            result['answer'] = answer
+    except Exception as e:
+        result['error'] = str(e)
+    result['cached'] = timings.pop('cached', False)
+    if timings.pop('failed', False) and not result.get('error'):
+        result['error'] = 'retrieval or generation failed' # the engine answered with its sorry text, so retry on resume
+    result['timings'] = {**timings, 'total_seconds': time.perf_counter() - started}
+    return result
+
+async def run(input_path: str, output_path: str, concurrency: int, requests_per_minute: float, max_docs: int|None, use_cache: bool) -> None:
+    questions = _read_questions(input_path)
+    done = _done_ids(output_path)
+    pending = [item for item in questions if item['id'] not in done]
+    logger.info('%s questions, %s already answered, %s to go', f'{len(questions):,}', f'{len(questions) - len(pending):,}', f'{len(pending):,}')
+
+    queue: asyncio.Queue[dict] = asyncio.Queue()
+    for item in pending:
+        queue.put_nowait(item)
+    rate_limiter = RateLimiter(requests_per_minute)
+    answered = errors = 0
+    started = time.monotonic()
+    reported = started
+
+    with open(output_path, 'a', encoding=UTF_8_ENCODING) as out_file:
+
+        async def worker() -> None:
+            nonlocal answered, errors, reported
+            while not queue.empty():
+                item = queue.get_nowait()
+                await rate_limiter.wait()
+                result = await _answer(item, max_docs, use_cache)
+                out_file.write(json.dumps(result, ensure_ascii=False))
+                out_file.write('\n')
+                out_file.flush() # so an interrupted run resumes after the last written answer
+                answered += 1
+                errors += 'error' in result
+                if time.monotonic() - reported >= REPORT_INTERVAL_SECONDS:
+                    reported = time.monotonic()
+                    logger.info('%s/%s answered (%s errors), %.2f questions/sec', f'{answered:,}', f'{len(pending):,}', f'{errors:,}', answered / (reported - started))
+
+        await asyncio.gather(*(worker() for _ in range(min(concurrency, len(pending)) or 1)))
+
+    elapsed = time.monotonic() - started
+    logger.info('Answered %s questions (%s errors) in %.1fs', f'{answered:,}', f'{errors:,}', elapsed)
+    logger.info('cache stats: %s', get_engine().cache_stats())
+    logger.info('model stats: %s', get_engine().model_stats())
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Answer questions from a JSONL file concurrently, e.g. for evaluation or cache warming.')
+    parser.add_argument('input', help='JSONL file, one {"question": ..., "title": ... (optional), "id": ... (optional)} per line')
+    parser.add_argument('output', help='JSONL file the answers and per-stage timings are appended to; re-running skips answered ids')
+    parser.add_argument('--concurrency', type=int, default=8, help='questions answered at once (default: %(default)s)')
+    parser.add_argument('--rpm', type=float, default=60, help='max questions started per minute, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--max-docs', type=int, help='chunks retrieved per question (default: retriever default)')
+    parser.add_argument('--no-cache', action='store_true', help='don\'t use cached answers')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _parse_args()
+    asyncio.run(run(args.input, args.output, args.concurrency, args.rpm, args.max_docs, not args.no_cache))
@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_services import FakeMongo, FakeOpenAI, FakePinecone, FaultProfile
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+UTF_8_ENCODING = 'utf-8'
+
+_WORDS = '''
+    patients cohort trial randomized outcomes mortality hospitalization therapy treatment dose placebo efficacy safety
+    incidence prevalence risk factors biomarkers genotype variant expression inflammation infection vaccine antibody
+    cardiac renal hepatic pulmonary neurological metabolic chronic acute severe mild moderate baseline follow-up
+    analysis regression significant reduction increase association survival adverse events quality life cost
+'''.split()
+_TERMS = ['heart failure', 'osteoporosis', 'COVID-19', 'Alzheimer\'s disease', 'malaria', 'tuberculosis', 'V122I', 'THAOS',
+          'hepatitis B', 'influenza', 'diabetes', 'asthma']
+
+def write_synthetic_articles(path: str, count: int, paragraphs: int, seed: int=42) -> None:
+    '''A `research_pubs.jsonl` of `count` articles with random medical-ish text and a few disease and gene terms each.'''
+    rng = random.Random(seed)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding=UTF_8_ENCODING) as f:
+        for i in range(1, count + 1):
+            terms = rng.sample(_TERMS, 3)
+            text = '\n\n'.join(' '.join(rng.choice(_WORDS + terms) for _ in range(rng.randint(60, 160))).capitalize() + '.'
+                               for _ in range(paragraphs))
+            f.write(json.dumps({'url': f'https://example.org/articles/{i}',
+                                'published_at': f'20{rng.randint(21, 24)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+                                'title': f'{terms[0].capitalize()} and {terms[1]} in a {rng.choice(_WORDS)} study {i}',
+                                'authors': 'A. Author, B. Author',
+                                'contents': text}, ensure_ascii=False))
+            f.write('\n')
+
+def latency_stats(seconds: list[float]) -> dict[str, float]:
+    '''Count and mean / percentiles in milliseconds.'''
+    if not seconds:
+        return {'count': 0}
+    ordered = sorted(seconds)
+    percentile = lambda p: ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)] * 1000
+    return {'count': len(ordered), 'mean_ms': statistics.fmean(ordered) * 1000, 'p50_ms': percentile(50), 'p90_ms': percentile(90),
+            'p95_ms': percentile(95), 'p99_ms': percentile(99), 'max_ms': ordered[-1] * 1000}
+
+def _git_commit() -> str|None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def _service_env(openai_chat: FakeOpenAI, openai_embedding: FakeOpenAI, pinecone: FakePinecone, mongo: FakeMongo) -> dict[str, str]:
+    return {
+        'PINECONE_API_KEY': 'fake', 'PINECONE_HOST': pinecone.url, 'PINECONE_INDEX_NAME': 'fake',
+        'OPENAI_EMBEDDING_BASE_URL': f'{openai_embedding.url}/v1', 'OPENAI_EMBEDDING_API_KEY': 'fake',
+        'OPENAI_EMBEDDING_MODEL': 'text-embedding-3-small',
+        'OPENAI_BASE_URL': f'{openai_chat.url}/v1', 'OPENAI_API_KEY': 'fake', 'OPENAI_MODEL': 'fake-fallback', 'MAX_TOKENS': '1024',
+        'OPENAI_BASE_URL2': f'{openai_chat.url}/v1', 'OPENAI_API_KEY2': 'fake', 'OPENAI_MODEL2': 'fake-primary', 'MAX_TOKENS2': '1024',
+        'MONGODB_ATLAS_CLUSTER_URI': mongo.url, 'DB_NAME': 'benchmark', 'COLLECTION_NAME': 'user_stats',
+        'DUMMY_IP_ADDRESS': '127.0.0.1',
+        'VECTOR_STORE_BACKEND': 'pinecone', 'CHUNK_TEXT_STORE': '',
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'), 'METRICS_PORT': '0',
+    }
+
+def _run_script(args: list[str], work_dir: str, env: dict[str, str], log_file) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, *args], cwd=work_dir, env={**os.environ, **env}, stdout=log_file, stderr=subprocess.STDOUT, check=True)
+    return time.perf_counter() - started
+
+def bench_loader(work_dir: str, env: dict[str, str], pinecone: FakePinecone, openai_embedding: FakeOpenAI, articles: int, log_file) -> dict:
+    loader = os.path.join(REPO_DIR, 'pinecone_loader.py')
+    # the loader's embedding client reads OPENAI_BASE_URL, which the app uses for the fallback llm
+    loader_env = {**env, 'OPENAI_BASE_URL': env['OPENAI_EMBEDDING_BASE_URL']}
+    embedding_requests = openai_embedding.requests
+    seconds = _run_script([loader, '--pipeline', '--no-embedding-cache'], work_dir, loader_env, log_file)
+    results = {'articles': articles, 'vectors': pinecone.vector_count(), 'seconds': seconds,
+               'docs_per_second': articles / seconds, 'vectors_per_second': pinecone.vector_count() / seconds,
+               'embedding_requests': openai_embedding.requests - embedding_requests}
+    # nothing changed, so this measures the manifest skip path
+    results['unchanged_rerun_seconds'] = _run_script([loader, '--pipeline'], work_dir, loader_env, log_file)
+    _run_script([os.path.join(REPO_DIR, 'build_title_db.py')], work_dir, env, log_file)
+    return results
+
+STARTUP_MODULES = ('gradio_ui', 'pinecone_rag', 'user_stats_service', 'pinecone_loader', 'build_title_db')
+
+def bench_startup(work_dir: str, env: dict[str, str], runs: int) -> dict:
+    '''
+    Cold start, as paid by each new replica: a fresh interpreter importing each entry module (`gradio_ui` builds the UI
+    but doesn't launch it). `import` is the time spent in the import, `process` the whole process including interpreter startup.
+    '''
+    code = 'import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)'
+    results = {}
+    for module in STARTUP_MODULES:
+        imports, processes = [], []
+        for _ in range(runs):
+            started = time.perf_counter()
+            run = subprocess.run([sys.executable, '-c', code.format(module=module)], cwd=work_dir,
+                                 env={**os.environ, **env, 'PYTHONPATH': REPO_DIR}, capture_output=True, text=True)
+            if run.returncode != 0:
+                results[module] = {'error': run.stderr.strip().splitlines()[-1] if run.stderr.strip() else f'exit code {run.returncode}'}
+                break
+            processes.append(time.perf_counter() - started)
+            imports.append(float(run.stdout.strip().splitlines()[-1]))
+        else:
+            results[module] = {'import': latency_stats(imports), 'process': latency_stats(processes)}
+    return results
+
+def _titles(work_dir: str) -> list[str]:
+    with open(os.path.join(work_dir, 'db', 'articles.jsonl'), 'r', encoding=UTF_8_ENCODING) as f:
+        return [json.loads(line)['title'] for line in f]
+
+def _timed(fn, *args) -> tuple[float, object]:
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+def bench_rag(titles: list[str], iterations: int, concurrency: int) -> dict:
+    import pinecone_rag
+    pinecone_rag.warm_up()
+    rng = random.Random(7)
+    results = {}
+
+    # a different question each time, so the caches don't answer
+    samples = [_timed(pinecone_rag.ask_question, f'What are the outcomes of {rng.choice(_TERMS)} treatment? ({i})')[0] for i in range(iterations)]
+    results['ask_question'] = latency_stats(samples)
+
+    samples = [_timed(pinecone_rag.ask_question, f'What are the key findings? ({i})', {'title': rng.choice(titles)})[0] for i in range(iterations)]
+    results['ask_question_title'] = latency_stats(samples)
+
+    samples, errors = [], 0
+    for i in range(iterations):
+        started = time.perf_counter()
+        try:
+            pinecone_rag.get_quiz(rng.choice(titles))
+        except Exception:
+            errors += 1
+        samples.append(time.perf_counter() - started)
+    results['get_quiz'] = {**latency_stats(samples), 'errors': errors}
+
+    async def stream_concurrently() -> dict:
+        semaphore = asyncio.Semaphore(concurrency)
+        first_token, total = [], []
+
+        async def one(i: int) -> None:
+            async with semaphore:
+                started = time.perf_counter()
+                first = None
+                async for _ in pinecone_rag.astream_question(f'Describe {rng.choice(_TERMS)} research. ({i})', {'title': rng.choice(titles)}):
+                    first = first or time.perf_counter() - started
+                first_token.append(first or 0.0)
+                total.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(iterations)))
+        elapsed = time.perf_counter() - started
+        return {'concurrency': concurrency, 'questions_per_second': iterations / elapsed,
+                'first_token': latency_stats(first_token), 'total': latency_stats(total)}
+
+    results['astream_question_concurrent'] = asyncio.run(stream_concurrently())
+    results['model_stats'] = pinecone_rag.model_stats()
+    return results
+
+def bench_user_stats(iterations: int, users: int) -> dict:
+    import user_stats_service
+    from progress_report import REPORT_PAGE_SIZE
+    from utils import format_timestamp
+
+    def submit_answer_stats(ip_address: str, i: int) -> None:
+        # what gradio_ui.submit_answer does with the stats
+        time_seconds = time.time()
+        user_stats_service.queue_quiz_attempt(ip_address, {'article': f'Article {i}', 'question': f'Question {i}?', 'answer': 'a. Answer',
+                                                           'correct': i % 2 == 0, 'time_seconds': int(time_seconds), 'formatted_time': format_timestamp(time_seconds)})
+
+    async def read_report_data() -> list[float]:
+        # what gradio_ui.generate_report reads: the stats version, then the aggregated summaries and first page
+        samples = []
+        for i in range(iterations):
+            started = time.perf_counter()
+            await user_stats_service.aget_stats_version(f'10.0.0.{i % users}')
+            await user_stats_service.aget_report_data(f'10.0.0.{i % users}', 1, REPORT_PAGE_SIZE)
+            samples.append(time.perf_counter() - started)
+        return samples
+
+    results = {'submit_answer': latency_stats([_timed(submit_answer_stats, f'10.0.0.{i % users}', i)[0] for i in range(iterations)])}
+    results['flush_seconds'] = _timed(user_stats_service.get_stats_writer().flush)[0] # whatever is still queued
+    results['report_data'] = latency_stats(asyncio.run(read_report_data()))
+    return results
+
+def bench_report(iterations: int, quizzes: int) -> dict:
+    from progress_report import create_progress_report
+
+    stats = {'ip_address': '10.0.0.1',
+             'quizzes': [{'article': f'Article {i} about heart failure outcomes', 'question': f'Which finding was reported in study {i}?',
+                          'answer': 'a. Finding', 'correct': i % 3 != 0, 'time_seconds': 1735077720 + i,
+                          'formatted_time': '2024-12-24 10:02 PM UTC'} for i in range(quizzes)]}
+    samples = [_timed(create_progress_report, stats)[0] for _ in range(iterations)]
+    return {'create_progress_report': {**latency_stats(samples), 'quizzes': quizzes}}
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark the loader, RAG, user stats and report paths against local fake Pinecone, OpenAI and Mongo services.')
+    parser.add_argument('--output', default='benchmark_results.json', help='results file (default: %(default)s)')
+    parser.add_argument('--articles', type=int, default=200, help='synthetic articles to load (default: %(default)s)')
+    parser.add_argument('--paragraphs', type=int, default=8, help='paragraphs per synthetic article (default: %(default)s)')
+    parser.add_argument('--iterations', type=int, default=50, help='requests per latency benchmark (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent streamed questions (default: %(default)s)')
+    parser.add_argument('--startup-runs', type=int, default=3, help='fresh interpreters per module in the cold start benchmark (default: %(default)s)')
+    parser.add_argument('--users', type=int, default=10, help='distinct users in the stats benchmark (default: %(default)s)')
+    parser.add_argument('--user-stats-backend', default='mongo', choices=['mongo', 'sqlite'], help='USER_STATS_BACKEND of the stats benchmark (default: %(default)s)')
+    parser.add_argument('--report-quizzes', type=int, default=200, help='quizzes in the rendered progress report (default: %(default)s)')
+    parser.add_argument('--embedding-latency-ms', type=float, default=40)
+    parser.add_argument('--chat-first-token-ms', type=float, default=400)
+    parser.add_argument('--chat-token-ms', type=float, default=10)
+    parser.add_argument('--pinecone-latency-ms', type=float, default=30)
+    parser.add_argument('--mongo-latency-ms', type=float, default=5)
+    parser.add_argument('--jitter', type=float, default=0.2, help='+/- fraction of each latency (default: %(default)s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests each service fails (default: %(default)s)')
+    parser.add_argument('--skip', nargs='*', default=[], choices=['loader', 'startup', 'rag', 'user_stats', 'report'], help='benchmarks to skip')
+    parser.add_argument('--keep-work-dir', action='store_true', help='keep the temporary working directory and its log')
+    return parser.parse_args()
+
+def _profile(latency_ms: float, args: argparse.Namespace) -> FaultProfile:
+    return FaultProfile(latency_ms / 1000, latency_ms / 1000 * args.jitter, args.failure_rate)
+
+if __name__ == '__main__':
+    args = _parse_args()
+    output_path = os.path.abspath(args.output)
+
+    openai_chat = FakeOpenAI(_profile(args.chat_first_token_ms, args), token_seconds=args.chat_token_ms / 1000).start()
+    openai_embedding = FakeOpenAI(_profile(args.embedding_latency_ms, args)).start()
+    pinecone = FakePinecone(_profile(args.pinecone_latency_ms, args)).start()
+    mongo = FakeMongo(_profile(args.mongo_latency_ms, args)).start()
+    env = _service_env(openai_chat, openai_embedding, pinecone, mongo)
+    env['USER_STATS_BACKEND'] = args.user_stats_backend
+
+    # the app uses paths relative to the working directory, so run it in a scratch copy
+    work_dir = tempfile.mkdtemp(prefix='researchio-benchmark-')
+    for name in ('prompts', 'templates', 'assets'):
+        os.symlink(os.path.join(REPO_DIR, name), os.path.join(work_dir, name))
+    os.makedirs(os.path.join(work_dir, 'db'))
+    shutil.copy(os.path.join(REPO_DIR, 'db', 'diseases.txt'), os.path.join(work_dir, 'db', 'diseases.txt'))
+    write_synthetic_articles(os.path.join(work_dir, 'data', 'research_pubs.jsonl'), args.articles, args.paragraphs)
+
+    log_path = os.path.join(work_dir, 'benchmark.log')
+    results = {'commit': _git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'config': vars(args), 'results': {}}
+    with open(log_path, 'w', encoding=UTF_8_ENCODING) as log_file:
+        if 'loader' not in args.skip:
+            print('Benchmarking loader ...')
+            log_file.flush()
+            results['results']['loader'] = bench_loader(work_dir, env, pinecone, openai_embedding, args.articles, log_file)
+
+        if 'startup' not in args.skip and os.path.exists(os.path.join(work_dir, 'db', 'articles.jsonl')):
+            print('Benchmarking startup ...')
+            results['results']['startup'] = bench_startup(work_dir, env, args.startup_runs)
+
+        # the app modules read their config at import, and their files relative to the working directory
+        os.environ.update(env)
+        os.chdir(work_dir)
+        sys.path.insert(0, REPO_DIR)
+        with contextlib.redirect_stdout(log_file):
+            if 'rag' not in args.skip and os.path.exists(os.path.join(work_dir, 'db', 'articles.jsonl')):
+                print('Benchmarking rag ...', file=sys.stderr)
+                results['results']['rag'] = bench_rag(_titles(work_dir), args.iterations, args.concurrency)
+            if 'user_stats' not in args.skip:
+                print('Benchmarking user stats ...', file=sys.stderr)
+                results['results']['user_stats'] = bench_user_stats(args.iterations, args.users)
+            if 'report' not in args.skip:
+                print('Benchmarking report ...', file=sys.stderr)
+                results['results']['report'] = bench_report(args.iterations, args.report_quizzes)
+        from metrics import stage_seconds
+        results['results']['stages'] = stage_seconds.totals() # where the in-process time went, per stage
+
+    results['services'] = {name: {'requests': service.requests, 'injected_failures': service.failures}
+                           for name, service in (('openai_chat', openai_chat), ('openai_embedding', openai_embedding),
+                                                 ('pinecone', pinecone), ('mongo', mongo))}
+    with open(output_path, 'w', encoding=UTF_8_ENCODING) as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results['results'], indent=2))
+    print(f'Saved: {output_path}')
+
+    os.chdir(REPO_DIR)
+    if args.keep_work_dir:
+        print(f'Work dir and log: {work_dir}')
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
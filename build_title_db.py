@@ -1,8 +1,11 @@
 import json
 import os
 
-from pinecone_loader import DATA_FILE, UTF_8_ENCODING
+from catalog import save_catalog, unique_titles
+from disease_index import DiseaseIndexBuilder, load_diseases
+from ingest_manifest import DATA_FILE # not from pinecone_loader: importing it loads the embedding and vector clients
 
+UTF_8_ENCODING = 'utf-8'
 OUT_DIR = 'db'
 OUT_FILE = f'{OUT_DIR}/articles.jsonl'
 
@@ -10,6 +13,9 @@ os.makedirs(OUT_DIR, exist_ok=True)
 
 if __name__ == '__main__':
 
+    disease_index = DiseaseIndexBuilder()
+    titles = []
+
     with open(DATA_FILE, 'r', encoding=UTF_8_ENCODING) as data_file, open(OUT_FILE, 'w', encoding=UTF_8_ENCODING) as out_file:
         for i, line in enumerate(data_file, start=1):
 
@@ -26,3 +32,9 @@ if __name__ == '__main__':
                 'authors': authors
             }, ensure_ascii=False))
             out_file.write('\n')
+
+            disease_index.add(url, title, published_at, jsonl['contents'])
+            titles.append(title)
+
+    disease_index.save()
+    save_catalog(unique_titles(titles), load_diseases()) # written last, so it is newer than its sources
@@ -0,0 +1,146 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+
+from typing import Generator
+
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+STATE_FILE = 'state.db' # in the output directory: see RenderState
+CURSOR_BATCH_SIZE = 500 # documents per cursor batch, and users per stats or state query
+TASKS_PER_WORKER = 4 # rendered reports waiting per worker: bounds memory whatever the user count
+SAVE_STATE_EVERY = 100 # rendered reports per state commit
+REPORT_INTERVAL_SECONDS = 10
+
+# worker process side: the template is compiled once per worker, by the import in the initializer
+
+def _init_worker() -> None:
+    import progress_report # noqa: F401
+
+def _render(user_stats: dict, output_dir: str, compress: bool) -> tuple[str, str, int]:
+    from progress_report import user_dir_name, summarize_quizzes, write_report
+    ip_address = user_stats['ip_address']
+    report = summarize_quizzes(ip_address, user_stats.get('quizzes', []))
+    outfile_path = os.path.join(output_dir, f'Progress Report for {user_dir_name(ip_address)}.html{".gz" if compress else ""}')
+    return ip_address, user_stats['version'], write_report(report, outfile_path, compress)
+
+# parent side
+
+class RenderState:
+    '''
+    The stats version each user's report was rendered from, in a sqlite table in the output directory: looked up
+    one cursor batch at a time and committed every SAVE_STATE_EVERY reports, so neither memory nor the writes grow
+    with the user count.
+    '''
+
+    def __init__(self, output_dir: str):
+        self._conn = sqlite3.connect(os.path.join(output_dir, STATE_FILE))
+        self._conn.execute('CREATE TABLE IF NOT EXISTS rendered (ip_address TEXT PRIMARY KEY, version TEXT NOT NULL) WITHOUT ROWID')
+        self._conn.commit()
+        self._unsaved = 0
+
+    def changed(self, versions: list[tuple[str, str]]) -> list[str]:
+        '''The users of (ip address, version) `versions` whose report wasn't rendered from that version.'''
+        rendered = dict(self._conn.execute(
+            f'SELECT ip_address, version FROM rendered WHERE ip_address IN ({",".join("?" * len(versions))})',
+            [ip_address for ip_address, _ in versions]))
+        return [ip_address for ip_address, version in versions if rendered.get(ip_address) != version]
+
+    def record(self, ip_address: str, version: str) -> None:
+        self._conn.execute('INSERT OR REPLACE INTO rendered (ip_address, version) VALUES (?, ?)', (ip_address, version))
+        self._unsaved += 1
+        if self._unsaved >= SAVE_STATE_EVERY:
+            self.save()
+
+    def save(self) -> None:
+        self._conn.commit() # an interrupted run resumes from here
+        self._unsaved = 0
+
+    def close(self) -> None:
+        self.save()
+        self._conn.close()
+
+def _changed_users(state: RenderState, force: bool, counts: dict[str, int]) -> Generator[list[str], None, None]:
+    '''Batches of users whose stats changed since their last report, from a cursor over the versions only.'''
+    from user_stats_service import iter_stats_versions
+    versions = []
+    for ip_address, version in iter_stats_versions(CURSOR_BATCH_SIZE):
+        counts['users'] += 1
+        versions.append((ip_address, version))
+        if len(versions) == CURSOR_BATCH_SIZE:
+            yield [ip_address for ip_address, _ in versions] if force else state.changed(versions)
+            versions = []
+    if versions:
+        yield [ip_address for ip_address, _ in versions] if force else state.changed(versions)
+
+def run(output_dir: str, workers: int, compress: bool, force: bool) -> dict:
+    from user_stats_service import iter_user_stats
+    os.makedirs(output_dir, exist_ok=True)
+    state = RenderState(output_dir)
+    started = time.monotonic()
+    last_report = started
+    rendered = bytes_written = errors = 0
+    counts = {'users': 0, 'changed': 0}
+
+    # spawn, not fork: the parent holds a mongo client, which must not be shared with child processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_init_worker) as executor:
+        pending: dict[concurrent.futures.Future, str] = {} # the ip address each report is for
+
+        def collect(wait_for: int) -> None:
+            nonlocal rendered, bytes_written, errors, last_report
+            while len(pending) > wait_for:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    ip_address = pending.pop(future)
+                    try:
+                        _, version, size = future.result()
+                    except Exception as e:
+                        logger.error('Error rendering the report for %s: %s', ip_address, e)
+                        errors += 1
+                        continue
+                    state.record(ip_address, version)
+                    rendered += 1
+                    bytes_written += size
+            now = time.monotonic()
+            if now - last_report >= REPORT_INTERVAL_SECONDS:
+                last_report = now
+                logger.info('%s reports (%.1f/sec)', f'{rendered:,}', rendered / (now - started))
+
+        for ip_addresses in _changed_users(state, force, counts):
+            if not ip_addresses:
+                continue
+            for user_stats in iter_user_stats(ip_addresses, CURSOR_BATCH_SIZE):
+                counts['changed'] += 1
+                pending[executor.submit(_render, user_stats, output_dir, compress)] = user_stats['ip_address']
+                collect(wait_for=workers * TASKS_PER_WORKER)
+        collect(wait_for=0)
+
+    state.close()
+    elapsed = max(time.monotonic() - started, 1e-9)
+    logger.info('Rendered %s of %s changed reports (%d errors) in %.1fs', f'{rendered:,}', f'{counts["changed"]:,}', errors, elapsed)
+    return {**counts, 'skipped': counts['users'] - counts['changed'], 'rendered': rendered, 'errors': errors,
+            'seconds': elapsed, 'reports_per_second': rendered / elapsed, 'megabytes_written': bytes_written / 1e6,
+            'megabytes_per_second': bytes_written / 1e6 / elapsed}
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Render the progress report of every user, e.g. to email or archive at the end of a term.')
+    parser.add_argument('output_dir', help='directory for the reports; re-running into it only renders users whose stats changed')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='rendering processes (default: %(default)s)')
+    parser.add_argument('--compress', action='store_true', help='write gzipped reports (.html.gz)')
+    parser.add_argument('--force', action='store_true', help='render every user, even if unchanged since the last run')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _parse_args()
+    summary = run(args.output_dir, args.workers, args.compress, args.force)
+    print(json.dumps(summary, indent=2)) # the command's output, on stdout; progress and errors are logged to stderr
@@ -0,0 +1,50 @@
+import json
+import os
+
+from typing import Iterable
+
+from app_logging import get_logger
+from disease_index import DISEASES_FILE, load_diseases
+from title_scope import ARTICLES_FILE, clean_title
+
+logger = get_logger(__name__)
+
+CATALOG_FILE = 'db/catalog.json' # built by build_title_db.py
+
+def unique_titles(titles: Iterable[str]) -> list[str]:
+    '''Cleaned titles as listed in the UI, without duplicates, sorted case-insensitively.'''
+    seen_titles = set()
+    unique = []
+    for title in titles:
+        cleaned_title = clean_title(title)
+        if cleaned_title not in seen_titles:
+            seen_titles.add(cleaned_title)
+            unique.append(cleaned_title)
+    unique.sort(key=str.lower)
+    return unique
+
+def save_catalog(titles: list[str], diseases: list[str], path: str=CATALOG_FILE) -> None:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'titles': titles, 'diseases': diseases}, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+    logger.info('Catalog: %s titles, %s diseases', f'{len(titles):,}', f'{len(diseases):,}')
+
+def load_catalog(path: str=CATALOG_FILE, articles_path: str=ARTICLES_FILE, diseases_path: str=DISEASES_FILE) -> tuple[list[str], list[str]]:
+    '''
+    (titles, diseases) for the UI, in one read of the catalog. Falls back to building them from `articles_path`
+    and `diseases_path` if the catalog is missing or older than either of them.
+    '''
+    try:
+        built = os.path.getmtime(path)
+        if all(not os.path.exists(source) or os.path.getmtime(source) <= built for source in (articles_path, diseases_path)):
+            with open(path, 'r', encoding='utf-8') as f:
+                catalog = json.load(f)
+            return catalog['titles'], catalog['diseases']
+        logger.warning('Catalog %s is out of date, run build_title_db.py to rebuild it', path)
+    except FileNotFoundError:
+        logger.warning('No catalog at %s, run build_title_db.py to build it', path)
+
+    with open(articles_path, 'r', encoding='utf-8') as f:
+        titles = unique_titles(json.loads(line)['title'] for line in f)
+    return titles, load_diseases(diseases_path)
@@ -0,0 +1,46 @@
+import sqlite3
+import threading
+import zlib
+
+CHUNK_STORE_FILE = 'db/chunk_store.db'
+COMPRESSION_LEVEL = 6
+
+_MAX_SQL_PARAMS = 500 # stay well under sqlite's host parameter limit
+
+class ChunkStore:
+    '''
+    Local store of chunk text, compressed and keyed by vector id (`src|i`),
+    so the text doesn't have to travel in pinecone metadata. Safe to use from multiple threads.
+    '''
+
+    def __init__(self, path: str=CHUNK_STORE_FILE):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, text BLOB NOT NULL) WITHOUT ROWID')
+        self._conn.commit()
+
+    def put_many(self, chunks: list[tuple[str, str]]) -> None:
+        rows = [(id, zlib.compress(text.encode('utf-8'), COMPRESSION_LEVEL)) for id, text in chunks]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO chunks (id, text) VALUES (?, ?)', rows)
+            self._conn.commit()
+
+    def get_many(self, ids: list[str]) -> dict[str, str]:
+        found: dict[str, bytes] = {}
+        with self._lock:
+            for i in range(0, len(ids), _MAX_SQL_PARAMS):
+                batch = ids[i:i + _MAX_SQL_PARAMS]
+                placeholders = ','.join('?' * len(batch))
+                found.update(self._conn.execute(f'SELECT id, text FROM chunks WHERE id IN ({placeholders})', batch))
+        return {id: zlib.decompress(text).decode('utf-8') for id, text in found.items()}
+
+    def delete(self, ids: list[str]) -> None:
+        with self._lock:
+            self._conn.executemany('DELETE FROM chunks WHERE id = ?', [(id,) for id in ids])
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
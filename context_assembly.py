@@ -0,0 +1,139 @@
+import math
+import os
+import re
+
+from functools import cache
+
+import tiktoken
+
+from langchain_core.documents import Document
+
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+# max context tokens per prompt file, pasted into the prompt in place of {context}
+CONTEXT_TOKEN_BUDGETS = {
+    'question.prompt.txt': int(os.getenv('QUESTION_CONTEXT_TOKENS', '6000')),
+    'get_quiz.prompt.txt': int(os.getenv('QUIZ_CONTEXT_TOKENS', '4000')),
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 6000
+
+NEAR_DUPLICATE_SIMILARITY = 0.9 # jaccard similarity of word shingles
+SHINGLE_SIZE = 3
+MAX_PASSAGE_TOKENS = 200 # longer paragraphs are split into sentences
+
+_STOPWORDS = frozenset('''
+    a about all an and any are as at be been but by can did do does for from had has have how i if in into is it its
+    list more most not of on or our should so such than that the their them then there these they this those to
+    was were what when where which who why will with would you your article articles research study studies
+'''.split())
+
+_WORD = re.compile(r'[a-z0-9][a-z0-9\-]*')
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+CHARACTERS_PER_TOKEN = 4 # estimate used when the tokenizer isn't available
+
+@cache
+def _encoding() -> tiktoken.Encoding|None:
+    try:
+        return tiktoken.get_encoding('cl100k_base') # downloaded on first use, so may fail offline
+    except Exception as e:
+        logger.warning('Error loading tokenizer, estimating token counts instead: %s', e)
+        return None
+
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        return math.ceil(len(text) / CHARACTERS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    '''The start of `text`, at most `max_tokens` long.'''
+    encoding = _encoding()
+    if encoding is None:
+        return text[:max_tokens * CHARACTERS_PER_TOKEN]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+def context_token_budget(prompt_file: str) -> int:
+    return CONTEXT_TOKEN_BUDGETS.get(prompt_file, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+def assemble_context(question: str, documents: list[Document], max_tokens: int) -> list[Document]:
+    '''
+    Fits retrieved chunks into a token budget: drops near-duplicate chunks of the same `src`,
+    then, if still over budget, keeps only the passages most relevant to `question`
+    (in their original order), favouring higher ranked chunks on ties.
+    '''
+    tokens_before = sum(count_tokens(document.page_content) for document in documents)
+    documents = _dedupe(documents)
+
+    passages = [(rank, position, passage, count_tokens(passage))
+                for rank, document in enumerate(documents)
+                for position, passage in enumerate(_split_passages(document.page_content))]
+    if sum(tokens for *_, tokens in passages) > max_tokens:
+        documents = _select_passages(question, documents, passages, max_tokens)
+
+    tokens_after = sum(count_tokens(document.page_content) for document in documents)
+    logger.info('context tokens: %s -> %s (saved %s, budget %s)', f'{tokens_before:,}', f'{tokens_after:,}', f'{tokens_before - tokens_after:,}', f'{max_tokens:,}')
+    return documents
+
+def _dedupe(documents: list[Document]) -> list[Document]:
+    kept: list[tuple[Document, set]] = []
+    for document in documents:
+        shingles = _shingles(document.page_content)
+        src = document.metadata.get('src')
+        if any(other.metadata.get('src') == src and _jaccard(shingles, other_shingles) >= NEAR_DUPLICATE_SIMILARITY
+               for other, other_shingles in kept):
+            continue
+        kept.append((document, shingles))
+    return [document for document, _ in kept]
+
+def _shingles(text: str) -> set[tuple[str, ...]]:
+    words = _WORD.findall(text.lower())
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))}
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def _split_passages(text: str) -> list[str]:
+    passages = []
+    for paragraph in _PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= MAX_PASSAGE_TOKENS:
+            passages.append(paragraph)
+        else:
+            passages.extend(sentence for sentence in _SENTENCE_END.split(paragraph) if sentence)
+    return passages
+
+def query_terms(question: str) -> set[str]:
+    '''Lowercased words of `question` worth matching on: no stopwords or very short words.'''
+    return {word for word in _WORD.findall(question.lower()) if word not in _STOPWORDS and len(word) > 2}
+
+def _select_passages(question: str, documents: list[Document], passages: list[tuple[int, int, str, int]], max_tokens: int) -> list[Document]:
+    terms = query_terms(question)
+    passage_terms = [terms.intersection(_WORD.findall(passage.lower())) for _, _, passage, _ in passages]
+    # idf over the retrieved passages, so terms which appear everywhere count for little
+    idf = {term: math.log(1 + len(passages) / (1 + sum(term in found for found in passage_terms))) for term in terms}
+    scores = [sum(idf[term] for term in found) for found in passage_terms]
+
+    ranked = sorted(range(len(passages)), key=lambda i: (-scores[i], passages[i][0], passages[i][1]))
+    selected: dict[int, str] = {}
+    used_tokens = 0
+    for i in ranked:
+        tokens = passages[i][3]
+        if used_tokens + tokens <= max_tokens:
+            selected[i] = passages[i][2]
+            used_tokens += tokens
+        elif not selected and max_tokens > 0: # the top passage alone is over budget: keep its start rather than no context
+            selected[i] = truncate_tokens(passages[i][2], max_tokens)
+            used_tokens = max_tokens
+
+    trimmed: dict[int, list[str]] = {}
+    for i in sorted(selected):
+        trimmed.setdefault(passages[i][0], []).append(selected[i])
+
+    return [Document(page_content='\n\n'.join(trimmed[rank]), metadata=document.metadata)
+            for rank, document in enumerate(documents) if rank in trimmed]
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import re
+
+from app_logging import get_logger
+from ingest_manifest import content_hash
+
+logger = get_logger(__name__)
+
+DISEASES_FILE = 'db/diseases.txt' # should be comma separated list
+DISEASE_INDEX_FILE = 'db/disease_index.json'
+TITLE_WEIGHT = 5 # a mention in the title counts as this many mentions in the text
+MAX_LOOKUP_ARTICLES = int(os.getenv('DISEASE_LOOKUP_MAX_ARTICLES', '25'))
+
+def load_diseases(path: str=DISEASES_FILE) -> list[str]:
+    '''Sorted disease names, singular ("disease" rather than "diseases"), without case-insensitive duplicates.'''
+    with open(path, 'r', encoding='utf-8') as f:
+        diseases: str = f.read()
+    diseases = diseases.replace('\n', ',')
+    diseases: list[str] = diseases.split(',')
+    diseases = [d.strip().replace('diseases', 'disease').replace('disorders', 'disorder') for d in diseases if d.strip()]
+    diseases.sort()
+
+    unique_diseases: list[str] = []
+    seen = set()
+    for d in diseases:
+        d_lower = d.lower()
+        if d_lower not in seen:
+            unique_diseases.append(d)
+            seen.add(d_lower)
+
+    return unique_diseases
+
+def disease_key(disease: str) -> str:
+    return ' '.join(_normalize_text(disease).split())
+
+def _normalize_text(text: str) -> str:
+    return text.lower().replace('’', "'")
+
+def _disease_pattern(keys: list[str]) -> re.Pattern:
+    # longest first, so "hepatitis b" wins over "hepatitis"; an optional plural ending, as `load_diseases` drops it
+    terms = sorted(keys, key=len, reverse=True)
+    alternatives = '|'.join(r'\s+'.join(re.escape(word) for word in key.split()) for key in terms)
+    return re.compile(rf'(?<!\w)({alternatives})(?:s|es)?(?!\w)')
+
+class DiseaseIndexBuilder:
+    '''
+    Builds `db/disease_index.json`: for each disease, the articles mentioning it, ranked by term frequency.
+    Rebuilds incrementally: an article whose content hash is unchanged reuses its counts
+    unless the disease list changed. Articles not added again are dropped.
+    '''
+
+    def __init__(self, path: str=DISEASE_INDEX_FILE, diseases_path: str=DISEASES_FILE):
+        self.path = path
+        self.diseases = {disease_key(d): d for d in load_diseases(diseases_path)}
+        self.diseases_hash = hashlib.sha256('\n'.join(sorted(self.diseases)).encode('utf-8')).hexdigest()
+        self._pattern = _disease_pattern(list(self.diseases))
+        self._articles: dict[str, dict] = {}
+        self._previous: dict[str, dict] = {}
+        self.counted = 0
+        self.reused = 0
+
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+            if previous.get('diseases_hash') == self.diseases_hash:
+                self._previous = previous['articles']
+        except FileNotFoundError:
+            pass
+
+    def add(self, url: str, title: str, published_at: str|None, contents: str) -> None:
+        article_hash = content_hash(title, published_at, contents)
+        previous = self._previous.get(url)
+        if previous and previous['hash'] == article_hash:
+            counts = previous['counts']
+            self.reused += 1
+        else:
+            counts = self._count(title, contents)
+            self.counted += 1
+        self._articles[url] = {'title': title, 'published_at': published_at, 'hash': article_hash, 'counts': counts}
+
+    def _count(self, title: str, contents: str) -> dict[str, int]:
+        counts: dict[str, int] = {}
+        for text, weight in ((title, TITLE_WEIGHT), (contents, 1)):
+            for match in self._pattern.finditer(_normalize_text(text)):
+                key = ' '.join(match.group(1).split())
+                counts[key] = counts.get(key, 0) + weight
+        return counts
+
+    def save(self) -> None:
+        index: dict[str, list[str]] = {}
+        for url, article in sorted(self._articles.items(), key=lambda item: item[1]['published_at'] or '', reverse=True):
+            for key in article['counts']:
+                index.setdefault(key, []).append(url)
+        for key, urls in index.items(): # stable sort: ties stay newest first
+            urls.sort(key=lambda url: self._articles[url]['counts'][key], reverse=True)
+
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'diseases_hash': self.diseases_hash, 'articles': self._articles, 'index': index}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        logger.info('Disease index: %s diseases in %s articles (%s counted, %s unchanged)',
+                    f'{len(index):,}', f'{len(self._articles):,}', f'{self.counted:,}', f'{self.reused:,}')
+
+class DiseaseIndex:
+    '''Read side of `DiseaseIndexBuilder`, loaded once.'''
+
+    def __init__(self, articles: dict[str, dict], index: dict[str, list[str]]):
+        self.articles = articles
+        self.index = index
+
+    @classmethod
+    def load(cls, path: str=DISEASE_INDEX_FILE) -> 'DiseaseIndex|None':
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logger.warning('No disease index at %s, run build_title_db.py to build it', path)
+            return None
+        return cls(data['articles'], data['index'])
+
+    def lookup(self, disease: str, max_articles: int=MAX_LOOKUP_ARTICLES) -> str:
+        '''Markdown list of the articles about `disease`, most mentions first.'''
+        urls = self.index.get(disease_key(disease), [])
+        if not urls:
+            return f'No articles found about {disease}.'
+
+        lines = []
+        for url in urls[:max_articles]:
+            article = self.articles[url]
+            published_at = f' ({article["published_at"][:10]})' if article['published_at'] else ''
+            lines.append(f'- [{article["title"]}]({url}){published_at}')
+        if len(urls) > max_articles:
+            lines.append(f'- ... and {len(urls) - max_articles:,} more')
+        return f'{len(urls):,} {"article" if len(urls) == 1 else "articles"} about {disease}:\n' + '\n'.join(lines)
@@ -0,0 +1,62 @@
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+EMBEDDING_CACHE_FILE = 'db/embedding_cache.db'
+
+_MAX_SQL_PARAMS = 500 # stay well under sqlite's host parameter limit
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+class EmbeddingCache:
+    '''
+    Persistent embedding cache keyed by (model name, sha256 of the text),
+    storing each embedding as a float32 blob. Safe to use from multiple threads.
+    '''
+
+    def __init__(self, model: str, path: str=EMBEDDING_CACHE_FILE):
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, key BLOB NOT NULL, vector BLOB NOT NULL, PRIMARY KEY (model, key)) WITHOUT ROWID')
+        self._conn.commit()
+
+    def get_many(self, texts: list[str]) -> list[list[float]|None]:
+        keys = [text_key(text) for text in texts]
+        found: dict[bytes, bytes] = {}
+        with self._lock:
+            for i in range(0, len(keys), _MAX_SQL_PARAMS):
+                batch = keys[i:i + _MAX_SQL_PARAMS]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._conn.execute(f'SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({placeholders})', (self.model, *batch))
+                found.update(rows)
+
+            embeddings = [np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None for key in keys]
+            hits = sum(embedding is not None for embedding in embeddings)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return embeddings
+
+    def put_many(self, texts: list[str], embeddings: list[list[float]]) -> None:
+        rows = [(self.model, text_key(text), np.asarray(embedding, dtype=np.float32).tobytes())
+                for text, embedding in zip(texts, embeddings) if embedding]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO embeddings (model, key, vector) VALUES (?, ?, ?)', rows)
+            self._conn.commit()
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f'embedding cache: {self.hits:,} hits, {self.misses:,} misses ({hit_rate:.1%} hit rate)'
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
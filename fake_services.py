@@ -0,0 +1,642 @@
+import base64
+import copy
+import hashlib
+import itertools
+import json
+import random
+import re
+import socketserver
+import struct
+import threading
+import time
+
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import bson
+import numpy as np
+
+EMBEDDING_DIMENSIONS = 1536 # same as text-embedding-3-small, and the pinecone index dimension in the README
+
+@dataclass
+class FaultProfile:
+    '''Latency (seconds, +/- uniform jitter) added to each request, and the fraction of requests failed on purpose.'''
+    latency_seconds: float = 0.0
+    jitter_seconds: float = 0.0
+    failure_rate: float = 0.0
+
+    def delay(self) -> None:
+        time.sleep(max(self.latency_seconds + random.uniform(-self.jitter_seconds, self.jitter_seconds), 0.0))
+
+    def fails(self) -> bool:
+        return random.random() < self.failure_rate
+
+def fake_embedding(text: str, dimensions: int=EMBEDDING_DIMENSIONS) -> np.ndarray:
+    '''Deterministic unit vector by feature hashing the words, so texts sharing words are similar.'''
+    words = re.findall(r'\w+', text.lower()) or ['']
+    digests = [hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest() for word in words]
+    hashes = np.frombuffer(b''.join(digests), dtype=np.uint64)
+    signs = np.where(hashes & np.uint64(1), 1.0, -1.0)
+    vector = np.bincount((hashes >> np.uint64(1)) % np.uint64(dimensions), weights=signs, minlength=dimensions).astype(np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+# http services
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, so pooled clients behave as against the real services
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self._handle()
+
+    def do_POST(self) -> None:
+        self._handle()
+
+    def _handle(self) -> None:
+        service: '_FakeHttpService' = self.server.service
+        body = self._read_body()
+        service.requests += 1
+        service.profile.delay()
+        if service.profile.fails():
+            service.failures += 1
+            self._send_json(503, {'error': {'message': 'injected failure', 'type': 'server_error'}})
+            return
+        try:
+            self.route(urlparse(self.path), body)
+        except Exception as e:
+            self._send_json(500, {'error': {'message': str(e), 'type': 'server_error'}})
+
+    def route(self, url, body: dict) -> None:
+        raise NotImplementedError
+
+    def _read_body(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _send_json(self, status: int, payload: dict) -> None:
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class _FakeHttpService:
+    def __init__(self, handler_class: type[_JsonHandler], profile: FaultProfile):
+        self.profile = profile
+        self.requests = 0
+        self.failures = 0
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self._server.daemon_threads = True
+        self._server.service = self
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def start(self) -> '_FakeHttpService':
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+class _OpenAIHandler(_JsonHandler):
+    def route(self, url, body: dict) -> None:
+        service: FakeOpenAI = self.server.service
+        if url.path.endswith('/embeddings'):
+            self._embeddings(service, body)
+        elif url.path.endswith('/chat/completions'):
+            self._chat(service, body)
+        else:
+            self._send_json(404, {'error': {'message': f'unknown path {url.path}'}})
+
+    def _embeddings(self, service: 'FakeOpenAI', body: dict) -> None:
+        inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+        data = []
+        for i, item in enumerate(inputs):
+            text = item if isinstance(item, str) else json.dumps(item) # token ids from tiktoken-aware clients
+            embedding = fake_embedding(text, service.dimensions)
+            if body.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(embedding.astype('<f4').tobytes()).decode('ascii')
+            else:
+                embedding = embedding.tolist()
+            data.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+        tokens = sum(len(str(item)) // 4 for item in inputs)
+        self._send_json(200, {'object': 'list', 'data': data, 'model': body.get('model'),
+                              'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}})
+
+    def _chat(self, service: 'FakeOpenAI', body: dict) -> None:
+        content = service.completion(body['messages'])
+        created = int(time.time())
+        if not body.get('stream'):
+            self._send_json(200, {'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': created, 'model': body.get('model'),
+                                  'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                                  'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        tokens = re.findall(r'\S*\s*', content)[:-1] or ['']
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(service.token_seconds)
+            delta = {'role': 'assistant', 'content': token} if i == 0 else {'content': token}
+            self._send_event({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': created, 'model': body.get('model'),
+                              'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})
+        self._send_event({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': created, 'model': body.get('model'),
+                          'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+        self._send_chunk(b'data: [DONE]\n\n')
+        self._send_chunk(b'')
+
+    def _send_event(self, payload: dict) -> None:
+        self._send_chunk(f'data: {json.dumps(payload)}\n\n'.encode('utf-8'))
+
+    def _send_chunk(self, data: bytes) -> None:
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+class FakeOpenAI(_FakeHttpService):
+    '''
+    OpenAI-compatible embeddings and chat completions (streaming or not). Embeddings come from `fake_embedding`;
+    a chat asking for a quiz gets a valid quiz, any other an answer of `answer_words` words.
+    `profile` latency is the time to the first token, `token_seconds` the time between tokens.
+    '''
+
+    def __init__(self, profile: FaultProfile, token_seconds: float=0.0, answer_words: int=80, dimensions: int=EMBEDDING_DIMENSIONS):
+        super().__init__(_OpenAIHandler, profile)
+        self.token_seconds = token_seconds
+        self.answer_words = answer_words
+        self.dimensions = dimensions
+        self._quiz_numbers = itertools.count(1)
+
+    def completion(self, messages: list[dict]) -> str:
+        prompt = ' '.join(str(message.get('content', '')) for message in messages)
+        if '"quiz"' in prompt:
+            n = next(self._quiz_numbers)
+            quiz = {'quiz': {'question': f'Which finding was reported in study {n}?',
+                             'choices': [f'a. Finding {n}', f'b. Finding {n + 1}', f'c. Finding {n + 2}'],
+                             'answer': f'a. Finding {n}'}}
+            return f'```json\n{json.dumps(quiz, indent=4)}\n```'
+        words = re.findall(r'[A-Za-z]{4,}', prompt)[-400:] or ['answer']
+        return ' '.join(random.choice(words) for _ in range(self.answer_words)) + '.'
+
+class _PineconeHandler(_JsonHandler):
+    def route(self, url, body: dict) -> None:
+        service: FakePinecone = self.server.service
+        if url.path == '/vectors/upsert':
+            self._send_json(200, {'upsertedCount': service.upsert(body['vectors'])})
+        elif url.path == '/query':
+            self._send_json(200, {'matches': service.query(body['vector'], body.get('topK', 10), body.get('filter'),
+                                                           body.get('includeMetadata', False), body.get('includeValues', False)),
+                                  'namespace': body.get('namespace', '')})
+        elif url.path == '/vectors/fetch':
+            self._send_json(200, {'vectors': service.fetch(parse_qs(url.query).get('ids', [])), 'namespace': ''})
+        elif url.path == '/vectors/delete':
+            service.delete(body.get('ids', []), body.get('deleteAll', False))
+            self._send_json(200, {})
+        elif url.path == '/describe_index_stats':
+            count = service.vector_count()
+            self._send_json(200, {'namespaces': {'': {'vectorCount': count}} if count else {},
+                                  'dimension': service.dimensions, 'indexFullness': 0.0, 'totalVectorCount': count})
+        else:
+            self._send_json(404, {'message': f'unknown path {url.path}'})
+
+class FakePinecone(_FakeHttpService):
+    '''In-memory pinecone index data plane: upsert, query (exact cosine, metadata filters), fetch, delete, stats.'''
+
+    def __init__(self, profile: FaultProfile, dimensions: int=EMBEDDING_DIMENSIONS):
+        super().__init__(_PineconeHandler, profile)
+        self.dimensions = dimensions
+        self._vectors: dict[str, tuple[list[float], dict]] = {}
+        self._matrix: tuple[list[str], np.ndarray]|None = None # rebuilt after writes
+        self._lock = threading.Lock()
+
+    def vector_count(self) -> int:
+        return len(self._vectors)
+
+    def upsert(self, vectors: list[dict]) -> int:
+        with self._lock:
+            for vector in vectors:
+                self._vectors[vector['id']] = (vector['values'], vector.get('metadata') or {})
+            self._matrix = None
+        return len(vectors)
+
+    def delete(self, ids: list[str], delete_all: bool) -> None:
+        with self._lock:
+            if delete_all:
+                self._vectors.clear()
+            for id in ids:
+                self._vectors.pop(id, None)
+            self._matrix = None
+
+    def fetch(self, ids: list[str]) -> dict[str, dict]:
+        with self._lock:
+            return {id: {'id': id, 'values': self._vectors[id][0], 'metadata': self._vectors[id][1]}
+                    for id in ids if id in self._vectors}
+
+    def query(self, vector: list[float], top_k: int, filter: dict|None, include_metadata: bool, include_values: bool) -> list[dict]:
+        with self._lock:
+            if self._matrix is None:
+                ids = list(self._vectors)
+                matrix = np.array([self._vectors[id][0] for id in ids], dtype=np.float32).reshape(len(ids), -1)
+                matrix /= np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+                self._matrix = (ids, matrix)
+            ids, matrix = self._matrix
+            vectors = self._vectors
+
+        if not ids:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        scores = matrix @ (query / (np.linalg.norm(query) or 1.0))
+        matches = []
+        for row in np.argsort(-scores):
+            values, metadata = vectors[ids[row]]
+            if filter and not _matches_filter(metadata, filter):
+                continue
+            match = {'id': ids[row], 'score': float(scores[row])}
+            if include_metadata:
+                match['metadata'] = metadata
+            if include_values:
+                match['values'] = values
+            matches.append(match)
+            if len(matches) == top_k:
+                break
+        return matches
+
+# filters and updates shared by the fake pinecone and mongo
+
+def _matches_filter(document: dict, filter: dict) -> bool:
+    for name, condition in filter.items():
+        if name == '$and':
+            if not all(_matches_filter(document, sub_filter) for sub_filter in condition):
+                return False
+            continue
+        if name == '$or':
+            if not any(_matches_filter(document, sub_filter) for sub_filter in condition):
+                return False
+            continue
+        value = _get_path(document, name)
+        conditions = condition if isinstance(condition, dict) and any(key.startswith('$') for key in condition) else {'$eq': condition}
+        for operator, operand in conditions.items():
+            if not _OPERATORS[operator](value, operand):
+                return False
+    return True
+
+_OPERATORS = {
+    '$eq': lambda value, operand: value == operand or (isinstance(value, list) and operand in value),
+    '$ne': lambda value, operand: value != operand and not (isinstance(value, list) and operand in value),
+    '$in': lambda value, operand: value in operand,
+    '$nin': lambda value, operand: value not in operand,
+    '$gt': lambda value, operand: value is not None and value > operand,
+    '$gte': lambda value, operand: value is not None and value >= operand,
+    '$lt': lambda value, operand: value is not None and value < operand,
+    '$lte': lambda value, operand: value is not None and value <= operand,
+    '$exists': lambda value, operand: (value is not None) == operand,
+}
+
+def _get_path(document: dict, path: str):
+    for i, key in enumerate(path.split('.')):
+        if isinstance(document, list): # e.g. `quizzes.attempt_id`: the values of the array's documents
+            return [_get_path(item, '.'.join(path.split('.')[i:])) for item in document]
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+def _set_path(document: dict, path: str, value) -> None:
+    *parents, key = path.split('.')
+    for parent in parents:
+        document = document.setdefault(parent, {})
+    document[key] = value
+
+# mongo
+
+OP_REPLY = 1
+OP_QUERY = 2004
+OP_MSG = 2013
+_MONITORING_COMMANDS = {'hello', 'ismaster', 'ping', 'buildinfo', 'endsessions'}
+
+class _MongoHandler(socketserver.BaseRequestHandler):
+    '''Speaks enough of the wire protocol (OP_QUERY handshake, then OP_MSG) for pymongo's sync and async clients.'''
+
+    def handle(self) -> None:
+        service: FakeMongo = self.server.service
+        while True:
+            header = self._read(16)
+            if not header:
+                return
+            length, request_id, _, op_code = struct.unpack('<iiii', header)
+            payload = self._read(length - 16)
+
+            if op_code == OP_QUERY:
+                namespace_end = payload.index(b'\0', 4)
+                document_start = namespace_end + 1 + 8 # skip numberToSkip, numberToReturn
+                document_length, = struct.unpack('<i', payload[document_start:document_start + 4])
+                command = bson.decode(payload[document_start:document_start + document_length])
+                reply = struct.pack('<iqii', 0, 0, 0, 1) + bson.encode(service.run_command(command))
+                self._send(request_id, OP_REPLY, reply)
+
+            elif op_code == OP_MSG:
+                flags, = struct.unpack('<I', payload[:4])
+                command = self._decode_sections(payload[4:len(payload) - (4 if flags & 1 else 0)]) # checksum present
+                response = service.run_command(command)
+                if not flags & 2: # moreToCome: unacknowledged, no reply
+                    self._send(request_id, OP_MSG, struct.pack('<I', 0) + b'\0' + bson.encode(response))
+
+            else:
+                return
+
+    @staticmethod
+    def _decode_sections(data: bytes) -> dict:
+        body: dict = {}
+        sequences: dict[str, list[dict]] = {}
+        position = 0
+        while position < len(data):
+            kind = data[position]
+            size, = struct.unpack('<i', data[position + 1:position + 5])
+            if kind == 0:
+                body = bson.decode(data[position + 1:position + 1 + size])
+            else:
+                identifier_end = data.index(b'\0', position + 5)
+                identifier = data[position + 5:identifier_end].decode('utf-8')
+                sequences[identifier] = bson.decode_all(data[identifier_end + 1:position + 1 + size])
+            position += 1 + size
+        body.update(sequences)
+        return body
+
+    def _read(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return b''
+            data += chunk
+        return data
+
+    def _send(self, response_to: int, op_code: int, data: bytes) -> None:
+        service: FakeMongo = self.server.service
+        self.request.sendall(struct.pack('<iiii', 16 + len(data), next(service.request_ids), response_to, op_code) + data)
+
+class FakeMongo:
+    '''
+    In-memory standalone mongod for the commands the app uses: hello, createIndexes, find, insert, update
+    (operators $set, $setOnInsert, $unset, $inc and $push with $each/$slice, plus upserts), delete, count and
+    a few aggregation stages ($match, $project, $unwind, $group with $sum, $sort, $skip, $limit).
+    `profile` applies to every command except handshake and monitoring.
+    '''
+
+    def __init__(self, profile: FaultProfile):
+        self.profile = profile
+        self.requests = 0
+        self.failures = 0
+        self.request_ids = itertools.count(1)
+        self._collections: dict[str, list[dict]] = {}
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _MongoHandler)
+        self._server.daemon_threads = True
+        self._server.service = self
+
+    @property
+    def url(self) -> str:
+        return f'mongodb://127.0.0.1:{self._server.server_address[1]}/?directConnection=true'
+
+    def start(self) -> 'FakeMongo':
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def run_command(self, command: dict) -> dict:
+        name = next(iter(command))
+        handler = getattr(self, f'_{name.lower()}', None)
+        if name.lower() not in _MONITORING_COMMANDS:
+            self.requests += 1
+            self.profile.delay()
+            if self.profile.fails():
+                self.failures += 1
+                return {'ok': 0.0, 'errmsg': 'injected failure', 'code': 50, 'codeName': 'MaxTimeMSExpired'}
+        if handler is None:
+            return {'ok': 0.0, 'errmsg': f'no such command: {name}', 'code': 59, 'codeName': 'CommandNotFound'}
+        try:
+            with self._lock:
+                return handler(command)
+        except Exception as e:
+            return {'ok': 0.0, 'errmsg': str(e), 'code': 2, 'codeName': 'BadValue'}
+
+    def _collection(self, command: dict, name: str) -> list[dict]:
+        return self._collections.setdefault(f'{command.get("$db")}.{command[name]}', [])
+
+    def _hello(self, command: dict) -> dict:
+        return {'ismaster': True, 'isWritablePrimary': True, 'helloOk': True, 'maxWireVersion': 17, 'minWireVersion': 0,
+                'maxBsonObjectSize': 16 * 1024 * 1024, 'maxMessageSizeBytes': 48_000_000, 'maxWriteBatchSize': 100_000,
+                'localTime': datetime.now(timezone.utc), 'logicalSessionTimeoutMinutes': 30, 'connectionId': 1, 'ok': 1.0}
+
+    _ismaster = _hello
+
+    def _ping(self, command: dict) -> dict:
+        return {'ok': 1.0}
+
+    def _buildinfo(self, command: dict) -> dict:
+        return {'version': '6.0.0', 'versionArray': [6, 0, 0, 0], 'ok': 1.0}
+
+    def _endsessions(self, command: dict) -> dict:
+        return {'ok': 1.0}
+
+    def _killcursors(self, command: dict) -> dict:
+        return {'cursorsKilled': command.get('cursors', []), 'ok': 1.0}
+
+    def _createindexes(self, command: dict) -> dict:
+        return {'numIndexesBefore': 1, 'numIndexesAfter': 1 + len(command.get('indexes', [])), 'ok': 1.0}
+
+    def _find(self, command: dict) -> dict:
+        documents = [document for document in self._collection(command, 'find') if _matches_filter(document, command.get('filter') or {})]
+        documents = _sort(documents, command.get('sort'))[command.get('skip', 0):]
+        if command.get('limit'):
+            documents = documents[:abs(command['limit'])]
+        documents = [_project(document, command.get('projection')) for document in documents]
+        return {'cursor': {'firstBatch': documents, 'id': 0, 'ns': f'{command.get("$db")}.{command["find"]}'}, 'ok': 1.0}
+
+    def _count(self, command: dict) -> dict:
+        return {'n': sum(_matches_filter(document, command.get('query') or {}) for document in self._collection(command, 'count')), 'ok': 1.0}
+
+    def _insert(self, command: dict) -> dict:
+        collection = self._collection(command, 'insert')
+        for document in command['documents']:
+            document.setdefault('_id', bson.ObjectId())
+            collection.append(copy.deepcopy(document))
+        return {'n': len(command['documents']), 'ok': 1.0}
+
+    def _update(self, command: dict) -> dict:
+        collection = self._collection(command, 'update')
+        matched = modified = 0
+        upserted = []
+        for i, update in enumerate(command['updates']):
+            documents = [document for document in collection if _matches_filter(document, update['q'])]
+            if not update.get('multi'):
+                documents = documents[:1]
+            if documents:
+                matched += len(documents)
+                for document in documents:
+                    before = copy.deepcopy(document)
+                    _apply_update(document, update['u'], inserting=False)
+                    modified += document != before
+            elif update.get('upsert'):
+                document = {key: value for key, value in update['q'].items() if not key.startswith('$') and not isinstance(value, dict)}
+                _apply_update(document, update['u'], inserting=True)
+                document.setdefault('_id', bson.ObjectId())
+                collection.append(document)
+                upserted.append({'index': i, '_id': document['_id']})
+        response = {'n': matched + len(upserted), 'nModified': modified, 'ok': 1.0}
+        if upserted:
+            response['upserted'] = upserted
+        return response
+
+    def _delete(self, command: dict) -> dict:
+        collection = self._collection(command, 'delete')
+        deleted = 0
+        for delete in command['deletes']:
+            documents = [document for document in collection if _matches_filter(document, delete['q'])]
+            if delete.get('limit'):
+                documents = documents[:1]
+            for document in documents:
+                collection.remove(document)
+            deleted += len(documents)
+        return {'n': deleted, 'ok': 1.0}
+
+    def _aggregate(self, command: dict) -> dict:
+        documents = [copy.deepcopy(document) for document in self._collection(command, 'aggregate')]
+        for stage in command['pipeline']:
+            (name, spec), = stage.items()
+            if name == '$match':
+                documents = [document for document in documents if _matches_filter(document, spec)]
+            elif name == '$project':
+                documents = [_project(document, spec) for document in documents]
+            elif name == '$unwind':
+                path = spec if isinstance(spec, str) else spec['path']
+                documents = [{**document, path[1:]: item} for document in documents for item in (_get_path(document, path[1:]) or [])]
+            elif name == '$group':
+                documents = _group(documents, spec)
+            elif name == '$sort':
+                documents = _sort(documents, spec)
+            elif name == '$skip':
+                documents = documents[spec:]
+            elif name == '$limit':
+                documents = documents[:spec]
+            else:
+                raise ValueError(f'unsupported aggregation stage {name}')
+        return {'cursor': {'firstBatch': documents, 'id': 0, 'ns': f'{command.get("$db")}.{command["aggregate"]}'}, 'ok': 1.0}
+
+def _apply_update(document: dict, update: dict, inserting: bool) -> None:
+    if not any(key.startswith('$') for key in update): # replacement
+        id = document.get('_id')
+        document.clear()
+        document.update(copy.deepcopy(update))
+        if id is not None:
+            document['_id'] = id
+        return
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if operator == '$set' or (operator == '$setOnInsert' and inserting):
+                _set_path(document, path, copy.deepcopy(value))
+            elif operator == '$unset':
+                parent = _get_path(document, path.rpartition('.')[0]) if '.' in path else document
+                if isinstance(parent, dict):
+                    parent.pop(path.rpartition('.')[2], None)
+            elif operator == '$inc':
+                _set_path(document, path, (_get_path(document, path) or 0) + value)
+            elif operator == '$push':
+                items = _get_path(document, path) or []
+                if isinstance(value, dict) and '$each' in value:
+                    items = items + copy.deepcopy(value['$each'])
+                    if '$slice' in value:
+                        items = items[value['$slice']:] if value['$slice'] < 0 else items[:value['$slice']]
+                else:
+                    items = items + [copy.deepcopy(value)]
+                _set_path(document, path, items)
+            elif operator != '$setOnInsert':
+                raise ValueError(f'unsupported update operator {operator}')
+
+def _project(document: dict, projection: dict|None) -> dict:
+    if not projection:
+        return document
+    include = {key for key, value in projection.items() if value and key != '_id'}
+    if include:
+        projected = {key: _project_value(document, value, key) for key, value in projection.items() if value and key != '_id'}
+        if projection.get('_id', 1) and '_id' in document:
+            projected['_id'] = document['_id']
+        return projected
+    return {key: value for key, value in document.items() if projection.get(key, 1)}
+
+def _project_value(document: dict, spec, key: str):
+    if spec is True or spec == 1:
+        return _get_path(document, key)
+    return _evaluate(document, spec)
+
+def _evaluate(document: dict, expression):
+    '''The aggregation expressions the app uses: field paths, objects and a few operators.'''
+    if isinstance(expression, str) and expression.startswith('$'):
+        return _get_path(document, expression[1:])
+    if isinstance(expression, list):
+        return [_evaluate(document, item) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) != 1 or not next(iter(expression)).startswith('$'):
+        return {key: _evaluate(document, value) for key, value in expression.items()}
+    (operator, operand), = expression.items()
+    if operator == '$size':
+        return len(_evaluate(document, operand) or [])
+    if operator == '$slice':
+        items, *args = _evaluate(document, operand)
+        items = items or []
+        if len(args) == 1:
+            return items[args[0]:] if args[0] < 0 else items[:args[0]]
+        position, n = args
+        position = max(len(items) + position, 0) if position < 0 else position
+        return items[position:position + n]
+    if operator == '$ifNull':
+        value, replacement = operand
+        value = _evaluate(document, value)
+        return _evaluate(document, replacement) if value is None else value
+    if operator == '$cond':
+        condition, then, otherwise = operand
+        return _evaluate(document, then) if _evaluate(document, condition) else _evaluate(document, otherwise)
+    if operator == '$multiply':
+        result = 1
+        for value in _evaluate(document, operand):
+            result *= value
+        return result
+    if operator == '$toDate':
+        return datetime.fromtimestamp(_evaluate(document, operand) / 1000, tz=timezone.utc)
+    if operator == '$dateToString':
+        return _evaluate(document, operand['date']).strftime(operand['format'])
+    raise ValueError(f'unsupported expression operator {operator}')
+
+def _group(documents: list[dict], spec: dict) -> list[dict]:
+    groups: dict = {}
+    for document in documents:
+        key = _evaluate(document, spec['_id'])
+        group = groups.setdefault(json.dumps(key, default=str, sort_keys=True), {'_id': key})
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            (operator, operand), = accumulator.items()
+            if operator != '$sum':
+                raise ValueError(f'unsupported accumulator {operator}')
+            increment = _evaluate(document, operand) or 0
+            group[field] = group.get(field, 0) + (int(increment) if isinstance(increment, bool) else increment)
+    return list(groups.values())
+
+def _sort(documents: list[dict], spec: dict|None) -> list[dict]:
+    for key, direction in reversed(list((spec or {}).items())):
+        documents = sorted(documents, key=lambda document: (_get_path(document, key) is None, _get_path(document, key)), reverse=direction < 0)
+    return documents
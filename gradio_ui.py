@@ -1,15 +1,23 @@
+import asyncio
 import gradio as gr
-import json
-import re
+import os
+import threading
 import time
 
-from typing import Generator
+from typing import AsyncGenerator
 
-from pinecone_rag import ask_question, get_quiz
-from progress_report import create_progress_report
-from user_stats_service import get_user_stats, persist_user_stats
+from app_logging import get_logger
+from catalog import load_catalog
+from disease_index import DiseaseIndex
+from metrics import register_collector, start_metrics_server
+from pinecone_rag import aget_quiz, astream_question, get_quiz, warm_up
+from progress_report import REPORT_PAGE_SIZE, create_progress_report, report_file_path
+from quiz_pool import QuizPool, quiz_constraint
+from user_stats_service import aget_report_data, aget_stats_version, get_stats_writer, queue_quiz_attempt
 from utils import format_timestamp, get_ip_address
 
+logger = get_logger(__name__)
+
 APP_NAME = 'Researchio'
 TITLE = f'{APP_NAME} Bot'
 
@@ -18,70 +26,36 @@ CHATBOX_HEIGHT_REDUCED_DUE_TO_QUIZ = '32vh'
 
 MIN_YEAR = 2021
 ALL_TITLES_INDICATOR = '[All]'
-UTF_8_ENCODING = 'UTF-8'
 
 CORRECT_ANSWER_SOUND = 'assets/audio/mixkit-correct-answer-reward-952.wav'
 
-# load titles
-
-def _extract_titles() -> list[str]:
-    file_path = 'db/articles.jsonl'
-
-    def generate_unique_titles() -> Generator[str, None, None]:
-        '''
-        Generates unique, cleaned titles from the articles JSONL file, yielding one title at a time.
-
-        Yields:
-            Unique, cleaned titles, one at a time (str).
+CONCURRENCY_LIMIT = int(os.getenv('GRADIO_CONCURRENCY_LIMIT', '64')) # concurrent requests per event, handlers are async
 
-            Receives:
-                None. The generator does not accept sent values.
+# load titles and diseases, precomputed by build_title_db.py
 
-            Returns:
-                None. The generator does not return a specific value upon completion.
-        '''
-        seen_titles = set()
-        with open(file_path, 'r', encoding=UTF_8_ENCODING) as f:
-            for line in f:
-                data = json.loads(line)
-                original_title = data['title']
-                cleaned_title = re.sub(r'^[^a-zA-Z]+', '', original_title).strip().replace('\n', ' ')
-
-                if cleaned_title not in seen_titles:
-                    seen_titles.add(cleaned_title)
-                    yield cleaned_title
-
-    titles = list(generate_unique_titles())
-    titles.insert(0, ALL_TITLES_INDICATOR)
-    titles.sort(key=str.lower)
-    return titles
-
-titles = _extract_titles()
+titles, diseases = load_catalog()
+titles.insert(0, ALL_TITLES_INDICATOR)
 num_titles = len(titles)-1
+diseases = [''] + diseases
 
-# load diseases
-
-def _load_diseases() -> list[str]:
-    file_path = 'db/diseases.txt' # should be comma separated list
+# disease index, loaded in the background at startup (it is large), or by the first lookup
 
-    with open(file_path, 'r', encoding=UTF_8_ENCODING) as f:
-        diseases: str = f.read()
-    diseases = diseases.replace('\n', ',')
-    diseases: list[str] = diseases.split(',')
-    diseases = [d.strip().replace('diseases', 'disease').replace('disorders', 'disorder') for d in diseases if d.strip()]
-    diseases.sort()
+_disease_index: DiseaseIndex|None = None
+_disease_index_loaded = False
+_disease_index_lock = threading.Lock()
 
-    unique_diseases: list[str] = ['']
-    seen = set()
-    for d in diseases:
-        d_lower = d.lower()
-        if d_lower not in seen:
-            unique_diseases.append(d)
-            seen.add(d_lower)
+def get_disease_index() -> DiseaseIndex|None:
+    '''None until build_title_db.py has been run.'''
+    global _disease_index, _disease_index_loaded
+    with _disease_index_lock:
+        if not _disease_index_loaded:
+            _disease_index = DiseaseIndex.load()
+            _disease_index_loaded = True
+        return _disease_index
 
-    return unique_diseases
-
-diseases = _load_diseases()
+# ready quizzes per title, refilled in the background once the app starts
+quiz_pool = QuizPool(get_quiz)
+register_collector(lambda: [(f'researchio_quiz_pool_{name}', {}, value) for name, value in quiz_pool.stats().items()])
 
 bulletpt = '\u2022'
 nbsp = '\u00A0'
@@ -97,33 +71,50 @@ You can also ask about a specific article by choosing a <i>title</i> from the li
 '''.strip()
 
 # send_button click handler
-def submit_message(message: str, title: str, history: list[tuple[str, str]]) -> tuple[list[tuple[str, str]], str]:
+async def submit_message(message: str, title: str, history: list[tuple[str, str]]) -> AsyncGenerator[tuple[list[tuple[str, str]], str], None]:
     if message:
-        print(f'[title]: {title} [question]: {message}')
+        logger.info('[title]: %s [question]: %s', title, message)
 
         filter = {}
         if title and title != ALL_TITLES_INDICATOR:
             filter = {'title': title}
 
-        answer = ask_question(message, filter)
-        history.append((message, answer))
-    return history, '' # '' clears the input text box
+        history.append((message, ''))
+        yield history, '' # show the question right away; '' clears the input text box
+        async for answer in astream_question(message, filter):
+            history[-1] = (message, answer)
+            yield history, ''
+        return
+    yield history, ''
 
 # disease_dropdown change handler
-def lookup_disease(disease: str, history: list[tuple[str, str]]) -> list[tuple[str, str]]:
+async def lookup_disease(disease: str, history: list[tuple[str, str]]) -> AsyncGenerator[list[tuple[str, str]], None]:
     if disease:
-        print(f'[disease]: {disease}')
-
-        answer = ask_question(f'List all articles about {disease}. Only include articles which have a "src" field (URL). Articles should NOT be numbered.', max_docs=5)
-        history.append((f'Quick lookup: **{disease}**', answer))
-    return history
+        logger.info('[disease]: %s', disease)
+
+        message = f'Quick lookup: **{disease}**'
+        disease_index = await asyncio.to_thread(get_disease_index)
+        if disease_index:
+            history.append((message, disease_index.lookup(disease)))
+            yield history
+            return
+
+        history.append((message, ''))
+        yield history
+        async for answer in astream_question(f'List all articles about {disease}. Only include articles which have a "src" field (URL). Articles should NOT be numbered.', max_docs=5):
+            history[-1] = (message, answer)
+            yield history
+        return
+    yield history
 
 # retry_button click handler
-def retry_message(title: str, history: list[tuple[str, str]]) -> tuple[list[tuple[str, str]], str]:
+async def retry_message(title: str, history: list[tuple[str, str]]) -> AsyncGenerator[tuple[list[tuple[str, str]], str], None]:
     if history:
         last_message: str = history[-1][0]
-        return submit_message(last_message, title, history if len(history) > 1 else history)
-    return history, ''
+        async for update in submit_message(last_message, title, history if len(history) > 1 else history):
+            yield update
+        return
+    yield history, ''
 
 # undo_message click handler
 def undo_message(history: list[tuple[str, str]]) -> tuple[list[tuple[str, str]], str]:
@@ -136,20 +127,15 @@ def clear() -> tuple[dict, str, str, str, dict, dict, dict]:
     return gr.update(value=[(None, GREETING)], height=CHATBOX_HEIGHT_NORMAL), '', ALL_TITLES_INDICATOR, '', gr.update(visible=False, value=None), {}, gr.update(visible=False, value=None)
 
 # quiz_button click handler
-def show_quiz(title: str, history: list[tuple[str, str]], old_quiz: dict) -> tuple[dict, dict, str, dict, dict]:
+async def show_quiz(title: str, history: list[tuple[str, str]], old_quiz: dict) -> tuple[dict, dict, str, dict, dict]:
     if not title or title == ALL_TITLES_INDICATOR:
         history.append(('Quiz me!', 'Please select the **title** of an article to quiz on👇'))
         return gr.update(visible=False), {}, None, None, gr.update(value=history)
 
-    constraint = ''
-    if old_quiz and old_quiz['title'] == title:
-        constraint = f'''
-You previously asked the reader the following question so try not to ask it again:
-"{old_quiz['question']}"
--- But if you must ask it again since you have no other choice, then reword the question.
-        '''.strip()
-
-    new_quiz = get_quiz(title, constraint)
+    old_question = old_quiz['question'] if old_quiz and old_quiz['title'] == title else None
+    new_quiz = quiz_pool.pop(title, old_question)
+    if new_quiz is None: # pool is empty for this title, generate one now
+        new_quiz = await aget_quiz(title, quiz_constraint([old_question] if old_question else []))
     return (gr.update(visible=True),
             new_quiz,
             new_quiz['question'],
@@ -157,8 +143,13 @@ You previously asked the reader the following question so try not to ask it agai
             gr.update(height=CHATBOX_HEIGHT_REDUCED_DUE_TO_QUIZ)
     )
 
+# title_dropdown change handler
+def select_title(title: str) -> None:
+    if title and title != ALL_TITLES_INDICATOR:
+        quiz_pool.touch(title) # start preparing quizzes for it
+
 # check_button click handler
-def submit_answer(selected_choice: str, quiz: dict, request: gr.Request) -> tuple[dict, str|None]:
+async def submit_answer(selected_choice: str, quiz: dict, request: gr.Request) -> tuple[dict, str|None]:
     if not selected_choice:
         return None
 
@@ -185,16 +176,11 @@ def submit_answer(selected_choice: str, quiz: dict, request: gr.Request) -> tupl
     sound_to_play = CORRECT_ANSWER_SOUND if correct else None
 
     ip_address = get_ip_address(request)
-    stats = get_user_stats(ip_address)
-    if not stats:
-        stats = {'quizzes': []}
-
     time_seconds = time.time()
     formatted_time = format_timestamp(time_seconds)
 
-    stats['quizzes'].append({'article': quiz['title'], 'question': quiz['question'], 'answer': selected_choice, 'correct': correct, 'time_seconds': int(time_seconds), 'formatted_time': formatted_time})
-
-    persist_user_stats(ip_address, stats)
+    # queued and written behind in batches, so the answer feedback doesn't wait on the database
+    queue_quiz_attempt(ip_address, {'article': quiz['title'], 'question': quiz['question'], 'answer': selected_choice, 'correct': correct, 'time_seconds': int(time_seconds), 'formatted_time': formatted_time})
 
     return (gr.update(choices=marked_choices if marked else orig_choices,
                       value=marked_selection if marked else None),
@@ -202,13 +188,26 @@ def submit_answer(selected_choice: str, quiz: dict, request: gr.Request) -> tupl
     )
 
 # get_report_btn click handler
-def generate_report(request: gr.Request) -> dict:
+async def generate_report(page: float, request: gr.Request) -> dict:
     ip_address = get_ip_address(request)
-    stats = get_user_stats(ip_address)
-    if not stats:
-        stats = {'ip_address': ip_address, 'quizzes': []}
-    report_file_path = create_progress_report(stats)
-    return gr.update(value=report_file_path, visible=True)
+    page = int(page or 1)
+    if not await asyncio.to_thread(get_stats_writer().flush): # the store then has this user's latest attempts
+        logger.warning('Progress report for %s includes quiz attempts not yet flushed', ip_address) # see aget_report_data
+    try:
+        version = await aget_stats_version(ip_address)
+        if version is None:
+            report = {'ip_address': ip_address, 'quizzes': []}
+            outfile_path = None
+        else:
+            outfile_path = report_file_path(ip_address, version, page)
+            if os.path.exists(outfile_path): # nothing answered since it was rendered
+                return gr.update(value=outfile_path, visible=True)
+            report = await aget_report_data(ip_address, page, REPORT_PAGE_SIZE)
+    except Exception as e:
+        logger.error('Error retrieving report data: %s', e)
+        raise gr.Error('Error getting your progress report. Please try again.')
+    outfile_path = await asyncio.to_thread(create_progress_report, report, outfile_path) # rendering and file i/o are blocking
+    return gr.update(value=outfile_path, visible=True)
 
 # canned message button click handler
 def append_to_msg(msg: str, canned: str) -> str:
@@ -328,6 +327,7 @@ with gr.Blocks(title=TITLE, theme='ocean', css='''
                 quiz_button = gr.Button('Quiz Me! 🤔')
             with gr.Row():
                 get_report_btn = gr.Button('Get Progress Report')
+                report_page = gr.Number(label='Report page', value=1, minimum=1, precision=0)
 
     with gr.Row():
         report_file = gr.File(label='Progress Report - use link on right ➡️ to download', interactive=False, visible=False)
@@ -359,6 +359,8 @@ with gr.Blocks(title=TITLE, theme='ocean', css='''
     undo_button.click(undo_message, inputs=[chatbot], outputs=[chatbot, msg])
     clear_button.click(clear, outputs=[chatbot, msg, title_dropdown, disease_dropdown, quiz_row, quiz_state, report_file])
 
+    title_dropdown.change(select_title, inputs=title_dropdown, outputs=None)
+
     disease_dropdown.change(
         lookup_disease,
         inputs=[disease_dropdown, chatbot],
@@ -380,8 +382,21 @@ with gr.Blocks(title=TITLE, theme='ocean', css='''
 
     get_report_btn.click(
         fn=generate_report,
-        inputs=None,
+        inputs=report_page,
         outputs=report_file
     )
 
-demo.launch(server_name='0.0.0.0')
+def _warm_up() -> None:
+    get_disease_index()
+    warm_up()
+
+if __name__ == '__main__':
+    # load the disease index and build the RAG clients and chains while the UI starts, so the first user request doesn't pay for it
+    threading.Thread(target=_warm_up, daemon=True).start()
+    quiz_pool.start()
+    stats_writer = get_stats_writer() # replays attempts left unflushed by the last run
+    register_collector(lambda: [('researchio_stats_writer_pending', {}, stats_writer.stats()['pending'])])
+    start_metrics_server()
+
+    demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT)
+    demo.launch(server_name='0.0.0.0')
@@ -0,0 +1,70 @@
+import asyncio
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from app_logging import get_logger
+from lexical_index import LexicalIndex
+
+logger = get_logger(__name__)
+
+DEFAULT_K = 4 # same default as the langchain retrievers
+RRF_K = 60 # reciprocal rank fusion constant, the usual default
+CANDIDATES_PER_RESULT = int(os.getenv('HYBRID_CANDIDATES_PER_RESULT', '2')) # each side returns this many times k
+
+_lexical_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='lexical')
+
+def reciprocal_rank_fusion(rankings: list[list[Document]], k: int) -> list[Document]:
+    '''Top-k documents by summed 1 / (RRF_K + rank) over `rankings`; the same chunk from two rankings counts once.'''
+    scores: dict[tuple, float] = {}
+    documents: dict[tuple, Document] = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = (document.metadata.get('src'), document.page_content)
+            scores[key] = scores.get(key, 0.0) + 1 / (RRF_K + rank)
+            documents.setdefault(key, document)
+    return [documents[key] for key in sorted(scores, key=scores.get, reverse=True)[:k]]
+
+class HybridRetriever(BaseRetriever):
+    '''
+    Runs `vector_retriever` and a BM25 search of `lexical_index` side by side, each for a few times k candidates
+    under the same filter, and merges them with reciprocal rank fusion into the top k.
+    `search_kwargs` are the vector retriever's; `lexical_filter` defaults to its filter.
+    '''
+
+    vector_retriever: BaseRetriever
+    lexical_index: LexicalIndex
+    search_kwargs: dict = {}
+    lexical_filter: dict|None = None
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        lexical = _lexical_executor.submit(self._lexical_search, query) # a few ms, overlapped with the vector search
+        vector_documents = self._vector_retriever().invoke(query)
+        return reciprocal_rank_fusion([vector_documents, lexical.result()], self._k())
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> list[Document]:
+        vector_documents, lexical_documents = await asyncio.gather(
+            self._vector_retriever().ainvoke(query),
+            asyncio.get_running_loop().run_in_executor(_lexical_executor, self._lexical_search, query))
+        return reciprocal_rank_fusion([vector_documents, lexical_documents], self._k())
+
+    def _k(self) -> int:
+        return self.search_kwargs.get('k', DEFAULT_K)
+
+    def _vector_retriever(self) -> BaseRetriever:
+        return self.vector_retriever.model_copy(update={'search_kwargs': {**self.search_kwargs, 'k': self._k() * CANDIDATES_PER_RESULT}})
+
+    def _lexical_search(self, query: str) -> list[Document]:
+        filter = self.lexical_filter if self.lexical_filter is not None else self.search_kwargs.get('filter')
+        try:
+            return self.lexical_index.search(query, self._k() * CANDIDATES_PER_RESULT, filter)
+        except Exception as e:
+            logger.error('Error in lexical search: %s', e) # vector results alone are still an answer
+            return []
@@ -0,0 +1,19 @@
+import asyncio
+import os
+
+# max concurrent requests per upstream service on the async request path
+INFLIGHT_LIMITS = {
+    'embedding': int(os.getenv('MAX_INFLIGHT_EMBEDDING', '32')),
+    'vector': int(os.getenv('MAX_INFLIGHT_VECTOR', '32')),
+    'llm_primary': int(os.getenv('MAX_INFLIGHT_LLM_PRIMARY', '16')),
+    'llm_fallback': int(os.getenv('MAX_INFLIGHT_LLM_FALLBACK', '16')),
+    'mongo': int(os.getenv('MAX_INFLIGHT_MONGO', '32')),
+}
+
+_semaphores: dict[str, asyncio.Semaphore] = {}
+
+def inflight_limit(upstream: str) -> asyncio.Semaphore:
+    '''Semaphore bounding the in-flight requests to `upstream`, shared by the whole process.'''
+    if upstream not in _semaphores:
+        _semaphores[upstream] = asyncio.Semaphore(INFLIGHT_LIMITS[upstream])
+    return _semaphores[upstream]
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from dataclasses import dataclass
+
+DATA_FILE = 'data/research_pubs.jsonl' # articles to load
+MANIFEST_FILE = 'db/ingest_manifest.db'
+LOCAL_MANIFEST_FILE = 'db/ingest_manifest.local.db' # for the local vector store sink
+INDEX_VERSION_FILE = 'db/index_version' # rewritten whenever a load changes the index, so readers can drop cached answers
+
+def content_hash(title: str, published_at: str, contents: str) -> str:
+    payload = json.dumps([title, published_at, contents], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+@dataclass
+class ManifestEntry:
+    src: str
+    content_hash: str
+    chunk_count: int
+
+class IngestManifest:
+    '''
+    Local record of what has been written to the vector index, keyed by article `src`.
+
+    Lets the loader skip unchanged articles, delete the stale `src|i` vector ids of articles
+    which now have fewer chunks, and resume an interrupted load from the last committed line.
+    Safe to use from multiple threads.
+    '''
+
+    def __init__(self, path: str=MANIFEST_FILE):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS articles (src TEXT PRIMARY KEY, content_hash TEXT NOT NULL, chunk_count INTEGER NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._conn.commit()
+
+        # lines finish out of order in pipeline mode, so only advance the resume point over a contiguous run
+        self._next_line = 1
+        self._done_lines: set[int] = set()
+        self.changed = 0 # articles written to the index by this run
+
+    def get(self, src: str) -> ManifestEntry|None:
+        with self._lock:
+            row = self._conn.execute('SELECT src, content_hash, chunk_count FROM articles WHERE src = ?', (src,)).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def chunk_counts(self, srcs: list[str]) -> dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute(f'SELECT src, chunk_count FROM articles WHERE src IN ({",".join("?" * len(srcs))})', srcs).fetchall()
+        return dict(rows)
+
+    def resume_line(self) -> int:
+        '''First line not yet committed by an interrupted run, or 1 if the last run completed.'''
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'resume_line'").fetchone()
+        return int(row[0]) if row else 1
+
+    def begin(self, start_line: int) -> None:
+        with self._lock:
+            self._next_line = start_line
+            self._done_lines.clear()
+            self._set_resume_line(start_line)
+            self._conn.commit()
+
+    def commit(self, line: int, entry: ManifestEntry=None) -> None:
+        '''Record `line` as done, with the `entry` written to the index (`None` if nothing was written).'''
+        with self._lock:
+            if entry:
+                self.changed += 1
+                self._conn.execute('INSERT OR REPLACE INTO articles (src, content_hash, chunk_count) VALUES (?, ?, ?)',
+                                   (entry.src, entry.content_hash, entry.chunk_count))
+            self._done_lines.add(line)
+            while self._next_line in self._done_lines:
+                self._done_lines.remove(self._next_line)
+                self._next_line += 1
+            self._set_resume_line(self._next_line)
+            self._conn.commit()
+
+    def finish(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM meta WHERE key = 'resume_line'")
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _set_resume_line(self, line: int) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('resume_line', ?)", (str(line),))
+
+def record_index_change() -> None:
+    with open(INDEX_VERSION_FILE, 'w', encoding='utf-8') as f:
+        f.write(str(time.time()))
+
+def stale_vector_ids(src: str, old_chunk_count: int, new_chunk_count: int) -> list[str]:
+    return [f'{src}|{i}' for i in range(new_chunk_count + 1, old_chunk_count + 1)]
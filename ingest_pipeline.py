@@ -0,0 +1,226 @@
+import queue
+import threading
+import time
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+
+from unidecode import unidecode
+from unstructured.chunking.basic import chunk_elements
+from unstructured.partition.text import partition_text
+
+from app_logging import get_logger
+from metrics import observe
+
+logger = get_logger(__name__)
+
+MAX_CHUNK_CHARACTERS = 40_000 # avoid exceed max metadata size 40960 bytes per vector & max message size 4194304 bytes
+
+DEFAULT_EMBED_BATCH_SIZE = 256 # chunks per embedding request
+DEFAULT_EMBED_BATCH_CHARACTERS = 400_000 # ~100k tokens, well under the per-request token limit
+DEFAULT_QUEUE_SIZE = 64
+REPORT_INTERVAL_SECONDS = 10
+
+_QUEUE_POLL_SECONDS = 0.5
+_END = object() # end of stream sentinel
+
+def chunk_text(text: str) -> list:
+    elements = partition_text(text=unidecode(text))
+    return chunk_elements(elements, max_characters=MAX_CHUNK_CHARACTERS)
+
+@dataclass
+class Article:
+    line: int
+    title: str
+    src: str
+    published_at: str
+    text: str
+    content_hash: str = ''
+    chunks: list = field(default_factory=list)
+    chunk_seconds: float = 0.0
+
+def _chunk_article(article: Article) -> Article:
+    # runs in a worker process: ship the chunks back, not the (large) raw text
+    started = time.perf_counter()
+    article.chunks = chunk_text(article.text)
+    article.chunk_seconds = time.perf_counter() - started
+    article.text = ''
+    return article
+
+class PipelineStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.docs = 0
+        self.vectors = 0
+        self._last_report = self.start_time
+
+    def add(self, docs: int, vectors: int) -> None:
+        with self._lock:
+            self.docs += docs
+            self.vectors += vectors
+            now = time.monotonic()
+            if now - self._last_report >= REPORT_INTERVAL_SECONDS:
+                self._last_report = now
+                logger.info(self.summary())
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        return (f'{self.docs:,} docs, {self.vectors:,} vectors in {elapsed:.1f}s '
+                f'({self.docs / elapsed:.2f} docs/sec, {self.vectors / elapsed:.2f} vectors/sec)')
+
+class IngestPipeline:
+    '''
+    Three-stage ingestion pipeline connected by bounded queues:
+
+        chunk (process pool) -> embed (batched across articles) -> upsert (thread pool)
+
+    `embed_fn` receives a list of chunks and must set `chunk.embeddings` on each of them,
+    `upsert_fn` receives one article with embedded chunks (possibly none).
+    The first error raised by any stage stops the pipeline and is re-raised by `run`.
+    '''
+
+    def __init__(self,
+                 embed_fn: Callable[[list], None],
+                 upsert_fn: Callable[[Article], None],
+                 chunk_workers: int=None,
+                 embed_workers: int=1,
+                 upsert_workers: int=4,
+                 embed_batch_size: int=DEFAULT_EMBED_BATCH_SIZE,
+                 embed_batch_characters: int=DEFAULT_EMBED_BATCH_CHARACTERS,
+                 queue_size: int=DEFAULT_QUEUE_SIZE):
+        self.embed_fn = embed_fn
+        self.upsert_fn = upsert_fn
+        self.chunk_workers = chunk_workers
+        self.embed_workers = embed_workers
+        self.upsert_workers = upsert_workers
+        self.embed_batch_size = embed_batch_size
+        self.embed_batch_characters = embed_batch_characters
+        self.queue_size = queue_size
+
+        self.stats = PipelineStats()
+        self._chunked: queue.Queue[Future|object] = queue.Queue(maxsize=queue_size)
+        self._embedded: queue.Queue[Article|object] = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._error: BaseException = None
+
+    def run(self, articles: Iterable[Article]) -> PipelineStats:
+        embedders = self._start_threads(self._embed_worker, self.embed_workers, 'embed')
+        upserters = self._start_threads(self._upsert_worker, self.upsert_workers, 'upsert')
+
+        with ProcessPoolExecutor(max_workers=self.chunk_workers) as executor:
+            try:
+                for article in articles:
+                    if self._stop.is_set():
+                        break
+                    # the bounded queue of pending futures also bounds the work in the process pool
+                    if not self._put(self._chunked, executor.submit(_chunk_article, article)):
+                        break
+            except BaseException as e:
+                self._fail(e)
+            finally:
+                for _ in embedders:
+                    self._put(self._chunked, _END, force=True)
+                for thread in embedders:
+                    thread.join()
+                for _ in upserters:
+                    self._put(self._embedded, _END, force=True)
+                for thread in upserters:
+                    thread.join()
+                if self._stop.is_set():
+                    executor.shutdown(cancel_futures=True)
+
+        logger.info('Pipeline done: %s', self.stats.summary())
+        if self._error:
+            raise self._error
+        return self.stats
+
+    def _start_threads(self, target, count: int, name: str) -> list[threading.Thread]:
+        threads = [threading.Thread(target=target, name=f'{name}-{i}', daemon=True) for i in range(max(count, 1))]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _fail(self, e: BaseException) -> None:
+        logger.error('Error in ingest pipeline: %s', e)
+        if self._error is None:
+            self._error = e
+        self._stop.set()
+
+    def _put(self, q: queue.Queue, item, force: bool=False) -> bool:
+        # keep polling so a stopped pipeline can't deadlock on a full queue;
+        # `force` is for end sentinels, which must always get through (consumers keep draining after a stop)
+        while True:
+            if self._stop.is_set() and not force:
+                return False
+            try:
+                q.put(item, timeout=_QUEUE_POLL_SECONDS)
+                return True
+            except queue.Full:
+                pass
+
+    def _embed_worker(self) -> None:
+        batch: list[Article] = []
+        batch_chunks = 0
+        batch_characters = 0
+
+        def flush():
+            nonlocal batch, batch_chunks, batch_characters
+            if batch and not self._stop.is_set():
+                chunks = [chunk for article in batch for chunk in article.chunks]
+                self.embed_fn(chunks)
+                for article in batch:
+                    if not self._put(self._embedded, article):
+                        break
+            batch, batch_chunks, batch_characters = [], 0, 0
+
+        ended = False
+        try:
+            while True:
+                item = self._chunked.get()
+                if item is _END:
+                    ended = True
+                    flush()
+                    return
+                if self._stop.is_set():
+                    continue # drain until the end sentinel
+
+                article: Article = item.result()
+                observe('loader_chunk', article.chunk_seconds) # timed in the worker process
+                if not article.chunks:
+                    logger.warning('No chunks extracted for src=%s', article.src)
+                    self._put(self._embedded, article) # nothing to embed, but the upsert stage still sees it
+                    continue
+
+                article_characters = sum(len(chunk.text) for chunk in article.chunks)
+                if batch and (batch_chunks + len(article.chunks) > self.embed_batch_size
+                              or batch_characters + article_characters > self.embed_batch_characters):
+                    flush()
+
+                batch.append(article)
+                batch_chunks += len(article.chunks)
+                batch_characters += article_characters
+
+        except BaseException as e:
+            self._fail(e)
+            while not ended and self._chunked.get() is not _END: # let the reader finish
+                pass
+
+    def _upsert_worker(self) -> None:
+        try:
+            while True:
+                item = self._embedded.get()
+                if item is _END:
+                    return
+                if self._stop.is_set():
+                    continue
+
+                article: Article = item
+                self.upsert_fn(article)
+                self.stats.add(docs=1, vectors=len(article.chunks))
+
+        except BaseException as e:
+            self._fail(e)
+            while self._embedded.get() is not _END:
+                pass
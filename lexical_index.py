@@ -0,0 +1,90 @@
+import sqlite3
+import threading
+
+from langchain_core.documents import Document
+
+from context_assembly import query_terms
+from metrics import span
+
+LEXICAL_INDEX_FILE = 'db/lexical_index.db'
+FILTER_FIELDS = ('title', 'src', 'published_at')
+
+class LexicalIndex:
+    '''
+    BM25 full-text index over chunk text (SQLite FTS5), keyed by vector id, so exact terms like gene names,
+    drug codes and trial acronyms are found even when embeddings miss them. Written by the loader next to
+    the vector index. Hyphens are part of tokens, so "covid-19" is one term. Safe to use from multiple threads.
+    '''
+
+    def __init__(self, path: str=LEXICAL_INDEX_FILE):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS chunks (rowid INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL,
+                                               title TEXT, src TEXT, published_at TEXT, text TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS chunks_src ON chunks (src);
+            CREATE INDEX IF NOT EXISTS chunks_title ON chunks (title);
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(text, content='chunks', content_rowid='rowid',
+                                                                     tokenize="unicode61 tokenchars '-'");
+            CREATE TRIGGER IF NOT EXISTS chunks_insert AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunks_fts (rowid, text) VALUES (new.rowid, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS chunks_delete AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+            END;
+        ''')
+        self._conn.commit()
+
+    def put_many(self, vectors: list[dict]) -> None:
+        '''Indexes the text of pinecone-style vector dicts (`id` and `metadata` with title, src, published_at and text).'''
+        rows = [(vector['id'], *(vector['metadata'].get(field) for field in FILTER_FIELDS), vector['metadata']['text'])
+                for vector in vectors]
+        with self._lock:
+            self._conn.executemany('DELETE FROM chunks WHERE id = ?', [(row[0],) for row in rows])
+            self._conn.executemany('INSERT INTO chunks (id, title, src, published_at, text) VALUES (?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+
+    def delete(self, ids: list[str]) -> None:
+        with self._lock:
+            self._conn.executemany('DELETE FROM chunks WHERE id = ?', [(id,) for id in ids])
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM chunks')
+            self._conn.commit()
+
+    def search(self, query: str, k: int, filter: dict=None) -> list[Document]:
+        '''Top-k chunks by BM25 for any of the query's terms, best first, among chunks matching `filter`.'''
+        terms = query_terms(query)
+        if not terms:
+            return []
+        match = ' OR '.join('"{}"'.format(term.replace('"', '""')) for term in sorted(terms))
+        where, params = self._where(filter or {})
+        sql = f'''SELECT c.title, c.src, c.published_at, c.text FROM chunks_fts JOIN chunks c ON c.rowid = chunks_fts.rowid
+                  WHERE chunks_fts MATCH ?{where} ORDER BY bm25(chunks_fts) LIMIT ?'''
+        with span('lexical_search'), self._lock:
+            rows = self._conn.execute(sql, (match, *params, k)).fetchall()
+        return [Document(page_content=text, metadata={'title': title, 'src': src, 'published_at': published_at})
+                for title, src, published_at, text in rows]
+
+    @staticmethod
+    def _where(filter: dict) -> tuple[str, list]:
+        # supports the pinecone filters the app uses: {'field': value}, {'field': {'$eq': value}} and {'field': {'$in': [...]}}
+        clauses, params = [], []
+        for name, condition in filter.items():
+            if name not in FILTER_FIELDS:
+                raise ValueError(f'Unsupported filter field: {name}')
+            if isinstance(condition, dict):
+                values = condition['$in'] if '$in' in condition else [condition['$eq']]
+            else:
+                values = [condition]
+            clauses.append(f' AND c.{name} IN ({",".join("?" * len(values))})')
+            params.extend(values)
+        return ''.join(clauses), params
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,369 @@
+import bisect
+import json
+import os
+import shutil
+import threading
+
+from typing import Callable
+
+import numpy as np
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from app_logging import get_logger
+from metrics import span
+
+logger = get_logger(__name__)
+
+LOCAL_VECTOR_STORE_DIR = 'db/vector_store'
+METADATA_FIELDS = ('title', 'src', 'published_at')
+DEFAULT_K = 4 # same default as the langchain retrievers
+FLUSH_BYTES = 64 * 2**20 # of pending vectors and text: a flush (and the commit of those articles) this often, so an interrupted load resumes
+MERGE_BLOCK_ROWS = 4096 # rows copied at a time when merging segments
+
+_MANIFEST_FILE = 'segments.json'
+_EMBEDDINGS_FILE = 'embeddings.npy'
+_SCALES_FILE = 'scales.npy' # per-row scales, int8 quantized segments only
+_TEXTS_FILE = 'texts.bin'
+_TEXT_OFFSETS_FILE = 'text_offsets.npy'
+_METADATA_FILE = 'metadata.json'
+
+class _Segment:
+    '''
+    One immutable part of a store, written by a flush or a merge: unit-normalized float32 (or int8 + per-row scale)
+    embeddings in a memory-mapped matrix, with columnar metadata and memory-mapped chunk text.
+    Rows deleted since (replaced or stale vectors) are masked out of searches.
+    '''
+
+    def __init__(self, directory: str, deleted: list[str]=()):
+        self.directory = directory
+        self.embeddings: np.ndarray = np.load(os.path.join(directory, _EMBEDDINGS_FILE), mmap_mode='r')
+        scales_path = os.path.join(directory, _SCALES_FILE)
+        self.scales: np.ndarray|None = np.load(scales_path) if os.path.exists(scales_path) else None
+        texts_path = os.path.join(directory, _TEXTS_FILE)
+        self._texts = np.memmap(texts_path, dtype=np.uint8, mode='r') if os.path.getsize(texts_path) else np.zeros(0, dtype=np.uint8) # can't mmap an empty file
+        self._text_offsets: np.ndarray = np.load(os.path.join(directory, _TEXT_OFFSETS_FILE))
+
+        with open(os.path.join(directory, _METADATA_FILE), 'r', encoding='utf-8') as f:
+            columns: dict[str, list] = json.load(f)
+        self.ids: list[str] = columns.pop('id')
+        self.columns: dict[str, np.ndarray] = {name: np.array(values, dtype=object) for name, values in columns.items()}
+        deleted = set(deleted)
+        self.live = np.array([id not in deleted for id in self.ids], dtype=bool) if deleted else np.ones(len(self.ids), dtype=bool)
+        self.live_count = int(self.live.sum())
+
+        self._value_rows: dict[str, dict[str, np.ndarray]] = {} # column -> value -> row numbers, built on first filter
+        self._lock = threading.Lock()
+
+    def text(self, row: int) -> str:
+        start, end = self._text_offsets[row], self._text_offsets[row + 1]
+        return bytes(self._texts[start:end]).decode('utf-8')
+
+    def metadata(self, row: int) -> dict[str, str]:
+        return {name: column[row] for name, column in self.columns.items()}
+
+    def unit_embeddings(self, rows: np.ndarray) -> np.ndarray:
+        '''The float32 embeddings of `rows`, dequantized.'''
+        embeddings = np.asarray(self.embeddings[rows], dtype=np.float32)
+        return embeddings if self.scales is None else embeddings * self.scales[rows][:, None]
+
+    def search(self, query: np.ndarray, k: int, filter: dict=None) -> list[tuple[int, float]]:
+        rows = self._filter_rows(filter) if filter else None
+        if rows is not None:
+            rows = rows[self.live[rows]]
+        candidates = self.live_count if rows is None else len(rows)
+        if candidates == 0:
+            return []
+
+        matrix = self.embeddings if rows is None else self.embeddings[rows]
+        scores = matrix @ query if self.scales is None else (matrix.astype(np.float32) @ query) * (self.scales if rows is None else self.scales[rows])
+        if rows is None and self.live_count < len(self.ids):
+            scores[~self.live] = -np.inf
+
+        k = min(k, candidates)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(top_row if rows is None else rows[top_row]), float(scores[top_row])) for top_row in top]
+
+    def _filter_rows(self, filter: dict) -> np.ndarray:
+        # supports the pinecone filters the app uses: {'field': value}, {'field': {'$eq': value}} and {'field': {'$in': [...]}}
+        rows = None
+        for name, condition in filter.items():
+            if isinstance(condition, dict):
+                values = condition['$in'] if '$in' in condition else [condition['$eq']]
+            else:
+                values = [condition]
+
+            value_rows = self._rows_by_value(name)
+            matched = [value_rows[value] for value in values if value in value_rows]
+            matched = np.unique(np.concatenate(matched)) if matched else np.zeros(0, dtype=np.int64)
+            rows = matched if rows is None else np.intersect1d(rows, matched)
+        return rows
+
+    def _rows_by_value(self, name: str) -> dict[str, np.ndarray]:
+        with self._lock:
+            if name not in self._value_rows:
+                grouped: dict[str, list[int]] = {}
+                for row, value in enumerate(self.columns[name]):
+                    grouped.setdefault(value, []).append(row)
+                self._value_rows[name] = {value: np.array(rows, dtype=np.int64) for value, rows in grouped.items()}
+            return self._value_rows[name]
+
+class LocalVectorStore:
+    '''
+    Read-only, in-process vector store: the segments listed in the store's manifest, each searched in turn
+    and the results merged. Rows are numbered across segments. Built by `LocalVectorStoreWriter`.
+    '''
+
+    def __init__(self, directory: str=LOCAL_VECTOR_STORE_DIR):
+        self.directory = directory
+        with open(os.path.join(directory, _MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            manifest: dict = json.load(f)
+        self.segments = [_Segment(os.path.join(directory, segment['name']), segment['deleted']) for segment in manifest['segments']]
+        self._starts = [0]
+        for segment in self.segments:
+            self._starts.append(self._starts[-1] + len(segment.ids))
+        logger.info('Loaded local vector store: %s vectors in %d segments from %s', f'{len(self):,}', len(self.segments), directory)
+
+    def __len__(self) -> int:
+        return sum(segment.live_count for segment in self.segments)
+
+    def text(self, row: int) -> str:
+        segment, segment_row = self._locate(row)
+        return segment.text(segment_row)
+
+    def metadata(self, row: int) -> dict[str, str]:
+        segment, segment_row = self._locate(row)
+        return segment.metadata(segment_row)
+
+    def search(self, query_embedding: list[float], k: int=DEFAULT_K, filter: dict=None) -> list[tuple[int, float]]:
+        '''Top-k (row, cosine similarity) pairs, best first, among rows matching `filter`.'''
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        results = []
+        for start, segment in zip(self._starts, self.segments):
+            results.extend((start + row, score) for row, score in segment.search(query, k, filter))
+        results.sort(key=lambda result: -result[1])
+        return results[:k]
+
+    def _locate(self, row: int) -> tuple[_Segment, int]:
+        i = bisect.bisect_right(self._starts, row) - 1
+        return self.segments[i], row - self._starts[i]
+
+class LocalVectorStoreWriter:
+    '''
+    Alternate loader sink which builds a `LocalVectorStore`. Takes the same vector dicts as a pinecone upsert.
+    Only the vectors added since the last flush are held in memory: a flush writes them as a new segment and
+    records replaced or deleted vectors as deletions from the older segments, so it costs the size of what changed.
+    The newest segment is merged into the one before once it is as large (so a row is copied O(log n) times).
+    Flushes once `flush_bytes` of vectors and text are pending; `on_done` callbacks are deferred until the flush,
+    since nothing is durable before. An article's chunks left over from a longer earlier version are dropped
+    when it is added, so they are never saved.
+    '''
+
+    def __init__(self, directory: str=LOCAL_VECTOR_STORE_DIR, quantize: bool=False, flush_bytes: int=FLUSH_BYTES):
+        self.directory = directory
+        self.quantize = quantize
+        self.flush_bytes = flush_bytes
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # one flush at a time, so callbacks run in order
+        self._pending: dict[str, tuple[np.ndarray, dict[str, str], str]] = {}
+        self._pending_bytes = 0
+        self._on_done: list[Callable[[], None]] = []
+        self._dirty = False
+        self.vectors = 0
+
+        self._segments: list[dict] = [] # manifest entries: name, rows, deleted ids
+        self._next_segment = 0
+        self._stored: dict[str, dict] = {} # id -> manifest entry of the segment it is stored in, for ids not deleted
+        manifest_path = os.path.join(directory, _MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest: dict = json.load(f)
+            self._segments = manifest['segments']
+            self._next_segment = manifest['next_segment']
+            for segment in self._segments:
+                deleted = set(segment['deleted'])
+                for id in _segment_ids(os.path.join(directory, segment['name'])):
+                    if id not in deleted:
+                        self._stored[id] = segment
+
+    def add(self, vectors: list[dict], on_done: Callable[[], None]=None) -> None:
+        with self._lock:
+            chunk_counts: dict[str, int] = {}
+            for vector in vectors:
+                metadata: dict = dict(vector['metadata'])
+                text = metadata.pop('text', '')
+                embedding = np.asarray(vector['values'], dtype=np.float32)
+                embedding /= np.linalg.norm(embedding) or 1.0
+                self._remove(vector['id'])
+                self._pending[vector['id']] = (embedding, {name: metadata.get(name) for name in METADATA_FIELDS}, text)
+                self._pending_bytes += embedding.nbytes + len(text)
+                src, i = vector['id'].rsplit('|', 1)
+                chunk_counts[src] = max(chunk_counts.get(src, 0), int(i))
+            for src, chunk_count in chunk_counts.items():
+                self._drop_stale_chunks(src, chunk_count)
+            self.vectors += len(vectors)
+            self._dirty = True
+            if on_done:
+                self._on_done.append(on_done)
+            flush = self._pending_bytes >= self.flush_bytes
+        if flush:
+            self.flush()
+
+    def delete(self, ids: list[str]) -> None:
+        with self._lock:
+            deleted = sum(self._remove(id) for id in ids)
+        logger.info('Deleted %d stale vectors from local vector store', deleted)
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                self._save()
+                on_done, self._on_done = self._on_done, []
+            logger.info('Saved local vector store: %s vectors in %d segments to %s', f'{len(self._stored):,}', len(self._segments), self.directory)
+            for callback in on_done:
+                callback()
+            with self._lock:
+                if self._dirty: # a callback deleted vectors
+                    self._save()
+
+    def _remove(self, id: str) -> bool:
+        '''Called with the lock held: drops `id` from the pending vectors, or records its deletion from its segment.'''
+        if self._pending.pop(id, None) is not None:
+            return True
+        segment = self._stored.pop(id, None)
+        if segment is None:
+            return False
+        segment['deleted'].append(id)
+        self._dirty = True
+        return True
+
+    def _drop_stale_chunks(self, src: str, chunk_count: int) -> None:
+        '''Called with the lock held: chunk ids are `src|1..n`, so those of a longer earlier version follow on from `chunk_count`.'''
+        i = chunk_count + 1
+        while self._remove(f'{src}|{i}'):
+            i += 1
+
+    def _save(self) -> None:
+        '''Called with the lock held: writes the pending vectors as a segment, merges, then replaces the manifest.'''
+        self._dirty = False
+        os.makedirs(self.directory, exist_ok=True)
+        if self._pending:
+            ids = list(self._pending)
+            rows = [self._pending[id] for id in ids]
+            embeddings = np.stack([embedding for embedding, _, _ in rows])
+            segment = self._write_segment(len(ids), embeddings.shape[1],
+                                          [(ids, embeddings, [text for _, _, text in rows], [metadata for _, metadata, _ in rows])])
+            for id in ids:
+                self._stored[id] = segment
+            self._pending = {}
+            self._pending_bytes = 0
+        while len(self._segments) >= 2 and _live_rows(self._segments[-1]) >= _live_rows(self._segments[-2]):
+            self._merge_last_segments()
+
+        tmp_path = os.path.join(self.directory, f'{_MANIFEST_FILE}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'segments': self._segments, 'next_segment': self._next_segment}, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.directory, _MANIFEST_FILE)) # readers switch to the new segments at once
+        names = {segment['name'] for segment in self._segments}
+        for name in os.listdir(self.directory):
+            if name.startswith('segment-') and name not in names:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True) # merged, or left by an interrupted flush
+
+    def _merge_last_segments(self) -> None:
+        older, newer = (_Segment(os.path.join(self.directory, entry['name']), entry['deleted']) for entry in self._segments[-2:])
+        del self._segments[-2:]
+        dimensions = max(segment.embeddings.shape[1] if segment.embeddings.ndim == 2 else 0 for segment in (older, newer))
+
+        def blocks():
+            for segment in (older, newer):
+                live_rows = np.flatnonzero(segment.live)
+                for i in range(0, len(live_rows), MERGE_BLOCK_ROWS):
+                    rows = live_rows[i:i + MERGE_BLOCK_ROWS]
+                    yield ([segment.ids[row] for row in rows], segment.unit_embeddings(rows),
+                           [segment.text(row) for row in rows], [segment.metadata(row) for row in rows])
+
+        merged = self._write_segment(older.live_count + newer.live_count, dimensions, blocks())
+        for id in _segment_ids(os.path.join(self.directory, merged['name'])):
+            self._stored[id] = merged
+
+    def _write_segment(self, rows: int, dimensions: int, blocks) -> dict:
+        '''
+        Called with the lock held: writes `rows` rows, from (ids, unit embeddings, texts, metadata) `blocks`,
+        as the next segment, appended to `_segments`. Streams block by block, so merges don't need the rows in memory.
+        '''
+        name = f'segment-{self._next_segment:06d}'
+        self._next_segment += 1
+        tmp_dir = os.path.join(self.directory, f'{name}.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        shape = (rows, dimensions) if rows else (0, 0)
+        embeddings = np.lib.format.open_memmap(os.path.join(tmp_dir, _EMBEDDINGS_FILE), mode='w+',
+                                               dtype=np.int8 if self.quantize else np.float32, shape=shape)
+        scales = np.ones(rows, dtype=np.float32) if self.quantize else None
+        offsets = [0]
+        columns = {'id': [], **{field: [] for field in METADATA_FIELDS}}
+        row = 0
+        with open(os.path.join(tmp_dir, _TEXTS_FILE), 'wb') as f:
+            for ids, block_embeddings, texts, metadata in blocks:
+                end = row + len(ids)
+                if self.quantize:
+                    block_scales = np.abs(block_embeddings).max(axis=1) / 127
+                    block_scales[block_scales == 0] = 1.0
+                    embeddings[row:end] = np.round(block_embeddings / block_scales[:, None]).astype(np.int8)
+                    scales[row:end] = block_scales
+                else:
+                    embeddings[row:end] = block_embeddings
+                for text in texts:
+                    offsets.append(offsets[-1] + f.write(text.encode('utf-8')))
+                columns['id'].extend(ids)
+                for field in METADATA_FIELDS:
+                    columns[field].extend(item[field] for item in metadata)
+                row = end
+        embeddings.flush()
+        del embeddings
+        if scales is not None:
+            np.save(os.path.join(tmp_dir, _SCALES_FILE), scales)
+        np.save(os.path.join(tmp_dir, _TEXT_OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+        with open(os.path.join(tmp_dir, _METADATA_FILE), 'w', encoding='utf-8') as f:
+            json.dump(columns, f, ensure_ascii=False)
+        os.replace(tmp_dir, os.path.join(self.directory, name))
+
+        segment = {'name': name, 'rows': rows, 'deleted': []}
+        self._segments.append(segment)
+        return segment
+
+def _segment_ids(directory: str) -> list[str]:
+    with open(os.path.join(directory, _METADATA_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f)['id']
+
+def _live_rows(segment: dict) -> int:
+    return segment['rows'] - len(segment['deleted'])
+
+class LocalVectorStoreRetriever(BaseRetriever):
+    '''Langchain retriever over a `LocalVectorStore`, returning the same documents as the pinecone vectorstore.'''
+
+    store: LocalVectorStore
+    embeddings: Embeddings
+    search_kwargs: dict = {}
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        return self._search(self.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> list[Document]:
+        return self._search(await self.embeddings.aembed_query(query)) # the search itself is in-process and fast
+
+    def _search(self, query_embedding: list[float]) -> list[Document]:
+        k = self.search_kwargs.get('k', DEFAULT_K)
+        filter = self.search_kwargs.get('filter')
+        with span('vector_query'):
+            results = self.store.search(query_embedding, k, filter)
+        return [Document(page_content=self.store.text(row), metadata=self.store.metadata(row)) for row, _ in results]
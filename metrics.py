@@ -0,0 +1,153 @@
+import bisect
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Generator
+
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464')) # 0 to disable the endpoint; not 9100, node_exporter's port
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0') # 127.0.0.1 to only serve local scrapers
+# upper bounds (seconds) of the stage latency buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+Labels = tuple[tuple[str, str], ...]
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(labels: Labels, extra: tuple[tuple[str, str], ...]=()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float=1, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter',
+                *(f'{self.name}{_format_labels(labels)} {value}' for labels, value in sorted(values.items()))]
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series: dict[Labels, list[float]] = {} # bucket counts, then +Inf count, then sum
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            all_series = {labels: list(series) for labels, series in self._series.items()}
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(all_series.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), series[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(labels, (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {series[-1]}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+    def totals(self) -> dict[str, dict[str, float]]:
+        '''Count and mean per series, keyed by its labels, e.g. `stage=llm,model=primary`.'''
+        with self._lock:
+            all_series = {labels: list(series) for labels, series in self._series.items()}
+        totals = {}
+        for labels, series in sorted(all_series.items()):
+            count = sum(series[:-1])
+            totals[','.join(f'{name}={value}' for name, value in labels)] = {'count': count, 'mean_seconds': series[-1] / count}
+        return totals
+
+stage_seconds = Histogram('researchio_stage_seconds', 'Time spent per request or loader stage.')
+stage_errors = Counter('researchio_stage_errors_total', 'Failed stage runs.')
+_metrics: list[Counter|Histogram] = [stage_seconds, stage_errors]
+_collectors: list[Callable[[], list[tuple[str, dict[str, str], float]]]] = []
+
+@contextmanager
+def span(stage: str, **labels: str) -> Generator[None, None, None]:
+    '''Times the block into `researchio_stage_seconds{stage=...}`, counting exceptions in `researchio_stage_errors_total`.'''
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage=stage, **labels)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage, **labels)
+
+def observe(stage: str, seconds: float, **labels: str) -> None:
+    '''For stages which don't fit a `with` block, like the time to the first streamed token.'''
+    stage_seconds.observe(seconds, stage=stage, **labels)
+
+def register_collector(collect: Callable[[], list[tuple[str, dict[str, str], float]]]) -> None:
+    '''`collect` is called on each scrape and returns (gauge name, labels, value) samples, e.g. cache sizes.'''
+    _collectors.append(collect)
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            samples = collect()
+        except Exception as e:
+            logger.warning('Error collecting metrics: %s', e)
+            continue
+        for name, labels, value in samples:
+            lines.append(f'{name}{_format_labels(_labels(labels))} {float(value)}')
+    return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        data = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+def start_metrics_server(port: int=METRICS_PORT, host: str=METRICS_HOST) -> None:
+    '''Serves `/metrics` in Prometheus text format from a background thread; a port already in use only logs a warning.'''
+    if not port:
+        return
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e: # e.g. another app process on this host has the port
+        logger.warning('Not serving metrics on %s:%d: %s', host, port, e)
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on %s:%d', host, port)
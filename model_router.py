@@ -0,0 +1,321 @@
+import asyncio
+import bisect
+import os
+import threading
+import time
+
+from collections import deque
+from typing import AsyncGenerator, AsyncIterator, Callable, Generator, Iterator
+
+from app_logging import get_logger
+from metrics import observe, stage_errors
+
+logger = get_logger(__name__)
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+LATENCY_WINDOW = 200 # recent samples used for percentiles
+MIN_SAMPLES_FOR_P95 = 20
+
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_DELAY_SECONDS = 0.5
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5')) # consecutive failures
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv('CIRCUIT_COOLDOWN_SECONDS', '30'))
+
+class LatencyHistogram:
+    '''Bucketed latency counts plus a window of recent samples for percentiles. Thread-safe.'''
+
+    def __init__(self, buckets: tuple[float, ...]=LATENCY_BUCKETS, window: int=LATENCY_WINDOW):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.total = 0.0
+        self.count = 0
+        self._recent: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.total += seconds
+            self.count += 1
+            self._recent.append(seconds)
+
+    def percentile(self, p: float) -> float|None:
+        with self._lock:
+            if not self._recent:
+                return None
+            samples = sorted(self._recent)
+        return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+    def samples(self) -> int:
+        with self._lock:
+            return len(self._recent)
+
+class CircuitBreaker:
+    '''
+    Opens after `failure_threshold` consecutive failures, so the model gets no traffic for `cooldown_seconds`;
+    then lets a single probe request through (half-open): its failure reopens the breaker, its success closes it.
+    A probe which never reports back (e.g. a cancelled hedge) is replaced by another after a further cooldown.
+    '''
+
+    def __init__(self, failure_threshold: int=CIRCUIT_FAILURE_THRESHOLD, cooldown_seconds: float=CIRCUIT_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.failures = 0
+        self.opened_at: float|None = None
+        self._probe_started: float|None = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'open' if time.monotonic() - self.opened_at < self.cooldown_seconds else 'half_open'
+
+    def available(self) -> bool:
+        '''Whether `allow` would admit a request now, without claiming the probe.'''
+        with self._lock:
+            return self._admits(time.monotonic())
+
+    def allow(self) -> bool:
+        '''Whether a request may go to the model; while half-open, True only for the caller which becomes the probe.'''
+        with self._lock:
+            now = time.monotonic()
+            if not self._admits(now):
+                return False
+            if self.opened_at is not None:
+                self._probe_started = now
+            return True
+
+    def _admits(self, now: float) -> bool:
+        if self.opened_at is None:
+            return True
+        if now - self.opened_at < self.cooldown_seconds:
+            return False
+        return self._probe_started is None or now - self._probe_started >= self.cooldown_seconds # else a probe is in flight
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probe_started = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probe_started = None
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+class ModelStats:
+    def __init__(self, latency_budget_seconds: float):
+        self.latency_budget_seconds = latency_budget_seconds
+        self.first_token_latency = LatencyHistogram()
+        self.total_latency = LatencyHistogram()
+        self.breaker = CircuitBreaker()
+        self.successes = 0
+        self.failures = 0
+        self.hedges = 0 # times this model was started as a hedge
+        self.hedge_wins = 0
+
+class ModelRouter:
+    '''
+    Routes a generation to an ordered list of models (primary first) and streams the answer so far.
+
+    On the async path, if the running model hasn't produced its first token by its hedge delay
+    (the p95 of its recent time-to-first-token, capped by its latency budget), the next model is started too;
+    the first to produce a token wins and the others are cancelled. Models whose circuit breaker is open
+    are skipped. If the winner fails mid-stream the remaining models start over.
+    The sync path has no hedging (it can't cancel a blocked call), only breakers and fallback.
+    '''
+
+    def __init__(self, latency_budgets: dict[str, float]):
+        self.models = list(latency_budgets)
+        self.stats = {model: ModelStats(budget) for model, budget in latency_budgets.items()}
+
+    def hedge_delay(self, model: str) -> float:
+        stats = self.stats[model]
+        delay = stats.latency_budget_seconds
+        if stats.first_token_latency.samples() >= MIN_SAMPLES_FOR_P95:
+            delay = min(delay, stats.first_token_latency.percentile(HEDGE_PERCENTILE))
+        return max(delay, HEDGE_MIN_DELAY_SECONDS)
+
+    def _candidates(self) -> tuple[list[str], bool]:
+        '''The models to try in order, and whether to force them past their breakers.'''
+        available = [model for model in self.models if self.stats[model].breaker.available()]
+        if available:
+            return available, False
+        return list(self.models), True # everything is failing: try anyway rather than refuse
+
+    def _next_model(self, candidates: list[str], forced: bool) -> str|None:
+        '''
+        Pops the first of `candidates` its breaker lets through, or None. Only called for a model about to start:
+        `allow` claims the single probe of a half-open breaker.
+        '''
+        while candidates:
+            model = candidates.pop(0)
+            if forced or self.stats[model].breaker.allow():
+                return model
+        return None
+
+    def stream(self, start: Callable[[str], Iterator[str]], on_success: Callable[[str], None]=None) -> Generator[str, None, None]:
+        '''`on_success`, if given, is called with the model which produced the whole answer.'''
+        last_error: Exception = None
+        candidates, forced = self._candidates()
+        while (model := self._next_model(candidates, forced)) is not None:
+            started = time.monotonic()
+            answer = ''
+            try:
+                for i, token in enumerate(start(model)):
+                    if i == 0:
+                        self._record_first_token(model, started)
+                    answer += token
+                    yield answer
+            except Exception as e:
+                self._record_failure(model, e)
+                last_error = e
+                continue
+            self._record_success(model, started)
+            if on_success:
+                on_success(model)
+            return
+        raise last_error or Exception('No model available')
+
+    async def astream(self, start: Callable[[str], AsyncIterator[str]], on_success: Callable[[str], None]=None) -> AsyncGenerator[str, None]:
+        '''Async `stream`, with hedging.'''
+        candidates, forced = self._candidates()
+        last_error: Exception = None
+
+        while candidates:
+            winner = await self._race_first_token(start, candidates, forced)
+            if winner is None: # none of the remaining candidates was let through
+                break
+            if isinstance(winner, Exception):
+                last_error = winner
+                break
+
+            model, iterator, first_token, started = winner
+            answer = first_token
+            try:
+                if first_token is not None:
+                    yield answer
+                    async for token in iterator:
+                        answer += token
+                        yield answer
+            except Exception as e:
+                self._record_failure(model, e)
+                last_error = e
+                continue # the remaining candidates start over
+            self._record_success(model, started)
+            if on_success:
+                on_success(model)
+            return
+
+        raise last_error or Exception('No model available')
+
+    async def _race_first_token(self, start: Callable[[str], AsyncIterator[str]], candidates: list[str], forced: bool):
+        '''
+        Runs `candidates` (consumed from the front) until one produces a first token, hedging as needed.
+        Returns (model, iterator, first token or None if empty, start time), the last error if all fail,
+        or None if none could be started.
+        '''
+        attempts: dict[asyncio.Task, tuple[str, AsyncIterator[str], float]] = {}
+        hedged: set[str] = set()
+        last_error: Exception = None
+        last_launch: tuple[str, float] = None
+
+        def launch(hedge: bool) -> bool:
+            nonlocal last_launch
+            model = self._next_model(candidates, forced)
+            if model is None:
+                return False
+            iterator = start(model).__aiter__()
+            last_launch = (model, time.monotonic())
+            attempts[asyncio.ensure_future(iterator.__anext__())] = (model, iterator, last_launch[1])
+            if hedge:
+                hedged.add(model)
+                self.stats[model].hedges += 1
+                logger.info('Hedging with model %s ...', model)
+            return True
+
+        if not launch(hedge=False):
+            return None
+        try:
+            while attempts:
+                timeout = None
+                if candidates: # hedge when the latest model is slower than usual
+                    model, launched = last_launch
+                    timeout = max(self.hedge_delay(model) - (time.monotonic() - launched), 0)
+                done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch(hedge=True)
+                    continue
+
+                for task in done:
+                    model, iterator, started = attempts.pop(task)
+                    try:
+                        first_token = task.result()
+                    except StopAsyncIteration:
+                        first_token = None
+                    except Exception as e:
+                        self._record_failure(model, e)
+                        last_error = e
+                        if not attempts and candidates:
+                            launch(hedge=False)
+                        continue
+
+                    self._record_first_token(model, started)
+                    if model in hedged:
+                        self.stats[model].hedge_wins += 1
+                    return model, iterator, first_token, started
+
+            return last_error or Exception('No model available')
+
+        finally:
+            await self._cancel(attempts)
+
+    @staticmethod
+    async def _cancel(attempts: dict[asyncio.Task, tuple[str, AsyncIterator[str], float]]) -> None:
+        for task in attempts:
+            task.cancel()
+        await asyncio.gather(*attempts, return_exceptions=True)
+        for _, iterator, _ in attempts.values():
+            try:
+                await iterator.aclose()
+            except Exception:
+                pass
+
+    def _record_first_token(self, model: str, started: float) -> None:
+        seconds = time.monotonic() - started
+        self.stats[model].first_token_latency.record(seconds)
+        observe('llm_first_token', seconds, model=model)
+
+    def _record_success(self, model: str, started: float) -> None:
+        stats = self.stats[model]
+        seconds = time.monotonic() - started
+        stats.total_latency.record(seconds)
+        observe('llm', seconds, model=model)
+        stats.successes += 1
+        stats.breaker.record_success()
+
+    def _record_failure(self, model: str, e: Exception) -> None:
+        logger.warning('Error from model %s: %s', model, e)
+        stage_errors.inc(stage='llm', model=model)
+        stats = self.stats[model]
+        stats.failures += 1
+        stats.breaker.record_failure()
+        if stats.breaker.state != 'closed':
+            logger.warning('Circuit open for model %s', model)
+
+    def summary(self) -> dict[str, dict]:
+        return {model: {'state': stats.breaker.state,
+                        'successes': stats.successes,
+                        'failures': stats.failures,
+                        'hedges': stats.hedges,
+                        'hedge_wins': stats.hedge_wins,
+                        'hedge_delay_seconds': self.hedge_delay(model),
+                        'p95_first_token_seconds': stats.first_token_latency.percentile(95),
+                        'p95_total_seconds': stats.total_latency.percentile(95)}
+                for model, stats in self.stats.items()}
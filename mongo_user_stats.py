@@ -0,0 +1,169 @@
+import asyncio
+import os
+import threading
+
+from typing import Generator
+
+from pymongo import AsyncMongoClient, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.collection import Collection
+
+from app_logging import get_logger
+from inflight import inflight_limit
+from user_stats_store import MOST_MISSED_QUESTIONS, QUIZ_HISTORY_LIMIT, PartialWriteError, UserStatsStore, report_page, stats_version
+
+logger = get_logger(__name__)
+
+MONGODB_ATLAS_CLUSTER_URI=os.getenv('MONGODB_ATLAS_CLUSTER_URI')
+DB_NAME=os.getenv('DB_NAME')
+COLLECTION_NAME=os.getenv('COLLECTION_NAME')
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '50')) # connections per client
+
+_VERSION_PROJECTION = {'_id': 0, 'ip_address': 1, 'quiz_attempts': 1, 'quiz_count': {'$size': {'$ifNull': ['$quizzes', []]}}}
+
+def quiz_attempt_update(attempt: dict) -> dict:
+    '''
+    Appends `attempt` to the user's `quizzes` (capped to the last QUIZ_HISTORY_LIMIT) and bumps the
+    `quiz_attempts` / `correct_answers` counters, all in one atomic update whatever the history length.
+    '''
+    push = {'$each': [attempt]}
+    if QUIZ_HISTORY_LIMIT > 0:
+        push['$slice'] = -QUIZ_HISTORY_LIMIT
+    return {'$push': {'quizzes': push},
+            '$inc': {'quiz_attempts': 1, 'correct_answers': 1 if attempt.get('correct') else 0}}
+
+class MongoUserStatsStore(UserStatsStore):
+    '''
+    One document per user in MongoDB (Atlas), with the quiz attempts in an array.
+    One pooled client per process for each of the sync and async paths: connections (and TLS sessions) are reused.
+    '''
+
+    name = 'mongo'
+
+    def __init__(self, uri: str=MONGODB_ATLAS_CLUSTER_URI, db_name: str=DB_NAME, collection_name: str=COLLECTION_NAME):
+        self.uri = uri
+        self.db_name = db_name
+        self.collection_name = collection_name
+        self._client = MongoClient(uri, maxPoolSize=MONGO_MAX_POOL_SIZE) # connects on first use
+        self._async_client: AsyncMongoClient = None
+        self._index_lock = threading.Lock()
+        self._index_created = False
+
+    def _collection(self) -> Collection:
+        collection = self._client[self.db_name].get_collection(self.collection_name) # creates if not exist
+        if not self._index_created:
+            with self._index_lock:
+                if not self._index_created:
+                    collection.create_index('ip_address', unique=True) # idempotent
+                    self._index_created = True
+        return collection
+
+    def _async_collection(self) -> AsyncCollection:
+        if self._async_client is None:
+            self._async_client = AsyncMongoClient(self.uri, maxPoolSize=MONGO_MAX_POOL_SIZE)
+        return self._async_client[self.db_name].get_collection(self.collection_name)
+
+    def record_attempts(self, attempts: list[tuple[str, dict]]) -> None:
+        updates = _attempt_updates(attempts)
+        try:
+            result = self._collection().bulk_write(updates) # ordered, so a user's attempts stay in order
+        except BulkWriteError as e:
+            raise _partial_write_error(e, len(updates) - len(attempts)) from e
+        logger.debug('%s - %s', self.collection_name, result.bulk_api_result)
+
+    def persist(self, ip_address: str, user_stats: dict) -> bool:
+        result = self._collection().update_one(
+                    {'ip_address': ip_address},
+                    {'$set': user_stats},
+                    upsert = True)
+        logger.debug('%s - %s', self.collection_name, result)
+        return result.modified_count == 1 or result.upserted_id is not None
+
+    def get(self, ip_address: str) -> dict|None:
+        return _without_id(self._collection().find_one({'ip_address': ip_address}))
+
+    def stats_version(self, ip_address: str) -> str|None:
+        documents = list(self._collection().aggregate([{'$match': {'ip_address': ip_address}}, {'$project': _VERSION_PROJECTION}]))
+        return stats_version(documents[0].get('quiz_attempts', 0), documents[0]['quiz_count']) if documents else None
+
+    def iter_stats_versions(self, batch_size: int) -> Generator[tuple[str, str], None, None]:
+        with self._collection().aggregate([{'$project': _VERSION_PROJECTION}], batchSize=batch_size) as cursor:
+            for document in cursor:
+                yield document['ip_address'], stats_version(document.get('quiz_attempts', 0), document['quiz_count'])
+
+    def iter_user_stats(self, ip_addresses: list[str], batch_size: int) -> Generator[dict, None, None]:
+        with self._collection().find({'ip_address': {'$in': ip_addresses}}, {'_id': 0}, batch_size=batch_size) as cursor:
+            for document in cursor:
+                document['version'] = stats_version(document.get('quiz_attempts', 0), len(document.get('quizzes', [])))
+                yield document
+
+    async def astats_version(self, ip_address: str) -> str|None:
+        documents = await self._aaggregate([{'$match': {'ip_address': ip_address}}, {'$project': _VERSION_PROJECTION}])
+        return stats_version(documents[0].get('quiz_attempts', 0), documents[0]['quiz_count']) if documents else None
+
+    async def areport_data(self, ip_address: str, page: int, page_size: int) -> dict:
+        # only the summaries and one page leave the database, whatever the history length
+        match = {'$match': {'ip_address': ip_address}}
+        unwind = {'$unwind': '$quizzes'}
+        correct = {'$cond': ['$quizzes.correct', 1, 0]}
+        day = {'$dateToString': {'format': '%Y-%m-%d', 'date': {'$toDate': {'$multiply': ['$quizzes.time_seconds', 1000]}}}}
+        pipelines = [
+            [match, unwind, {'$group': {'_id': '$quizzes.article', 'attempts': {'$sum': 1}, 'correct': {'$sum': correct}}},
+             {'$sort': {'attempts': -1, '_id': 1}}],
+            [match, unwind, {'$group': {'_id': day, 'attempts': {'$sum': 1}, 'correct': {'$sum': correct}}},
+             {'$sort': {'_id': 1}}],
+            [match, unwind, {'$group': {'_id': {'article': '$quizzes.article', 'question': '$quizzes.question'},
+                                        'attempts': {'$sum': 1}, 'missed': {'$sum': {'$cond': ['$quizzes.correct', 0, 1]}}}},
+             {'$match': {'missed': {'$gt': 0}}}, {'$sort': {'missed': -1, 'attempts': -1}}, {'$limit': MOST_MISSED_QUESTIONS}],
+        ]
+        articles, days, most_missed = await asyncio.gather(*(self._aaggregate(pipeline) for pipeline in pipelines))
+
+        total = sum(article['attempts'] for article in articles)
+        page, pages = report_page(total, page, page_size)
+        # attempts are stored oldest first: page 1 is the last `page_size` of them
+        end = total - (page - 1) * page_size
+        start = max(end - page_size, 0)
+        quizzes = []
+        if end > 0:
+            documents = await self._aaggregate([match, {'$project': {'_id': 0, 'quizzes': {'$slice': ['$quizzes', start, end - start]}}}])
+            quizzes = list(reversed(documents[0]['quizzes'])) if documents else []
+
+        return {'ip_address': ip_address,
+                'total': total,
+                'correct': sum(article['correct'] for article in articles),
+                'articles': [{'article': article['_id'], 'attempts': article['attempts'], 'correct': article['correct']} for article in articles],
+                'days': [{'day': day['_id'], 'attempts': day['attempts'], 'correct': day['correct']} for day in days],
+                'most_missed': [{**question['_id'], 'attempts': question['attempts'], 'missed': question['missed']} for question in most_missed],
+                'quizzes': quizzes,
+                'page': page,
+                'pages': pages}
+
+    async def _aaggregate(self, pipeline: list[dict]) -> list[dict]:
+        async with inflight_limit('mongo'):
+            return await (await self._async_collection().aggregate(pipeline)).to_list()
+
+def _attempt_updates(attempts: list[tuple[str, dict]]) -> list[UpdateOne]:
+    '''
+    Creates the missing users first, then one update per attempt, guarded on its `attempt_id` so a replayed
+    attempt is a no-op (an upsert couldn't be guarded: it would insert a second document for the user).
+    '''
+    ip_addresses = dict.fromkeys(ip_address for ip_address, _ in attempts)
+    updates = [UpdateOne({'ip_address': ip_address}, {'$setOnInsert': {'quiz_attempts': 0, 'correct_answers': 0}}, upsert=True)
+               for ip_address in ip_addresses]
+    for ip_address, attempt in attempts:
+        filter = {'ip_address': ip_address}
+        if attempt.get('attempt_id'):
+            filter['quizzes.attempt_id'] = {'$ne': attempt['attempt_id']}
+        updates.append(UpdateOne(filter, quiz_attempt_update(attempt)))
+    return updates
+
+def _partial_write_error(e: BulkWriteError, user_updates: int) -> PartialWriteError:
+    # an ordered bulk write stops at its first error: the updates before it were applied
+    write_errors = e.details.get('writeErrors') or [{'index': 0}]
+    return PartialWriteError(max(write_errors[0]['index'] - user_updates, 0), str(e))
+
+def _without_id(user_stats: dict|None) -> dict|None:
+    if user_stats: # may be `None`
+        del user_stats['_id'] # caller doesn't care about this, uses `ip_address`
+    return user_stats
@@ -1,39 +1,120 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import argparse
+import concurrent.futures
+import functools
 import os
 import json
 import threading
 
+from typing import Callable, Generator
+
 from pinecone import Pinecone
-from unidecode import unidecode
-from unstructured.chunking.basic import chunk_elements
-from unstructured.embed.openai import OpenAIEmbeddingConfig, OpenAIEmbeddingEncoder
-from unstructured.partition.text import partition_text
 
-DATA_FILE = 'data/research_pubs.jsonl'
+from app_logging import get_logger
+from chunk_store import ChunkStore
+from embedding_cache import EmbeddingCache
+from ingest_manifest import (DATA_FILE, LOCAL_MANIFEST_FILE, MANIFEST_FILE, IngestManifest, ManifestEntry, content_hash,
+                             record_index_change, stale_vector_ids)
+from ingest_pipeline import (DEFAULT_EMBED_BATCH_CHARACTERS, DEFAULT_EMBED_BATCH_SIZE, DEFAULT_QUEUE_SIZE,
+                             Article, IngestPipeline, chunk_text)
+from lexical_index import LexicalIndex
+from local_vector_store import LocalVectorStoreWriter
+from metrics import span, start_metrics_server
+from upsert_batcher import UpsertBatcher, call_with_backoff
+
+logger = get_logger(__name__)
+
 UTF_8_ENCODING = 'utf-8'
 MIN_YEAR = 2021
 
-embedding_encoder = OpenAIEmbeddingEncoder(config=
-    OpenAIEmbeddingConfig(api_key=os.getenv('OPENAI_EMBEDDING_API_KEY'), model_name=os.getenv('OPENAI_EMBEDDING_MODEL')))
+embedding_encoder = None # created on first use, see `_get_embedding_encoder`
+embedding_cache: EmbeddingCache|None = None # opened by `__main__` unless --no-embedding-cache
+lexical_index: LexicalIndex|None = None # opened by `__main__` unless --no-lexical-index
+
+class PineconeSink:
+    '''
+    Loader sink which upserts to the pinecone index, packing vectors from many articles into each request.
+    With a `chunk_store`, chunk text is written there instead of to the vector metadata.
+    '''
+
+    def __init__(self, chunk_store: ChunkStore=None):
+        self.chunk_store = chunk_store
+        pc = Pinecone()
+        self.index = pc.Index(host=os.getenv('PINECONE_HOST'))
+        index_stats_response = self.index.describe_index_stats()
+        logger.info('index stats: %s', index_stats_response)
+        self.upsert_batcher = UpsertBatcher(send_fn=self._upsert)
+
+    def add(self, vectors: list[dict], on_done: Callable[[], None]=None) -> None:
+        if self.chunk_store:
+            self.chunk_store.put_many([(vector['id'], vector['metadata']['text']) for vector in vectors])
+            vectors = [{**vector, 'metadata': {key: value for key, value in vector['metadata'].items() if key != 'text'}} for vector in vectors]
+        self.upsert_batcher.add(vectors, on_done) # sent once a full request has been packed, or on flush
+
+    def _upsert(self, vectors: list[dict]):
+        with span('loader_upsert'):
+            return self.index.upsert(vectors=vectors)
 
-pc = Pinecone()
-index = pc.Index(host=os.getenv('PINECONE_HOST'))
-index_stats_response = index.describe_index_stats()
-print(f'index stats: {index_stats_response}')
+    def delete(self, ids: list[str]) -> None:
+        rsp = call_with_backoff(self.index.delete, ids=ids)
+        logger.info('Deleted %d stale vectors: %s', len(ids), rsp)
+        if self.chunk_store:
+            self.chunk_store.delete(ids)
 
-def load_to_vector_store(title: str, src: str, published_at: str, text: str) -> None:
-    elements = partition_text(text=unidecode(text))
-    chunks = chunk_elements(elements, max_characters=40_000) # avoid exceed max metadata size 40960 bytes per vector & max message size 4194304 bytes
+    def flush(self) -> None:
+        self.upsert_batcher.flush()
+        logger.info('Upserted %s vectors in %s requests', f'{self.upsert_batcher.vectors:,}', f'{self.upsert_batcher.requests:,}')
 
-    if not _invoke_embedding_in_thread(chunks):
-        print('Retry embedding...')
-        _invoke_embedding_in_thread(chunks, abort=True)
+def _get_embedding_encoder():
+    global embedding_encoder
+    if embedding_encoder is None:
+        from unstructured.embed.openai import OpenAIEmbeddingConfig, OpenAIEmbeddingEncoder
+        embedding_encoder = OpenAIEmbeddingEncoder(config=
+            OpenAIEmbeddingConfig(api_key=os.getenv('OPENAI_EMBEDDING_API_KEY'), model_name=os.getenv('OPENAI_EMBEDDING_MODEL')))
+    return embedding_encoder
+
+vector_sink: PineconeSink|LocalVectorStoreWriter = None # created on first use, see `_get_vector_sink`
+
+def _get_vector_sink() -> PineconeSink|LocalVectorStoreWriter:
+    global vector_sink
+    if vector_sink is None:
+        vector_sink = PineconeSink()
+    return vector_sink
+
+def load_to_vector_store(title: str, src: str, published_at: str, text: str) -> int:
+    with span('loader_chunk'):
+        chunks = chunk_text(text)
+    _embed_chunks(chunks)
 
     total_embeddings = sum(len(chunk.embeddings) for chunk in chunks)
-    print(f'Extracted {len(chunks)} chunks, {total_embeddings=} for {src=}')
-    _add_to_pinecone(title, src, published_at, chunks)
+    logger.info('Extracted %d chunks, total_embeddings=%d for src=%s', len(chunks), total_embeddings, src)
+    _add_to_vector_store(title, src, published_at, chunks)
+    _get_vector_sink().flush()
+    return len(chunks)
+
+def _embed_chunks(chunks: list) -> None:
+    with span('loader_embed'):
+        misses = chunks
+        if embedding_cache:
+            cached = embedding_cache.get_many([chunk.text for chunk in chunks])
+            misses = []
+            for chunk, embedding in zip(chunks, cached):
+                if embedding:
+                    chunk.embeddings = embedding
+                else:
+                    misses.append(chunk)
+
+        if not misses:
+            return
+
+        if not _invoke_embedding_in_thread(misses):
+            logger.warning('Retry embedding...')
+            _invoke_embedding_in_thread(misses, abort=True)
+
+        if embedding_cache:
+            embedding_cache.put_many([chunk.text for chunk in misses], [chunk.embeddings for chunk in misses])
 
 def _invoke_embedding_in_thread(chunks, abort=False, timeout=120) -> bool:
     success = False
@@ -41,11 +122,11 @@ def _invoke_embedding_in_thread(chunks, abort=False, timeout=120) -> bool:
     def target():
         nonlocal success
         try:
-            embedding_encoder.embed_documents(chunks)
+            _get_embedding_encoder().embed_documents(chunks)
             success = True
 
         except Exception as e:
-            print(f'Error embedding chunks: {e}')
+            logger.error('Error embedding chunks: %s', e)
 
     thread = threading.Thread(target=target, daemon=True)
     thread.start()
@@ -53,15 +134,21 @@ def _invoke_embedding_in_thread(chunks, abort=False, timeout=120) -> bool:
 
     if thread.is_alive():
         err = f'Error: embedding timed out after {timeout} seconds.'
-        print(err)
+        logger.error(err)
         # thread probably will be orphaned now
         if abort:
             raise Exception(err)
 
     return success
 
-def _add_to_pinecone(title: str, src: str, published_at: str, chunks: list) -> None:
-    vectors = [
+def _add_to_vector_store(title: str, src: str, published_at: str, chunks: list, on_done: Callable[[], None]=None) -> None:
+    vectors = _chunk_vectors(title, src, published_at, chunks)
+    if lexical_index:
+        lexical_index.put_many(vectors) # before the sink, so it is written by the time the manifest records the article
+    _get_vector_sink().add(vectors, on_done)
+
+def _chunk_vectors(title: str, src: str, published_at: str, chunks: list) -> list[dict]:
+    return [
         {
             'id': f'{src}|{i}',
             'values': chunk.embeddings,
@@ -74,47 +161,128 @@ def _add_to_pinecone(title: str, src: str, published_at: str, chunks: list) -> N
         } for i, chunk in enumerate(chunks, start=1)
     ]
 
-    try:
-        rsp = index.upsert(vectors=vectors)
-        print(f'index: {rsp}')
-
-    except Exception as e:
-        print(f'Error upserting vectors to index: {e}')
-
-        if 'exceeds the maximum supported size' in str(e): # request max size 2MB
-            print('Split vectors and retry...')
-            mid = len(vectors) // 2
-            rsp = index.upsert(vectors=vectors[:mid])
-            print(f'index: {rsp}')
-            rsp = index.upsert(vectors=vectors[mid:])
-            print(f'index: {rsp}')
-
-        elif 'exceeds the limit of 40960 bytes per vector' in str(e): # metadata max size 40960 bytes per vector
-            print('Upsert vectors one by one...')
-            for i, vector in enumerate(vectors):
-                try:
-                    rsp = index.upsert(vectors=[vector])
-                    print(f'index: {rsp}')
-                except Exception as e:
-                    print(f'Error upserting vector[{i}] of total {len(vectors)} to index: {e}')
-                    print(f"Error vector: {vector['id']=} {vector['metadata']=}")
-                    raise
-
-        else:
-            raise
+def _delete_from_vector_store(ids: list[str]) -> None:
+    if ids:
+        _get_vector_sink().delete(ids)
+        if lexical_index:
+            lexical_index.delete(ids)
 
-if __name__ == '__main__':
-    START_LINE = 1
+def _rebuild_lexical_index(chunk_workers: int) -> None:
+    '''Re-chunks every article into a fresh lexical index, without embedding or touching the vector index.'''
+    lexical_index.clear()
+    articles = list(_read_articles())
+    with concurrent.futures.ProcessPoolExecutor(max_workers=chunk_workers) as executor:
+        for article, chunks in zip(articles, executor.map(chunk_text, [article.text for article in articles], chunksize=8)):
+            lexical_index.put_many(_chunk_vectors(article.title, article.src, article.published_at, chunks))
+    logger.info('Rebuilt lexical index: %s articles', f'{len(articles):,}')
 
+def _read_articles(start_line: int=1) -> Generator[Article, None, None]:
     with open(DATA_FILE, 'r', encoding=UTF_8_ENCODING) as data_file:
         for i, line in enumerate(data_file, start=1):
-            if i < START_LINE:
+            if i < start_line:
                 continue
-            print(f'Processing line {i} ...')
 
             jsonl: dict = json.loads(line)
-            url: str = jsonl['url']
-            published_at: str = jsonl.get('published_at')
-            title: str = jsonl['title']
-            contents: str = jsonl['contents']
-            load_to_vector_store(title, url, published_at, contents)
+            yield Article(line=i,
+                          title=jsonl['title'],
+                          src=jsonl['url'],
+                          published_at=jsonl.get('published_at'),
+                          text=jsonl['contents'])
+
+def _changed_articles(articles: Generator[Article, None, None], manifest: IngestManifest, force: bool) -> Generator[Article, None, None]:
+    skipped = 0
+    for article in articles:
+        article.content_hash = content_hash(article.title, article.published_at, article.text)
+        entry = manifest.get(article.src)
+        if not force and entry and entry.content_hash == article.content_hash:
+            manifest.commit(article.line)
+            skipped += 1
+            continue
+        yield article
+    logger.info('Skipped %s unchanged articles', f'{skipped:,}')
+
+def _commit_article(article: Article, chunk_count: int, manifest: IngestManifest) -> None:
+    entry = manifest.get(article.src)
+    if entry and entry.chunk_count > chunk_count:
+        _delete_from_vector_store(stale_vector_ids(article.src, entry.chunk_count, chunk_count))
+    manifest.commit(article.line, ManifestEntry(article.src, article.content_hash, chunk_count))
+
+def _upsert_article(article: Article, manifest: IngestManifest) -> None:
+    # the manifest is only updated once the sink has actually written all of the article's vectors
+    on_done = functools.partial(_commit_article, article, len(article.chunks), manifest)
+    _add_to_vector_store(article.title, article.src, article.published_at, article.chunks, on_done)
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=f'Load {DATA_FILE} to the Pinecone index or the local vector store.')
+    parser.add_argument('--sink', choices=['pinecone', 'local'], default='pinecone', help='where to write the vectors (default: %(default)s)')
+    parser.add_argument('--chunk-text-store', action='store_true', help='keep chunk text in the local chunk store instead of pinecone metadata (pinecone sink only)')
+    parser.add_argument('--quantize', action='store_true', help='store int8 quantized embeddings (local sink only)')
+    parser.add_argument('--start-line', type=int, help='first line of the data file to load (default: resume where the last run stopped)')
+    parser.add_argument('--force', action='store_true', help='re-embed and upsert articles even if unchanged since the last load')
+    parser.add_argument('--no-embedding-cache', action='store_true', help='always call the embedding API instead of reusing embeddings cached by earlier loads')
+    parser.add_argument('--no-lexical-index', action='store_true', help='don\'t write chunk text to the local lexical (BM25) index used for hybrid retrieval')
+    parser.add_argument('--rebuild-lexical-index', action='store_true', help='only rebuild the lexical index from the data file (chunking, no embedding), then exit')
+    parser.add_argument('--pipeline', action='store_true', help='chunk, embed and upsert concurrently instead of one article at a time')
+    parser.add_argument('--chunk-workers', type=int, default=os.cpu_count(), help='chunking processes (default: %(default)s)')
+    parser.add_argument('--embed-workers', type=int, default=2, help='concurrent embedding requests (default: %(default)s)')
+    parser.add_argument('--embed-batch-size', type=int, default=DEFAULT_EMBED_BATCH_SIZE, help='max chunks per embedding request (default: %(default)s)')
+    parser.add_argument('--embed-batch-characters', type=int, default=DEFAULT_EMBED_BATCH_CHARACTERS, help='max characters per embedding request (default: %(default)s)')
+    parser.add_argument('--upsert-workers', type=int, default=4, help='concurrent upsert requests (default: %(default)s)')
+    parser.add_argument('--metrics-port', type=int, default=0, help='serve stage timings on this port at /metrics while loading (default: off)')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_QUEUE_SIZE, help='max articles waiting between stages (default: %(default)s)')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = _parse_args()
+    start_metrics_server(args.metrics_port)
+    if not args.no_lexical_index:
+        lexical_index = LexicalIndex()
+    if args.rebuild_lexical_index:
+        _rebuild_lexical_index(args.chunk_workers)
+        record_index_change()
+        lexical_index.close()
+        raise SystemExit
+
+    if not args.no_embedding_cache:
+        embedding_cache = EmbeddingCache(os.getenv('OPENAI_EMBEDDING_MODEL'))
+    if args.sink == 'local':
+        vector_sink = LocalVectorStoreWriter(quantize=args.quantize)
+    elif args.chunk_text_store:
+        vector_sink = PineconeSink(chunk_store=ChunkStore())
+    manifest = IngestManifest(LOCAL_MANIFEST_FILE if args.sink == 'local' else MANIFEST_FILE)
+    start_line = args.start_line or manifest.resume_line()
+    if start_line > 1:
+        logger.info('Resuming from line %d ...', start_line)
+    manifest.begin(start_line)
+    articles = _changed_articles(_read_articles(start_line), manifest, args.force)
+
+    if args.pipeline:
+        pipeline = IngestPipeline(embed_fn=_embed_chunks,
+                                  upsert_fn=functools.partial(_upsert_article, manifest=manifest),
+                                  chunk_workers=args.chunk_workers,
+                                  embed_workers=args.embed_workers,
+                                  upsert_workers=args.upsert_workers,
+                                  embed_batch_size=args.embed_batch_size,
+                                  embed_batch_characters=args.embed_batch_characters,
+                                  queue_size=args.queue_size)
+        pipeline.run(articles)
+
+    else:
+        for article in articles:
+            logger.info('Processing line %d ...', article.line)
+            with span('loader_chunk'):
+                article.chunks = chunk_text(article.text)
+            _embed_chunks(article.chunks)
+            logger.info('Extracted %d chunks for src=%s', len(article.chunks), article.src)
+            _upsert_article(article, manifest)
+
+    _get_vector_sink().flush()
+    if embedding_cache:
+        logger.info(embedding_cache.summary())
+        embedding_cache.close()
+    if lexical_index:
+        lexical_index.close()
+    if manifest.changed:
+        record_index_change()
+    manifest.finish()
+    manifest.close()
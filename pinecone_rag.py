@@ -2,85 +2,67 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import json
-import os
 
-from langchain_community.vectorstores import Pinecone
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from typing import AsyncGenerator
 
-from utils import load_prompt
+from app_logging import get_logger
+from metrics import span
 
-PINECONE_INDEX_NAME = os.environ.get('PINECONE_INDEX_NAME')
+logger = get_logger(__name__)
+
+def _engine():
+    # imported on first use (or by `warm_up`, in the background): langchain and the clients aren't loaded at startup
+    from rag_engine import get_engine
+    return get_engine()
 
 def ask_question(question: str, filter: dict[str, str]={}, max_docs: int=None) -> str:
     return ask_question_with_prompt_file('question.prompt.txt', question, filter, max_docs)
 
+async def astream_question(question: str, filter: dict[str, str]={}, max_docs: int=None) -> AsyncGenerator[str, None]:
+    '''Yields the answer so far as it is generated.'''
+    async for answer in _engine().astream('question.prompt.txt', question, filter, max_docs):
+        yield answer
+
 def get_quiz(title: str, constraint: str='') -> dict[str, str|list[str]]:
-    print(f'get_quiz for: {title}')
+    logger.info('get_quiz for: %s', title)
     filter = {'title': title}
     max_docs = None # use default
     question = constraint
-    answer = ask_question_with_prompt_file('get_quiz.prompt.txt', question, filter, max_docs)
+    answer = ask_question_with_prompt_file('get_quiz.prompt.txt', question, filter, max_docs, use_cache=False) # a retry should get a new quiz
+    return _parse_quiz(title, answer)
+
+async def aget_quiz(title: str, constraint: str='') -> dict[str, str|list[str]]:
+    logger.info('aget_quiz for: %s', title)
+    answer = await _engine().aask('get_quiz.prompt.txt', constraint, {'title': title}, None, use_cache=False)
+    return _parse_quiz(title, answer)
+
+def _parse_quiz(title: str, answer: str) -> dict[str, str|list[str]]:
     answer = answer.lstrip('```json').rstrip('```')
     try:
-        answer: dict[str, str|list[str]] = json.loads(answer)['quiz']
-        if not answer.get('question') or not answer.get('choices') or len(answer['choices']) < 3 or not answer.get('answer') or answer['answer'] not in answer['choices']:
-            raise Exception('Invalid quiz')
+        with span('quiz_parse'):
+            answer: dict[str, str|list[str]] = json.loads(answer)['quiz']
+            if not answer.get('question') or not answer.get('choices') or len(answer['choices']) < 3 or not answer.get('answer') or answer['answer'] not in answer['choices']:
+                raise Exception('Invalid quiz')
         answer['title'] = title
-        print(f'quiz: {answer}')
+        logger.debug('quiz: %s', answer)
         return answer
     except Exception as e:
-        print(f'Error: {e}')
+        logger.warning('Error parsing quiz: %s', e)
         raise Exception(f'Error getting quiz. Please try again.') # for end user
 
-def ask_question_with_prompt_file(prompt_file: str, question: str, filter: dict[str, str], max_docs: int) -> str:
-    vectorstore = Pinecone.from_existing_index(PINECONE_INDEX_NAME,
-        OpenAIEmbeddings(api_key=os.getenv('OPENAI_EMBEDDING_API_KEY'), model=os.getenv('OPENAI_EMBEDDING_MODEL'), base_url=os.getenv('OPENAI_EMBEDDING_BASE_URL')))
-    search_kwargs = {'filter': filter} if filter else {}
-    if max_docs:
-        search_kwargs['k'] = max_docs # else default 4
-    retriever = vectorstore.as_retriever(search_type='similarity', search_kwargs=search_kwargs)
-
-    # define the RAG prompt
-    template = load_prompt(prompt_file)
-    prompt = ChatPromptTemplate.from_template(template)
-
-    # define the RAG model
-    model = ChatOpenAI(temperature=0, api_key=os.getenv('OPENAI_API_KEY2'),
-                       model=os.getenv('OPENAI_MODEL2'), base_url=os.getenv('OPENAI_BASE_URL2'),
-                       max_tokens=int(os.getenv('MAX_TOKENS2')))
-    chain = _create_rag_chain(retriever, prompt, model)
-
-    print(f'PINECONE RAG Q: {question}')
-    try:
-        answer = chain.invoke(question)
-    except Exception as e:
-        print(f'Error: {e}')
-        print('Trying other model ...')
-        model = ChatOpenAI(temperature=0, api_key=os.getenv('OPENAI_API_KEY'),
-                           model=os.getenv('OPENAI_MODEL'), base_url=os.getenv('OPENAI_BASE_URL'),
-                           max_tokens=int(os.getenv('MAX_TOKENS')))
-        chain = _create_rag_chain(retriever, prompt, model)
-        try:
-            answer = chain.invoke(question)
-        except Exception as e:
-            print(f'Error: {e}')
-            answer = "Sorry I can't find the answer. Please try asking another question."
-
-    print(f'A: {answer}')
-    return answer
-
-def _create_rag_chain(retriever, prompt, model):
-    chain = (
-        RunnableParallel({'context': retriever, 'question': RunnablePassthrough()})
-        | prompt
-        | model
-        | StrOutputParser()
-    )
-    chain = chain.with_types(input_type=str)
-    return chain
+def ask_question_with_prompt_file(prompt_file: str, question: str, filter: dict[str, str], max_docs: int, use_cache: bool=True) -> str:
+    return _engine().ask(prompt_file, question, filter, max_docs, use_cache)
+
+def cache_stats() -> dict[str, dict[str, float]]:
+    '''Size, hits, misses and hit rate of the query embedding and answer caches.'''
+    return _engine().cache_stats()
+
+def model_stats() -> dict[str, dict]:
+    '''Circuit state, successes, failures, hedges and latency percentiles per model.'''
+    return _engine().model_stats()
+
+def warm_up() -> None:
+    _engine().warm_up()
 
 if __name__ == '__main__':
     # test usage
@@ -0,0 +1,131 @@
+import asyncio
+
+import numpy as np
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+from app_logging import get_logger
+from chunk_store import ChunkStore
+from inflight import inflight_limit
+from metrics import span
+from rag_cache import LRUCache
+
+logger = get_logger(__name__)
+
+DEFAULT_K = 4 # same default as the langchain retrievers
+TEXT_KEY = 'text'
+FETCH_BATCH_SIZE = 100 # ids go in the fetch url, so keep batches modest
+
+class PineconeRetriever(BaseRetriever):
+    '''
+    Similarity search against the pinecone index.
+    Chunk text comes from the vector metadata or, if a `chunk_store` is given, from one batched local read.
+    '''
+
+    index: object # pinecone.Index
+    embeddings: Embeddings
+    chunk_store: ChunkStore|None = None
+    search_kwargs: dict = {}
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        return self._to_documents(self._query(self.embeddings.embed_query(query)))
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> list[Document]:
+        embedding = await self.embeddings.aembed_query(query)
+        async with inflight_limit('vector'):
+            matches = await asyncio.to_thread(self._query, embedding) # the pinecone client is sync only
+        return self._to_documents(matches)
+
+    def _query(self, embedding: list[float]) -> list:
+        with span('vector_query'):
+            rsp = self.index.query(vector=embedding,
+                                   top_k=self.search_kwargs.get('k', DEFAULT_K),
+                                   filter=self.search_kwargs.get('filter'),
+                                   include_metadata=True)
+        return rsp.matches
+
+    def _to_documents(self, matches: list) -> list[Document]:
+        return [document for _, document in self._documents(matches)]
+
+    def _documents(self, matches: list) -> list[tuple[object, Document]]:
+        '''(match, document) pairs, skipping matches without text.'''
+        texts = self.chunk_store.get_many([match.id for match in matches]) if self.chunk_store else {}
+        documents = []
+        for match in matches:
+            metadata = dict(match.metadata or {})
+            text = metadata.pop(TEXT_KEY, None)
+            if self.chunk_store:
+                text = texts.get(match.id, text)
+            if text is None:
+                logger.warning('No text found for vector %s', match.id)
+                continue
+            documents.append((match, Document(page_content=text, metadata=metadata)))
+        return documents
+
+class PineconeTitleRetriever(PineconeRetriever):
+    '''
+    Retrieval scoped to one article's known vector `ids`: a batched fetch by id (kept in `chunk_cache`)
+    and a local similarity rank, instead of a filtered query over the whole index. If the article has
+    no more than k chunks they are all returned, without embedding the query. Falls back to the filtered
+    query if none of the ids are found.
+    '''
+
+    ids: list[str]
+    chunk_cache: LRUCache|None = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        chunks = self._cached_chunks()
+        if chunks is None:
+            chunks = self._fetch()
+        if not chunks:
+            return super()._get_relevant_documents(query, run_manager=run_manager)
+        if len(chunks[0]) <= self._k():
+            return chunks[0]
+        return self._rank(chunks, self.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> list[Document]:
+        chunks = self._cached_chunks()
+        if chunks is None:
+            async with inflight_limit('vector'):
+                chunks = await asyncio.to_thread(self._fetch)
+        if not chunks:
+            return await super()._aget_relevant_documents(query, run_manager=run_manager)
+        if len(chunks[0]) <= self._k():
+            return chunks[0]
+        return self._rank(chunks, await self.embeddings.aembed_query(query))
+
+    def _k(self) -> int:
+        return self.search_kwargs.get('k', DEFAULT_K)
+
+    def _cached_chunks(self) -> tuple[list[Document], np.ndarray]|None:
+        return self.chunk_cache.get(tuple(self.ids)) if self.chunk_cache else None
+
+    def _fetch(self) -> tuple[list[Document], np.ndarray]|None:
+        '''The article's chunks in order, with their unit-normalized embeddings as rows.'''
+        vectors = {}
+        with span('vector_fetch'):
+            for i in range(0, len(self.ids), FETCH_BATCH_SIZE):
+                vectors.update(self.index.fetch(ids=self.ids[i:i + FETCH_BATCH_SIZE]).vectors)
+        if len(vectors) < len(self.ids):
+            logger.warning('Fetched %d of %d vectors', len(vectors), len(self.ids))
+
+        pairs = self._documents([vectors[id] for id in self.ids if id in vectors])
+        if not pairs:
+            return None
+        embeddings = np.array([vector.values for vector, _ in pairs], dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True).clip(min=1e-12)
+        chunks = ([document for _, document in pairs], embeddings)
+        if self.chunk_cache:
+            self.chunk_cache.put(tuple(self.ids), chunks)
+        return chunks
+
+    def _rank(self, chunks: tuple[list[Document], np.ndarray], query_embedding: list[float]) -> list[Document]:
+        documents, embeddings = chunks
+        scores = embeddings @ np.asarray(query_embedding, dtype=np.float32) # same order as cosine, the query norm is constant
+        return [documents[i] for i in np.argsort(-scores)[:self._k()]]
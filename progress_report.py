@@ -1,29 +1,163 @@
+import gzip
+import hashlib
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timezone
 
 from jinja2 import Environment, FileSystemLoader
 
+from app_logging import get_logger
+from metrics import span
+from user_stats_store import MOST_MISSED_QUESTIONS
 from utils import UTF8_ENCODING
 
+logger = get_logger(__name__)
+
 REPORTS_DIR = 'reports'
 os.makedirs(REPORTS_DIR, exist_ok=True)
+REPORT_PAGE_SIZE = int(os.getenv('REPORT_PAGE_SIZE', '50')) # attempts listed per report page
+REPORT_MAX_AGE_SECONDS = float(os.getenv('REPORT_MAX_AGE_SECONDS', '86400')) # report files older than this are deleted
+REPORT_VERSIONS_KEPT = 3 # per user, newest first; older versions are superseded
+GC_INTERVAL_SECONDS = 600
 
 env = Environment(loader=FileSystemLoader('templates'))
 template = env.get_template('quiz_results.html')
 
-def create_progress_report(user_stats: dict) -> None:
-    ip_address = user_stats['ip_address']
-    quizzes = user_stats['quizzes']
+def report_file_path(ip_address: str, version: str, page: int) -> str:
+    '''
+    Where the report for this stats `version` and page is (or will be) saved: a report already there is current.
+    One directory per user and version, so the downloaded file keeps its plain name.
+    '''
+    version_key = hashlib.sha256(f'{version}:{page}:{REPORT_PAGE_SIZE}'.encode('utf-8')).hexdigest()[:16]
+    return f'{REPORTS_DIR}/{user_dir_name(ip_address)}/{version_key}/Progress Report for {user_dir_name(ip_address)}.html'
 
-    html_output = template.render(ip_address=ip_address, quizzes=quizzes)
-    print(f'{html_output=}')
+def user_dir_name(ip_address: str) -> str:
+    # the ip address comes from the client's x-forwarded-for header: keep it to one plain path component
+    return re.sub(r'[^\w.-]', '_', ip_address).lstrip('.') or '_'
 
-    outfile_path = f'{REPORTS_DIR}/Progress Report for {ip_address}.html'
-    with open(outfile_path, 'w', encoding=UTF8_ENCODING) as f:
-        f.write(html_output)
+def _check_in_reports_dir(path: str) -> None:
+    reports_dir = os.path.realpath(REPORTS_DIR)
+    if os.path.commonpath([reports_dir, os.path.realpath(path)]) != reports_dir:
+        raise ValueError(f'Report path outside {REPORTS_DIR}: {path}')
 
-    print(f'Saved: {outfile_path}')
+def create_progress_report(user_stats: dict, outfile_path: str=None) -> str:
+    '''
+    Renders `user_stats` (the quizzes to list, plus the summaries from `aget_report_data` if any) to `outfile_path`,
+    streamed to the file as it renders and renamed into place once complete.
+    '''
+    ip_address = user_stats['ip_address']
+    outfile_path = outfile_path or f'{REPORTS_DIR}/Progress Report for {user_dir_name(ip_address)}.html'
+    _check_in_reports_dir(outfile_path)
+    write_report(user_stats, outfile_path)
+    logger.info('Saved: %s', outfile_path)
+    threading.Thread(target=collect_old_reports, args=(ip_address, os.path.dirname(outfile_path)), daemon=True).start()
     return outfile_path
 
+def write_report(report: dict, outfile_path: str, compress: bool=False) -> int:
+    '''Streams the render of `report` to `outfile_path` (gzipped if `compress`), renamed into place once complete; returns its size.'''
+    directory = os.path.dirname(outfile_path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory) # unique, so concurrent renders of one report don't interleave
+    os.close(fd)
+    try:
+        with span('report_render'):
+            with (gzip.open(tmp_path, 'wt', encoding=UTF8_ENCODING) if compress else open(tmp_path, 'w', encoding=UTF8_ENCODING)) as f:
+                f.writelines(template.generate(**report))
+        os.replace(tmp_path, outfile_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return os.path.getsize(outfile_path)
+
+def summarize_quizzes(ip_address: str, quizzes: list[dict]) -> dict:
+    '''The summaries of `user_stats_service.aget_report_data`, computed from a full history, with all of it on one page.'''
+    articles: dict[str, dict] = {}
+    days: dict[str, dict] = {}
+    questions: dict[tuple[str, str], dict] = {}
+    for quiz in quizzes:
+        article = articles.setdefault(quiz['article'], {'article': quiz['article'], 'attempts': 0, 'correct': 0})
+        day_key = datetime.fromtimestamp(quiz['time_seconds'], tz=timezone.utc).strftime('%Y-%m-%d')
+        day = days.setdefault(day_key, {'day': day_key, 'attempts': 0, 'correct': 0})
+        question = questions.setdefault((quiz['article'], quiz['question']),
+                                        {'article': quiz['article'], 'question': quiz['question'], 'attempts': 0, 'missed': 0})
+        for counts in (article, day):
+            counts['attempts'] += 1
+            counts['correct'] += 1 if quiz['correct'] else 0
+        question['attempts'] += 1
+        question['missed'] += 0 if quiz['correct'] else 1
+
+    most_missed = sorted((question for question in questions.values() if question['missed']),
+                         key=lambda question: (-question['missed'], -question['attempts']))
+    return {'ip_address': ip_address,
+            'total': len(quizzes),
+            'correct': sum(article['correct'] for article in articles.values()),
+            'articles': sorted(articles.values(), key=lambda article: (-article['attempts'], article['article'])),
+            'days': sorted(days.values(), key=lambda day: day['day']),
+            'most_missed': most_missed[:MOST_MISSED_QUESTIONS],
+            'quizzes': list(reversed(quizzes)),
+            'page': 1,
+            'pages': 1}
+
+_gc_lock = threading.Lock()
+_last_gc = 0.0
+
+def collect_old_reports(ip_address: str=None, keep_dir: str=None) -> None:
+    '''Deletes the user's superseded report versions, and (at most every GC_INTERVAL_SECONDS) any report past its max age.'''
+    global _last_gc
+    with _gc_lock:
+        if ip_address:
+            user_dir = os.path.join(REPORTS_DIR, user_dir_name(ip_address))
+            for path in _by_age(user_dir)[REPORT_VERSIONS_KEPT:]:
+                if path != keep_dir:
+                    _remove(path)
+
+        now = time.time()
+        if now - _last_gc < GC_INTERVAL_SECONDS:
+            return
+        _last_gc = now
+        removed = 0
+        for path, modified in _by_age(REPORTS_DIR, with_mtimes=True):
+            if os.path.isdir(path):
+                for version_path, version_modified in _by_age(path, with_mtimes=True):
+                    if now - version_modified > REPORT_MAX_AGE_SECONDS:
+                        removed += _remove(version_path)
+                if not _by_age(path):
+                    removed += _remove(path)
+            elif now - modified > REPORT_MAX_AGE_SECONDS: # reports from before the per-user directories
+                removed += _remove(path)
+        if removed:
+            logger.info('Deleted %d old report files', removed)
+
+def _by_age(directory: str, with_mtimes: bool=False) -> list:
+    '''Entries of `directory`, newest first (as (path, mtime) if `with_mtimes`), skipping any deleted meanwhile.'''
+    try:
+        paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+    except FileNotFoundError:
+        return []
+    entries = []
+    for path in paths:
+        try:
+            entries.append((path, os.path.getmtime(path)))
+        except FileNotFoundError:
+            continue # e.g. removed by a concurrent collection, or a temp file renamed into place
+    entries.sort(key=lambda entry: entry[1], reverse=True)
+    return entries if with_mtimes else [path for path, _ in entries]
+
+def _remove(path: str) -> int:
+    try:
+        shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+        return 1
+    except FileNotFoundError:
+        return 0 # already gone
+    except OSError as e:
+        logger.warning('Error deleting %s: %s', path, e)
+        return 0
+
 if __name__ == '__main__':
     user_stats = {
         "ip_address": "99.198.232.98",
@@ -0,0 +1,153 @@
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Callable
+
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+QUIZ_POOL_FILE = 'db/quiz_pool.json'
+QUIZ_POOL_SIZE = int(os.getenv('QUIZ_POOL_SIZE', '3')) # ready quizzes kept per title
+QUIZ_POOL_MAX_TITLES = int(os.getenv('QUIZ_POOL_MAX_TITLES', '200')) # most recently viewed titles kept
+QUIZ_POOL_WORKERS = int(os.getenv('QUIZ_POOL_WORKERS', '2'))
+RETRY_DELAY_SECONDS = 30 # after a failed generation for a title
+
+def quiz_constraint(previous_questions: list[str]) -> str:
+    '''Prompt constraint asking for a quiz question unlike `previous_questions`.'''
+    if not previous_questions:
+        return ''
+    questions = '\n'.join(f'"{question}"' for question in previous_questions)
+    return f'''
+You previously asked the reader the following questions so try not to ask them again:
+{questions}
+-- But if you must ask one again since you have no other choice, then reword the question.
+    '''.strip()
+
+class QuizPool:
+    '''
+    Keeps up to `size` validated quizzes ready per title, generated in background threads with `generate(title, constraint)`
+    (which must raise on an invalid quiz). Titles are refilled most recently viewed first, only the `max_titles` most
+    recently viewed titles are kept, and the pool is saved to `path` so a restart starts warm.
+    '''
+
+    def __init__(self, generate: Callable[[str, str], dict], path: str=QUIZ_POOL_FILE,
+                 size: int=QUIZ_POOL_SIZE, max_titles: int=QUIZ_POOL_MAX_TITLES, workers: int=QUIZ_POOL_WORKERS):
+        self.generate = generate
+        self.path = path
+        self.size = size
+        self.max_titles = max_titles
+        self.workers = workers
+        self._quizzes: OrderedDict[str, list[dict]] = OrderedDict() # most recently viewed last
+        self._generating: set[str] = set()
+        self._retry_at: dict[str, float] = {}
+        self._dirty = False
+        self._started = False
+        self._cond = threading.Condition()
+        self._load()
+
+    def start(self) -> None:
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f'quiz-pool-{i}', daemon=True).start()
+
+    def touch(self, title: str) -> None:
+        '''Marks `title` as just viewed, so its quizzes are generated next.'''
+        with self._cond:
+            self._touch(title)
+            self._cond.notify_all()
+
+    def pop(self, title: str, avoid_question: str=None) -> dict|None:
+        '''Takes a ready quiz for `title` whose question isn't `avoid_question`, or returns None if there is none.'''
+        with self._cond:
+            self._touch(title)
+            quizzes = self._quizzes[title]
+            quiz = next((quiz for quiz in quizzes if quiz['question'] != avoid_question), None)
+            if quiz is not None:
+                quizzes.remove(quiz)
+                self._dirty = True
+            self._cond.notify_all() # refill
+        logger.info('quiz pool %s for: %s', 'hit' if quiz else 'miss', title)
+        return quiz
+
+    def stats(self) -> dict[str, int]:
+        with self._cond:
+            return {'titles': len(self._quizzes), 'quizzes': sum(len(quizzes) for quizzes in self._quizzes.values())}
+
+    def _touch(self, title: str) -> None:
+        self._quizzes.setdefault(title, [])
+        self._quizzes.move_to_end(title)
+        while len(self._quizzes) > self.max_titles:
+            evicted, _ = self._quizzes.popitem(last=False)
+            self._retry_at.pop(evicted, None)
+            self._dirty = True
+
+    def _next_title(self) -> str|None:
+        now = time.monotonic()
+        for title in reversed(self._quizzes):
+            if (len(self._quizzes[title]) < self.size and title not in self._generating
+                    and self._retry_at.get(title, 0) <= now):
+                return title
+        return None
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                title = self._next_title()
+                while title is None:
+                    if self._dirty:
+                        break
+                    self._cond.wait(timeout=RETRY_DELAY_SECONDS)
+                    title = self._next_title()
+                if self._dirty:
+                    self._save()
+                if title is None:
+                    continue
+                self._generating.add(title)
+                previous_questions = [quiz['question'] for quiz in self._quizzes[title]]
+
+            try:
+                quiz = self.generate(title, quiz_constraint(previous_questions))
+            except Exception as e:
+                logger.warning('Error pre-generating quiz for %s: %s', title, e)
+                quiz = None
+
+            with self._cond:
+                self._generating.discard(title)
+                quizzes = self._quizzes.get(title)
+                if quiz is None:
+                    self._retry_at[title] = time.monotonic() + RETRY_DELAY_SECONDS
+                elif quizzes is not None and all(other['question'] != quiz['question'] for other in quizzes):
+                    quizzes.append(quiz)
+                    self._retry_at.pop(title, None)
+                    self._dirty = True
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved: dict[str, list[dict]] = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error('Error loading quiz pool %s: %s', self.path, e)
+            return
+        for title, quizzes in saved.items(): # saved in view order
+            self._quizzes[title] = quizzes[:self.size]
+        while len(self._quizzes) > self.max_titles:
+            self._quizzes.popitem(last=False)
+        logger.info('quiz pool loaded: %s', self.stats())
+
+    def _save(self) -> None:
+        '''Called with the lock held; the file is small.'''
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._quizzes, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
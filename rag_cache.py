@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from langchain_core.embeddings import Embeddings
+
+from app_logging import get_logger
+from inflight import inflight_limit
+from ingest_manifest import INDEX_VERSION_FILE
+from metrics import span
+
+logger = get_logger(__name__)
+
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', '10000'))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', '1000'))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv('ANSWER_CACHE_TTL_SECONDS', '3600'))
+INDEX_VERSION_CHECK_SECONDS = 10
+
+def normalize_question(question: str) -> str:
+    return ' '.join(question.lower().split())
+
+class LRUCache:
+    '''Thread-safe, size-bounded LRU cache with optional per-entry TTL, counting hits and misses.'''
+
+    def __init__(self, maxsize: int, ttl_seconds: float=None):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[object, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (self.ttl_seconds is None or entry[1] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key] # expired
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value) -> None:
+        expires = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else 0
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+class CachedQueryEmbeddings(Embeddings):
+    '''Wraps an `Embeddings` so repeated questions skip the embedding call. Documents are never cached.'''
+
+    def __init__(self, embeddings: Embeddings, cache: LRUCache):
+        self.embeddings = embeddings
+        self.cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        key = normalize_question(text)
+        embedding = self.cache.get(key)
+        if embedding is None:
+            with span('embedding'):
+                embedding = self.embeddings.embed_query(text)
+            self.cache.put(key, embedding)
+        return embedding
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        async with inflight_limit('embedding'):
+            return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = normalize_question(text)
+        embedding = self.cache.get(key)
+        if embedding is None:
+            async with inflight_limit('embedding'):
+                with span('embedding'):
+                    embedding = await self.embeddings.aembed_query(text)
+            self.cache.put(key, embedding)
+        return embedding
+
+def answer_cache_key(prompt_file: str, question: str, filter: dict|None, k: int|None, model: str) -> tuple:
+    return (prompt_file, normalize_question(question), json.dumps(filter or {}, sort_keys=True), k, model)
+
+class IndexVersionWatcher:
+    '''Calls `on_change` when the loader reports an index change (see `ingest_manifest.record_index_change`).'''
+
+    def __init__(self, on_change: Callable[[], None], path: str=INDEX_VERSION_FILE):
+        self.on_change = on_change
+        self.path = path
+        self._version = self._read()
+        self._checked = time.monotonic()
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        with self._lock:
+            if time.monotonic() - self._checked < INDEX_VERSION_CHECK_SECONDS:
+                return
+            self._checked = time.monotonic()
+            version = self._read()
+            if version == self._version:
+                return
+            self._version = version
+        logger.info('Index changed (version %s), clearing cached answers', version)
+        self.on_change()
+
+    def _read(self) -> str|None:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,393 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+import threading
+import time
+
+from typing import AsyncGenerator, Generator
+
+import httpx
+
+from langchain_core.documents import Document
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import Runnable
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from pinecone import Pinecone
+
+from app_logging import get_logger
+from chunk_store import ChunkStore
+from context_assembly import assemble_context, context_token_budget, count_tokens
+from hybrid_retriever import HybridRetriever
+from inflight import inflight_limit
+from lexical_index import LEXICAL_INDEX_FILE, LexicalIndex
+from local_vector_store import LocalVectorStore, LocalVectorStoreRetriever
+from metrics import register_collector, span
+from model_router import ModelRouter
+from pinecone_retriever import PineconeRetriever, PineconeTitleRetriever
+from rag_cache import (ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL_SECONDS, QUERY_EMBEDDING_CACHE_SIZE,
+                       CachedQueryEmbeddings, IndexVersionWatcher, LRUCache, answer_cache_key)
+from title_scope import TitleScope
+from utils import load_prompt
+
+logger = get_logger(__name__)
+
+PINECONE_INDEX_NAME = os.environ.get('PINECONE_INDEX_NAME')
+VECTOR_STORE_BACKEND = os.getenv('VECTOR_STORE_BACKEND', 'pinecone') # or 'local', built by `pinecone_loader.py --sink local`
+CHUNK_TEXT_STORE = os.getenv('CHUNK_TEXT_STORE') # 'local' if loaded with `pinecone_loader.py --chunk-text-store`
+TITLE_SCOPED_RETRIEVAL = os.getenv('TITLE_SCOPED_RETRIEVAL', 'true').lower() == 'true'
+HYBRID_RETRIEVAL = os.getenv('HYBRID_RETRIEVAL', 'true').lower() == 'true' # if the loader built the lexical index
+TITLE_CHUNK_CACHE_SIZE = int(os.getenv('TITLE_CHUNK_CACHE_SIZE', '256')) # articles whose fetched chunks are kept
+
+PROMPT_FILES = ('question.prompt.txt', 'get_quiz.prompt.txt')
+PRIMARY_MODEL = 'primary' # lambda llama
+FALLBACK_MODEL = 'fallback' # openai
+MODEL_UPSTREAMS = {PRIMARY_MODEL: 'llm_primary', FALLBACK_MODEL: 'llm_fallback'} # for `inflight_limit`
+# max wait for a model's first token before hedging with the next model (lower if its p95 is lower)
+MODEL_LATENCY_BUDGETS = {
+    PRIMARY_MODEL: float(os.getenv('PRIMARY_LATENCY_BUDGET_SECONDS', '5')),
+    FALLBACK_MODEL: float(os.getenv('FALLBACK_LATENCY_BUDGET_SECONDS', '10')),
+}
+
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '20')) # per endpoint
+HTTP_TIMEOUT_SECONDS = float(os.getenv('HTTP_TIMEOUT_SECONDS', '120'))
+
+SORRY_ANSWER = "Sorry I can't find the answer. Please try asking another question."
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+
+def _http_clients() -> dict[str, httpx.Client|httpx.AsyncClient]:
+    return {'http_client': httpx.Client(limits=_http_limits(), timeout=HTTP_TIMEOUT_SECONDS),
+            'http_async_client': httpx.AsyncClient(limits=_http_limits(), timeout=HTTP_TIMEOUT_SECONDS)}
+
+class RagEngine:
+    '''
+    Long-lived RAG engine, created once per process by `get_engine`.
+
+    Holds pooled, keep-alive clients for the embedding, vector store, primary and fallback LLM endpoints,
+    prompt templates loaded once, and generation chains compiled once per (prompt file, model).
+    Retrieval runs once per question, so a fallback to the other model reuses the retrieved context.
+    Generation goes through a `ModelRouter`, which hedges slow requests and stops routing to failing models.
+
+    Questions about one title are answered from that article's chunks alone: fetched by vector id
+    (see `TitleScope`) and ranked locally, or filtered by row in the local vector store.
+
+    Vector results are fused with BM25 results from the local lexical index, if the loader built one.
+
+    Query embeddings are cached by normalized question, and answers (deterministic at temperature 0)
+    by prompt file, normalized question, filter, k and model, until they expire or the index changes.
+    '''
+
+    def __init__(self):
+        self.query_embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
+        self.answer_cache = LRUCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL_SECONDS)
+        self.title_chunk_cache = LRUCache(TITLE_CHUNK_CACHE_SIZE)
+        self._index_watcher = IndexVersionWatcher(on_change=self._on_index_change)
+
+        self.embeddings = CachedQueryEmbeddings(
+            OpenAIEmbeddings(api_key=os.getenv('OPENAI_EMBEDDING_API_KEY'), model=os.getenv('OPENAI_EMBEDDING_MODEL'),
+                             base_url=os.getenv('OPENAI_EMBEDDING_BASE_URL'), **_http_clients()),
+            self.query_embedding_cache)
+        self.models: dict[str, ChatOpenAI] = {
+            PRIMARY_MODEL: ChatOpenAI(temperature=0, api_key=os.getenv('OPENAI_API_KEY2'),
+                                      model=os.getenv('OPENAI_MODEL2'), base_url=os.getenv('OPENAI_BASE_URL2'),
+                                      max_tokens=int(os.getenv('MAX_TOKENS2')), **_http_clients()),
+            FALLBACK_MODEL: ChatOpenAI(temperature=0, api_key=os.getenv('OPENAI_API_KEY'),
+                                       model=os.getenv('OPENAI_MODEL'), base_url=os.getenv('OPENAI_BASE_URL'),
+                                       max_tokens=int(os.getenv('MAX_TOKENS')), **_http_clients()),
+        }
+
+        self.router = ModelRouter(MODEL_LATENCY_BUDGETS)
+
+        self._lock = threading.Lock()
+        self._index = None
+        self._local_vector_store: LocalVectorStore = None
+        self._chunk_store: ChunkStore = None
+        self._title_scope: TitleScope = None
+        self._lexical_index: LexicalIndex|None = None
+        self._lexical_index_checked = False
+        self._prompts: dict[str, ChatPromptTemplate] = {}
+        self._chains: dict[tuple[str, str], Runnable] = {}
+        register_collector(self._metrics)
+
+    def warm_up(self) -> None:
+        '''Builds everything the first request would otherwise pay for, including the connections.'''
+        for prompt_file in PROMPT_FILES:
+            for model in self.models:
+                self.chain(prompt_file, model)
+        if TITLE_SCOPED_RETRIEVAL:
+            self._get_title_scope()
+        self._get_lexical_index()
+        count_tokens('warm up') # loads (on first run, downloads) the tokenizer used for the context budget
+
+        if VECTOR_STORE_BACKEND == 'local':
+            self._get_local_vector_store()
+        else:
+            self._get_index().describe_index_stats()
+            if CHUNK_TEXT_STORE == 'local':
+                self._get_chunk_store()
+        self.embeddings.embeddings.embed_query('warm up') # bypass the cache, the point is to open the connection
+        logger.info('RAG engine warmed up')
+
+    def cache_stats(self) -> dict[str, dict[str, float]]:
+        return {'query_embeddings': self.query_embedding_cache.stats(), 'answers': self.answer_cache.stats(),
+                'title_chunks': self.title_chunk_cache.stats()}
+
+    def model_stats(self) -> dict[str, dict]:
+        return self.router.summary()
+
+    def _metrics(self) -> list[tuple[str, dict[str, str], float]]:
+        samples = []
+        for cache, stats in self.cache_stats().items():
+            samples += [('researchio_cache_size', {'cache': cache}, stats['size']),
+                        ('researchio_cache_hit_rate', {'cache': cache}, stats['hit_rate'])]
+        for model, stats in self.model_stats().items():
+            samples += [('researchio_model_circuit_open', {'model': model}, stats['state'] != 'closed'),
+                        ('researchio_model_hedges', {'model': model}, stats['hedges']),
+                        ('researchio_model_hedge_wins', {'model': model}, stats['hedge_wins'])]
+        return samples
+
+    def ask(self, prompt_file: str, question: str, filter: dict[str, str], max_docs: int, use_cache: bool=True) -> str:
+        key, answer = self._cached_answer(prompt_file, question, filter, max_docs, use_cache)
+        if answer is not None:
+            return answer
+
+        try:
+            context = self.retrieve_context(prompt_file, question, filter, max_docs)
+        except Exception as e: # counted by the `retrieve` stage span
+            logger.error('Error retrieving context: %s', e)
+            return SORRY_ANSWER # not cached, the next try may succeed
+        inputs = {'context': context, 'question': question}
+
+        logger.info('PINECONE RAG Q: %s', question)
+        answer = SORRY_ANSWER
+        answered_by = []
+        try:
+            for answer in self.router.stream(lambda model: self.chain(prompt_file, model).stream(inputs), answered_by.append):
+                pass
+        except Exception as e:
+            logger.error('Error generating answer: %s', e)
+            answer = SORRY_ANSWER
+
+        self._cache_answer(key, answered_by, answer)
+        return answer
+
+    def stream(self, prompt_file: str, question: str, filter: dict[str, str], max_docs: int, use_cache: bool=True) -> Generator[str, None, None]:
+        '''
+        Like `ask`, but yields the answer so far as tokens arrive.
+        If a model fails mid-answer the next one starts over, so the answer so far may get shorter.
+        '''
+        key, answer = self._cached_answer(prompt_file, question, filter, max_docs, use_cache)
+        if answer is not None:
+            yield answer
+            return
+
+        try:
+            context = self.retrieve_context(prompt_file, question, filter, max_docs)
+        except Exception as e: # counted by the `retrieve` stage span
+            logger.error('Error retrieving context: %s', e)
+            yield SORRY_ANSWER # not cached, the next try may succeed
+            return
+        inputs = {'context': context, 'question': question}
+
+        logger.info('PINECONE RAG Q (streaming): %s', question)
+        answered_by = []
+        try:
+            for answer in self.router.stream(lambda model: self.chain(prompt_file, model).stream(inputs), answered_by.append):
+                yield answer
+        except Exception as e:
+            logger.error('Error generating answer: %s', e)
+            answer = SORRY_ANSWER
+            yield answer
+
+        self._cache_answer(key, answered_by, answer)
+
+    async def aask(self, prompt_file: str, question: str, filter: dict[str, str], max_docs: int, use_cache: bool=True) -> str:
+        answer = SORRY_ANSWER
+        async for answer in self.astream(prompt_file, question, filter, max_docs, use_cache):
+            pass
+        return answer
+
+    async def astream(self, prompt_file: str, question: str, filter: dict[str, str], max_docs: int, use_cache: bool=True,
+                      timings: dict[str, float|bool]=None) -> AsyncGenerator[str, None]:
+        '''
+        Async `stream`: never blocks the event loop, and bounds the in-flight requests to each upstream.
+        If given, `timings` is filled in with the seconds spent per stage (retrieve, first token, generate),
+        whether the answer was `cached`, and `failed` if retrieval or every model failed (the answer is then SORRY_ANSWER).
+        '''
+        timings = {} if timings is None else timings
+        key, answer = self._cached_answer(prompt_file, question, filter, max_docs, use_cache)
+        timings['cached'] = answer is not None
+        if answer is not None:
+            yield answer
+            return
+
+        started = time.perf_counter()
+        try:
+            context = await self.aretrieve_context(prompt_file, question, filter, max_docs)
+        except Exception as e: # counted by the `retrieve` stage span
+            logger.error('Error retrieving context: %s', e)
+            timings['failed'] = True
+            yield SORRY_ANSWER # not cached, the next try may succeed
+            return
+        finally:
+            timings['retrieve_seconds'] = time.perf_counter() - started
+        inputs = {'context': context, 'question': question}
+
+        logger.info('PINECONE RAG Q (async): %s', question)
+        started = time.perf_counter()
+        answered_by = []
+        try:
+            async for answer in self.router.astream(lambda model: self._astream_model(prompt_file, model, inputs), answered_by.append):
+                timings.setdefault('first_token_seconds', time.perf_counter() - started)
+                yield answer
+        except Exception as e:
+            logger.error('Error generating answer: %s', e)
+            timings['failed'] = True
+            answer = SORRY_ANSWER
+            yield answer
+        timings['generate_seconds'] = time.perf_counter() - started
+
+        self._cache_answer(key, answered_by, answer)
+
+    async def _astream_model(self, prompt_file: str, model: str, inputs: dict) -> AsyncGenerator[str, None]:
+        async with inflight_limit(MODEL_UPSTREAMS[model]):
+            async for token in self.chain(prompt_file, model).astream(inputs):
+                yield token
+
+    def retrieve_context(self, prompt_file: str, question: str, filter: dict[str, str], max_docs: int) -> list[Document]:
+        with span('retrieve'):
+            documents = self.retriever(self._search_kwargs(filter, max_docs)).invoke(question)
+        with span('context_assembly'):
+            return assemble_context(question, documents, context_token_budget(prompt_file))
+
+    async def aretrieve_context(self, prompt_file: str, question: str, filter: dict[str, str], max_docs: int) -> list[Document]:
+        with span('retrieve'):
+            documents = await self.retriever(self._search_kwargs(filter, max_docs)).ainvoke(question)
+        with span('context_assembly'):
+            return assemble_context(question, documents, context_token_budget(prompt_file))
+
+    def retriever(self, search_kwargs: dict) -> BaseRetriever:
+        # retrievers are cheap views over the pooled clients, so one is made per search
+        srcs = self._title_srcs(search_kwargs.get('filter'))
+        retriever = self._vector_retriever(search_kwargs, srcs)
+        lexical_index = self._get_lexical_index()
+        if lexical_index:
+            # filter by src where known, so titles cleaned up for the ui match too
+            lexical_filter = {'src': {'$in': srcs}} if srcs else None
+            retriever = HybridRetriever(vector_retriever=retriever, lexical_index=lexical_index,
+                                        search_kwargs=search_kwargs, lexical_filter=lexical_filter)
+        return retriever
+
+    def _vector_retriever(self, search_kwargs: dict, srcs: list[str]) -> BaseRetriever:
+        if VECTOR_STORE_BACKEND == 'local':
+            if srcs: # same rows as the title filter, also for titles cleaned up for the ui
+                search_kwargs = {**search_kwargs, 'filter': {'src': {'$in': srcs}}}
+            return LocalVectorStoreRetriever(store=self._get_local_vector_store(), embeddings=self.embeddings, search_kwargs=search_kwargs)
+
+        chunk_store = self._get_chunk_store() if CHUNK_TEXT_STORE == 'local' else None
+        ids = self._get_title_scope().chunk_ids(srcs) if srcs else []
+        if ids:
+            return PineconeTitleRetriever(index=self._get_index(), embeddings=self.embeddings, chunk_store=chunk_store,
+                                          search_kwargs=search_kwargs, ids=ids, chunk_cache=self.title_chunk_cache)
+        return PineconeRetriever(index=self._get_index(), embeddings=self.embeddings, chunk_store=chunk_store, search_kwargs=search_kwargs)
+
+    def _title_srcs(self, filter: dict|None) -> list[str]:
+        if not TITLE_SCOPED_RETRIEVAL or not filter or list(filter) != ['title'] or not isinstance(filter['title'], str):
+            return []
+        return self._get_title_scope().srcs(filter['title'])
+
+    @staticmethod
+    def _search_kwargs(filter: dict[str, str], max_docs: int) -> dict:
+        search_kwargs = {'filter': filter} if filter else {}
+        if max_docs:
+            search_kwargs['k'] = max_docs # else default 4
+        return search_kwargs
+
+    def _cached_answer(self, prompt_file: str, question: str, filter: dict[str, str], max_docs: int, use_cache: bool) -> tuple[tuple|None, str|None]:
+        '''(key without the model, cached answer of any model, primary first); (None, None) if not using the cache.'''
+        if not use_cache:
+            return None, None
+        self._index_watcher.check()
+        key = (prompt_file, question, filter, max_docs)
+        for model in self.router.models:
+            answer = self.answer_cache.get(answer_cache_key(*key, self.models[model].model_name))
+            if answer is not None:
+                logger.info('PINECONE RAG Q (cached, %s): %s', model, question)
+                return key, answer
+        return key, None
+
+    def _cache_answer(self, key: tuple|None, answered_by: list[str], answer: str) -> None:
+        '''Caches `answer` under the model which produced it, if any did.'''
+        logger.debug('A: %s', answer)
+        if key and answered_by and answer != SORRY_ANSWER:
+            self.answer_cache.put(answer_cache_key(*key, self.models[answered_by[-1]].model_name), answer)
+
+    def chain(self, prompt_file: str, model: str) -> Runnable:
+        key = (prompt_file, model)
+        with self._lock:
+            if key not in self._chains:
+                chain = self._prompt(prompt_file) | self.models[model] | StrOutputParser()
+                self._chains[key] = chain.with_types(input_type=dict)
+            return self._chains[key]
+
+    def _prompt(self, prompt_file: str) -> ChatPromptTemplate:
+        if prompt_file not in self._prompts:
+            self._prompts[prompt_file] = ChatPromptTemplate.from_template(load_prompt(prompt_file))
+        return self._prompts[prompt_file]
+
+    def _on_index_change(self) -> None:
+        self.answer_cache.clear()
+        self.title_chunk_cache.clear()
+        with self._lock:
+            self._local_vector_store = None # reopened with the new files on next use
+            self._title_scope = None
+            if self._lexical_index is None:
+                self._lexical_index_checked = False # the loader may have built it since
+
+    def _get_index(self):
+        with self._lock:
+            if self._index is None:
+                self._index = Pinecone().Index(name=PINECONE_INDEX_NAME, host=os.getenv('PINECONE_HOST'))
+            return self._index
+
+    def _get_local_vector_store(self) -> LocalVectorStore:
+        with self._lock:
+            if self._local_vector_store is None:
+                self._local_vector_store = LocalVectorStore() # memory-mapped, so loading once per process is cheap
+            return self._local_vector_store
+
+    def _get_title_scope(self) -> TitleScope:
+        with self._lock:
+            if self._title_scope is None:
+                self._title_scope = TitleScope()
+            return self._title_scope
+
+    def _get_lexical_index(self) -> LexicalIndex|None:
+        with self._lock:
+            if not self._lexical_index_checked:
+                self._lexical_index_checked = True
+                if HYBRID_RETRIEVAL and os.path.exists(LEXICAL_INDEX_FILE):
+                    self._lexical_index = LexicalIndex()
+                elif HYBRID_RETRIEVAL:
+                    logger.warning('No lexical index at %s, using vector search only', LEXICAL_INDEX_FILE)
+            return self._lexical_index
+
+    def _get_chunk_store(self) -> ChunkStore:
+        with self._lock:
+            if self._chunk_store is None:
+                self._chunk_store = ChunkStore()
+            return self._chunk_store
+
+_engine: RagEngine = None
+_engine_lock = threading.Lock()
+
+def get_engine() -> RagEngine:
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = RagEngine()
+        return _engine
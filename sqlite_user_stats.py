@@ -0,0 +1,191 @@
+import json
+import os
+import sqlite3
+import threading
+
+from typing import Generator
+
+from user_stats_store import MOST_MISSED_QUESTIONS, QUIZ_HISTORY_LIMIT, UserStatsStore, report_page, stats_version
+
+USER_STATS_DB_FILE = 'db/user_stats.db'
+
+_MAX_SQL_PARAMS = 500 # stay well under sqlite's host parameter limit
+_ATTEMPT_COLUMNS = ('article', 'question', 'answer', 'correct', 'time_seconds', 'formatted_time', 'attempt_id')
+_COUNTERS = ('quiz_attempts', 'correct_answers')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    ip_address TEXT PRIMARY KEY,
+    quiz_attempts INTEGER NOT NULL DEFAULT 0,
+    correct_answers INTEGER NOT NULL DEFAULT 0,
+    fields TEXT -- json of any other persisted fields
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS quiz_attempts (
+    id INTEGER PRIMARY KEY,
+    ip_address TEXT NOT NULL,
+    article TEXT,
+    question TEXT,
+    answer TEXT,
+    correct INTEGER NOT NULL,
+    time_seconds INTEGER,
+    formatted_time TEXT,
+    attempt_id TEXT
+);
+CREATE INDEX IF NOT EXISTS quiz_attempts_by_user_time ON quiz_attempts (ip_address, time_seconds);
+CREATE UNIQUE INDEX IF NOT EXISTS quiz_attempts_by_attempt_id ON quiz_attempts (attempt_id);
+'''
+
+class SqliteUserStatsStore(UserStatsStore):
+    '''
+    User stats in an embedded sqlite database (WAL mode): one row per quiz attempt, indexed by user and time,
+    so recording an attempt or reading one page of a report never touches the rest of the history.
+    A batch of attempts is one transaction, and a replayed attempt (same `attempt_id`) is ignored.
+    Safe to use from multiple threads.
+    '''
+
+    name = 'sqlite'
+
+    def __init__(self, path: str=USER_STATS_DB_FILE):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def record_attempts(self, attempts: list[tuple[str, dict]]) -> None:
+        counters: dict[str, list[int]] = {}
+        with self._lock, self._conn: # one transaction
+            for ip_address, attempt in attempts:
+                cursor = self._conn.execute(
+                    f'INSERT OR IGNORE INTO quiz_attempts (ip_address, {", ".join(_ATTEMPT_COLUMNS)}) VALUES (?{", ?" * len(_ATTEMPT_COLUMNS)})',
+                    (ip_address, *_attempt_row(attempt)))
+                if cursor.rowcount == 1:
+                    counter = counters.setdefault(ip_address, [0, 0])
+                    counter[0] += 1
+                    counter[1] += 1 if attempt.get('correct') else 0
+            self._conn.executemany(
+                '''INSERT INTO users (ip_address, quiz_attempts, correct_answers) VALUES (?, ?, ?)
+                   ON CONFLICT (ip_address) DO UPDATE SET quiz_attempts = quiz_attempts + excluded.quiz_attempts,
+                                                          correct_answers = correct_answers + excluded.correct_answers''',
+                [(ip_address, count, correct) for ip_address, (count, correct) in counters.items()])
+            if QUIZ_HISTORY_LIMIT > 0:
+                self._conn.executemany(
+                    '''DELETE FROM quiz_attempts WHERE ip_address = ?1 AND id NOT IN
+                       (SELECT id FROM quiz_attempts WHERE ip_address = ?1 ORDER BY time_seconds DESC, id DESC LIMIT ?2)''',
+                    [(ip_address, QUIZ_HISTORY_LIMIT) for ip_address in counters])
+
+    def persist(self, ip_address: str, user_stats: dict) -> bool:
+        user_stats = dict(user_stats)
+        user_stats.pop('ip_address', None)
+        quizzes = user_stats.pop('quizzes', None)
+        counters = {name: user_stats.pop(name) for name in _COUNTERS if name in user_stats}
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT fields FROM users WHERE ip_address = ?', (ip_address,)).fetchone()
+            fields = {**json.loads(row[0] or '{}'), **user_stats} if row else user_stats
+            self._conn.execute('INSERT OR IGNORE INTO users (ip_address) VALUES (?)', (ip_address,))
+            self._conn.execute('UPDATE users SET fields = ? WHERE ip_address = ?', (json.dumps(fields, ensure_ascii=False), ip_address))
+            for name, value in counters.items():
+                self._conn.execute(f'UPDATE users SET {name} = ? WHERE ip_address = ?', (value, ip_address))
+            if quizzes is not None:
+                self._conn.execute('DELETE FROM quiz_attempts WHERE ip_address = ?', (ip_address,))
+                self._conn.executemany(
+                    f'INSERT OR IGNORE INTO quiz_attempts (ip_address, {", ".join(_ATTEMPT_COLUMNS)}) VALUES (?{", ?" * len(_ATTEMPT_COLUMNS)})',
+                    [(ip_address, *_attempt_row(quiz)) for quiz in quizzes])
+        return True
+
+    def get(self, ip_address: str) -> dict|None:
+        with self._lock:
+            return next(_user_stats(self._conn, [ip_address]), None)
+
+    def stats_version(self, ip_address: str) -> str|None:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT quiz_attempts, (SELECT COUNT(*) FROM quiz_attempts WHERE ip_address = ?1) FROM users WHERE ip_address = ?1',
+                (ip_address,)).fetchone()
+        return stats_version(*row) if row else None
+
+    def report_data(self, ip_address: str, page: int, page_size: int) -> dict:
+        with self._lock:
+            articles = self._conn.execute(
+                '''SELECT article, COUNT(*) AS attempts, SUM(correct) FROM quiz_attempts WHERE ip_address = ?
+                   GROUP BY article ORDER BY attempts DESC, article''', (ip_address,)).fetchall()
+            days = self._conn.execute(
+                '''SELECT strftime('%Y-%m-%d', time_seconds, 'unixepoch') AS day, COUNT(*), SUM(correct) FROM quiz_attempts
+                   WHERE ip_address = ? GROUP BY day ORDER BY day''', (ip_address,)).fetchall()
+            most_missed = self._conn.execute(
+                '''SELECT article, question, COUNT(*) AS attempts, SUM(1 - correct) AS missed FROM quiz_attempts WHERE ip_address = ?
+                   GROUP BY article, question HAVING missed > 0 ORDER BY missed DESC, attempts DESC, article, question LIMIT ?''',
+                (ip_address, MOST_MISSED_QUESTIONS)).fetchall()
+            total = sum(attempts for _, attempts, _ in articles)
+            page, pages = report_page(total, page, page_size)
+            rows = self._conn.execute(
+                f'''SELECT {", ".join(_ATTEMPT_COLUMNS)} FROM quiz_attempts WHERE ip_address = ?
+                    ORDER BY time_seconds DESC, id DESC LIMIT ? OFFSET ?''',
+                (ip_address, page_size, (page - 1) * page_size)).fetchall()
+
+        return {'ip_address': ip_address,
+                'total': total,
+                'correct': sum(correct for _, _, correct in articles),
+                'articles': [{'article': article, 'attempts': attempts, 'correct': correct} for article, attempts, correct in articles],
+                'days': [{'day': day, 'attempts': attempts, 'correct': correct} for day, attempts, correct in days],
+                'most_missed': [{'article': article, 'question': question, 'attempts': attempts, 'missed': missed}
+                                for article, question, attempts, missed in most_missed],
+                'quizzes': [_attempt(row) for row in rows],
+                'page': page,
+                'pages': pages}
+
+    def iter_stats_versions(self, batch_size: int) -> Generator[tuple[str, str], None, None]:
+        conn = self._connect() # a reader of its own: WAL readers don't block the writer, nor each other
+        try:
+            cursor = conn.execute(
+                '''SELECT ip_address, quiz_attempts, (SELECT COUNT(*) FROM quiz_attempts WHERE quiz_attempts.ip_address = users.ip_address)
+                   FROM users''')
+            while rows := cursor.fetchmany(batch_size):
+                for ip_address, quiz_attempts, quiz_count in rows:
+                    yield ip_address, stats_version(quiz_attempts, quiz_count)
+        finally:
+            conn.close()
+
+    def iter_user_stats(self, ip_addresses: list[str], batch_size: int) -> Generator[dict, None, None]:
+        conn = self._connect()
+        try:
+            for i in range(0, len(ip_addresses), min(batch_size, _MAX_SQL_PARAMS)):
+                for user_stats in _user_stats(conn, ip_addresses[i:i + min(batch_size, _MAX_SQL_PARAMS)]):
+                    user_stats['version'] = stats_version(user_stats['quiz_attempts'], len(user_stats['quizzes']))
+                    yield user_stats
+        finally:
+            conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+def _attempt_row(attempt: dict) -> tuple:
+    return tuple(bool(attempt.get(column)) if column == 'correct' else attempt.get(column) for column in _ATTEMPT_COLUMNS)
+
+def _attempt(row: tuple) -> dict:
+    attempt = dict(zip(_ATTEMPT_COLUMNS, row))
+    attempt['correct'] = bool(attempt['correct'])
+    if attempt['attempt_id'] is None:
+        del attempt['attempt_id']
+    return attempt
+
+def _user_stats(conn: sqlite3.Connection, ip_addresses: list[str]) -> Generator[dict, None, None]:
+    '''The stats of `ip_addresses` (at most _MAX_SQL_PARAMS) in the shape of a mongo document, quizzes oldest first.'''
+    placeholders = ','.join('?' * len(ip_addresses))
+    users = {ip_address: {**json.loads(fields or '{}'), 'ip_address': ip_address, 'quiz_attempts': quiz_attempts,
+                          'correct_answers': correct_answers, 'quizzes': []}
+             for ip_address, quiz_attempts, correct_answers, fields in conn.execute(
+                 f'SELECT ip_address, quiz_attempts, correct_answers, fields FROM users WHERE ip_address IN ({placeholders})', ip_addresses)}
+    for ip_address, *row in conn.execute(
+            f'''SELECT ip_address, {", ".join(_ATTEMPT_COLUMNS)} FROM quiz_attempts WHERE ip_address IN ({placeholders})
+                ORDER BY ip_address, time_seconds, id''', ip_addresses):
+        users[ip_address]['quizzes'].append(_attempt(row))
+    yield from users.values()
@@ -0,0 +1,41 @@
+import json
+import os
+import re
+
+from ingest_manifest import MANIFEST_FILE, IngestManifest
+
+ARTICLES_FILE = 'db/articles.jsonl' # built by build_title_db.py
+
+def clean_title(title: str) -> str:
+    '''Title as listed in the UI.'''
+    return re.sub(r'^[^a-zA-Z]+', '', title).strip().replace('\n', ' ')
+
+class TitleScope:
+    '''
+    Resolves an article title (as listed in the UI, or as loaded) to its `src` urls using `db/articles.jsonl`,
+    and those to their vector ids `src|1..n` using the chunk counts in the ingest manifest.
+    '''
+
+    def __init__(self, articles_path: str=ARTICLES_FILE, manifest_path: str=MANIFEST_FILE):
+        self._srcs: dict[str, list[str]] = {}
+        if os.path.exists(articles_path):
+            with open(articles_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    article: dict = json.loads(line)
+                    for title in {article['title'], clean_title(article['title'])}:
+                        srcs = self._srcs.setdefault(title, [])
+                        if article['url'] not in srcs:
+                            srcs.append(article['url'])
+        self._manifest = IngestManifest(manifest_path) if os.path.exists(manifest_path) else None
+
+    def srcs(self, title: str) -> list[str]:
+        return self._srcs.get(title, [])
+
+    def chunk_ids(self, srcs: list[str]) -> list[str]:
+        '''Vector ids of all chunks of `srcs`, or [] unless every one of them is in the manifest.'''
+        if not self._manifest or not srcs:
+            return []
+        chunk_counts = self._manifest.chunk_counts(srcs)
+        if len(chunk_counts) < len(set(srcs)):
+            return []
+        return [f'{src}|{i}' for src in srcs for i in range(1, chunk_counts[src] + 1)]
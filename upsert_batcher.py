@@ -0,0 +1,134 @@
+import json
+import random
+import threading
+import time
+
+from typing import Callable
+
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+MAX_REQUEST_BYTES = 2 * 1024 * 1024 # pinecone max upsert request size 2MB
+MAX_METADATA_BYTES = 40_960 # pinecone max metadata size per vector
+MAX_VECTORS_PER_REQUEST = 1000
+REQUEST_OVERHEAD_BYTES = 64 * 1024 # headroom for the request envelope and serialization differences
+
+MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+def _json_size(obj) -> int:
+    return len(json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+def _fit_metadata(vector: dict, text_key: str='text') -> dict:
+    metadata: dict = vector.get('metadata') or {}
+    overflow = _json_size(metadata) - MAX_METADATA_BYTES
+    if overflow <= 0 or text_key not in metadata:
+        return vector
+
+    text_bytes = metadata[text_key].encode('utf-8')
+    # json escaping can make the encoded text longer than the raw bytes, so trim a little extra
+    keep = max(len(text_bytes) - overflow - 1024, 0)
+    metadata = {**metadata, text_key: text_bytes[:keep].decode('utf-8', errors='ignore')}
+    logger.warning('Truncated metadata %r of vector %s from %s to %s bytes', text_key, vector['id'], f'{len(text_bytes):,}', f'{keep:,}')
+    return {**vector, 'metadata': metadata}
+
+def is_transient_error(e: Exception) -> bool:
+    status = getattr(e, 'status', None) or getattr(e, 'status_code', None)
+    if status in TRANSIENT_STATUS_CODES:
+        return True
+    return isinstance(e, (ConnectionError, TimeoutError)) or type(e).__module__.startswith('urllib3')
+
+def call_with_backoff(fn: Callable, *args, max_retries: int=MAX_RETRIES, **kwargs):
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == max_retries or not is_transient_error(e):
+                raise
+            delay = min(BACKOFF_BASE_SECONDS * 2 ** attempt, BACKOFF_MAX_SECONDS) * random.uniform(0.5, 1.0)
+            logger.warning('Transient error: %s - retry %d/%d in %.1fs', e, attempt + 1, max_retries, delay)
+            time.sleep(delay)
+
+class _Pending:
+    def __init__(self, count: int, on_done: Callable[[], None]|None):
+        self.count = count
+        self.on_done = on_done
+
+class UpsertBatcher:
+    '''
+    Packs vectors from any number of documents into upsert requests which stay under
+    the request size, vector count and per-vector metadata limits, measured before sending
+    instead of discovered from rejected requests.
+
+    `add` queues one document's vectors and sends full requests as they fill up;
+    the document's `on_done` callback runs once all of its vectors have been upserted.
+    Call `flush` at the end to send what is left. Safe to use from multiple threads:
+    requests are sent outside the lock so several can be in flight.
+    '''
+
+    def __init__(self,
+                 send_fn: Callable[[list[dict]], object],
+                 max_request_bytes: int=MAX_REQUEST_BYTES,
+                 max_vectors: int=MAX_VECTORS_PER_REQUEST):
+        self.send_fn = send_fn
+        self.max_payload_bytes = max_request_bytes - REQUEST_OVERHEAD_BYTES
+        self.max_vectors = max_vectors
+
+        self._lock = threading.Lock()
+        self._batch: list[tuple[dict, _Pending]] = []
+        self._batch_bytes = 0
+        self.requests = 0
+        self.vectors = 0
+
+    def add(self, vectors: list[dict], on_done: Callable[[], None]=None) -> None:
+        if not vectors:
+            if on_done:
+                on_done()
+            return
+
+        pending = _Pending(len(vectors), on_done)
+        sized = [(vector, _json_size(vector) + 1) for vector in map(_fit_metadata, vectors)] # +1 for the separator
+
+        ready: list[list[tuple[dict, _Pending]]] = []
+        with self._lock:
+            for vector, size in sized:
+                if self._batch and (self._batch_bytes + size > self.max_payload_bytes or len(self._batch) >= self.max_vectors):
+                    ready.append(self._take_batch())
+                self._batch.append((vector, pending))
+                self._batch_bytes += size
+
+        for batch in ready:
+            self._send(batch)
+
+    def flush(self) -> None:
+        with self._lock:
+            batch = self._take_batch()
+        if batch:
+            self._send(batch)
+
+    def _take_batch(self) -> list[tuple[dict, '_Pending']]:
+        batch = self._batch
+        self._batch = []
+        self._batch_bytes = 0
+        return batch
+
+    def _send(self, batch: list[tuple[dict, _Pending]]) -> None:
+        vectors = [vector for vector, _ in batch]
+        rsp = call_with_backoff(self.send_fn, vectors)
+        logger.debug('index: %s', rsp)
+
+        done: list[_Pending] = []
+        with self._lock:
+            self.requests += 1
+            self.vectors += len(vectors)
+            for _, pending in batch:
+                pending.count -= 1
+                if pending.count == 0:
+                    done.append(pending)
+
+        for pending in done:
+            if pending.on_done:
+                pending.on_done()
@@ -1,43 +1,308 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import atexit
+import fcntl
+import json
 import os
+import threading
+import time
+import uuid
 
-from pymongo import MongoClient
-from pymongo.collection import Collection
+from typing import Generator
 
-MONGODB_ATLAS_CLUSTER_URI=os.getenv('MONGODB_ATLAS_CLUSTER_URI')
-DB_NAME=os.getenv('DB_NAME')
-COLLECTION_NAME=os.getenv('COLLECTION_NAME')
+from app_logging import get_logger
+from metrics import span
+from user_stats_store import MOST_MISSED_QUESTIONS, QUIZ_HISTORY_LIMIT, PartialWriteError, UserStatsStore
 
-def _get_user_stats_collection(client: MongoClient) -> Collection:
-    db = client[DB_NAME] # creates if not exist
-    return db.get_collection(COLLECTION_NAME)
+logger = get_logger(__name__)
 
-# initialize user stats collection
-with MongoClient(MONGODB_ATLAS_CLUSTER_URI) as client:
-    _get_user_stats_collection(client).create_index('ip_address', unique=True) # idempotent
+USER_STATS_BACKEND = os.getenv('USER_STATS_BACKEND', 'mongo') # mongo, or sqlite (db/user_stats.db)
+STATS_WAL_DIR = 'db/user_stats_wal' # one write-ahead file per app process
+STATS_FLUSH_BATCH_SIZE = int(os.getenv('STATS_FLUSH_BATCH_SIZE', '100')) # queued attempts which trigger a flush
+STATS_FLUSH_INTERVAL_SECONDS = float(os.getenv('STATS_FLUSH_INTERVAL_SECONDS', '1'))
+RETRY_DELAY_SECONDS = 5 # after a failed flush
+
+_store: UserStatsStore = None
+_lock = threading.Lock()
+
+def get_store() -> UserStatsStore:
+    '''The storage backend picked by USER_STATS_BACKEND, created on first use.'''
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                if USER_STATS_BACKEND == 'sqlite':
+                    from sqlite_user_stats import SqliteUserStatsStore
+                    _store = SqliteUserStatsStore()
+                elif USER_STATS_BACKEND == 'mongo':
+                    from mongo_user_stats import MongoUserStatsStore
+                    _store = MongoUserStatsStore()
+                else:
+                    raise ValueError(f'Unknown USER_STATS_BACKEND: {USER_STATS_BACKEND}')
+    return _store
+
+class StatsWriter:
+    '''
+    Write-behind quiz attempts: `record` appends the attempt to this process's write-ahead file and returns,
+    and a background thread sends the queued attempts as one batch to the store once `batch_size` are queued
+    or `interval_seconds` have passed. Each process holds a lock on its own file in `directory`, so several
+    app processes can share it; at startup, the files of processes which died (unlocked) are taken over and
+    their attempts sent again. Stores skip attempts they already have (by `attempt_id`), so each is recorded once.
+    Until an attempt is acknowledged, `unflushed` returns it to readers.
+    '''
+
+    def __init__(self, directory: str=STATS_WAL_DIR, batch_size: int=STATS_FLUSH_BATCH_SIZE,
+                 interval_seconds: float=STATS_FLUSH_INTERVAL_SECONDS):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self._pending: list[tuple[str, dict]] = [] # (ip address, attempt), oldest first
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock() # one bulk write at a time, so a user's attempts stay in order
+        os.makedirs(directory, exist_ok=True)
+
+        name = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.path = os.path.join(directory, f'{name}.jsonl')
+        self._lock_path = os.path.join(directory, f'{name}.lock')
+        # locked before it is visible under its name, so no other process takes it for a dead one's
+        self._lock_file = open(f'{self._lock_path}.tmp', 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.replace(f'{self._lock_path}.tmp', self._lock_path)
+
+        orphans = self._adopt_orphans()
+        self._wal = open(self.path, 'a', encoding='utf-8')
+        self._rewrite_wal() # the adopted attempts are in this process's file before theirs are removed
+        for lock_file, lock_path, wal_path in orphans:
+            _remove_file(wal_path)
+            _remove_file(lock_path)
+            lock_file.close()
+        threading.Thread(target=self._work, name='stats-writer', daemon=True).start()
+        atexit.register(self.close)
+
+    def record(self, ip_address: str, attempt: dict) -> None:
+        attempt = {**attempt, 'attempt_id': attempt.get('attempt_id') or uuid.uuid4().hex} # lets readers drop duplicates
+        with self._cond:
+            # written through to the OS, so a crash of this process loses nothing
+            self._wal.write(json.dumps([ip_address, attempt], ensure_ascii=False) + '\n')
+            self._wal.flush()
+            self._pending.append((ip_address, attempt))
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+
+    def unflushed(self, ip_address: str) -> list[dict]:
+        with self._cond:
+            return [attempt for ip, attempt in self._pending if ip == ip_address]
+
+    def flush(self) -> bool:
+        '''Sends everything queued so far; True unless the bulk write failed (the attempts then stay queued).'''
+        with self._flush_lock:
+            with self._cond:
+                batch = list(self._pending)
+            if not batch:
+                return True
+            try:
+                store = get_store()
+                with span('stats_write', backend=store.name):
+                    store.record_attempts(batch)
+                logger.debug('flushed %d quiz attempts', len(batch))
+            except PartialWriteError as e:
+                logger.error('Error flushing %d quiz attempts, %d written: %s', len(batch), e.written, e)
+                with self._cond:
+                    del self._pending[:e.written] # so the retry doesn't send them again
+                    self._rewrite_wal()
+                return False
+            except Exception as e:
+                logger.error('Error flushing %d quiz attempts: %s', len(batch), e)
+                return False
+            with self._cond:
+                del self._pending[:len(batch)] # only this thread removes, so the batch is still the head
+                self._rewrite_wal()
+            return True
+
+    def stats(self) -> dict[str, int]:
+        with self._cond:
+            return {'pending': len(self._pending)}
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pending) >= self.batch_size, timeout=self.interval_seconds)
+            if not self.flush():
+                time.sleep(RETRY_DELAY_SECONDS)
+
+    def close(self) -> None:
+        '''Flushes, and removes this process's files if nothing is left pending.'''
+        self.flush()
+        with self._cond:
+            if not self._pending:
+                self._wal.close()
+                _remove_file(self.path)
+                _remove_file(self._lock_path)
+                self._lock_file.close()
+
+    def _adopt_orphans(self) -> list:
+        '''
+        Loads the attempts of the write-ahead files whose lock no process holds (their process died), keeping
+        those locks: returns (lock file, lock path, wal path) of each, to remove once the attempts are safe here.
+        '''
+        orphans = []
+        for name in sorted(os.listdir(self.directory)):
+            lock_path = os.path.join(self.directory, name)
+            if not name.endswith('.lock') or lock_path == self._lock_path:
+                continue
+            try:
+                lock_file = open(lock_path, 'a')
+            except FileNotFoundError:
+                continue # just taken over by another process
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue # its process is alive
+            wal_path = f'{lock_path[:-len(".lock")]}.jsonl'
+            count = len(self._pending)
+            try:
+                with open(wal_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            ip_address, attempt = json.loads(line)
+                        except ValueError:
+                            continue # torn last line
+                        self._pending.append((ip_address, attempt))
+            except FileNotFoundError:
+                pass
+            if len(self._pending) > count:
+                logger.info('Replaying %d unflushed quiz attempts from %s', len(self._pending) - count, wal_path)
+            orphans.append((lock_file, lock_path, wal_path))
+        return orphans
+
+    def _rewrite_wal(self) -> None:
+        '''Called with the lock held: the file keeps just the attempts still pending.'''
+        self._wal.close()
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for ip_address, attempt in self._pending:
+                f.write(json.dumps([ip_address, attempt], ensure_ascii=False) + '\n')
+        os.replace(tmp_path, self.path)
+        self._wal = open(self.path, 'a', encoding='utf-8')
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+_stats_writer: StatsWriter = None
+
+def get_stats_writer() -> StatsWriter:
+    global _stats_writer
+    if _stats_writer is None:
+        with _lock:
+            if _stats_writer is None:
+                _stats_writer = StatsWriter()
+    return _stats_writer
+
+def queue_quiz_attempt(ip_address: str, attempt: dict) -> None:
+    '''Records a quiz attempt without waiting on the database; see `StatsWriter`.'''
+    get_stats_writer().record(ip_address, attempt)
+
+def _with_unflushed(ip_address: str, user_stats: dict|None, unflushed: list[dict]) -> dict|None:
+    # `unflushed` is taken before the read, so an attempt is either in it or already in `user_stats`
+    if not unflushed:
+        return user_stats
+    user_stats = user_stats or {'ip_address': ip_address, 'quizzes': []}
+    stored = {quiz.get('attempt_id') for quiz in user_stats.get('quizzes', [])}
+    for attempt in unflushed:
+        if attempt['attempt_id'] in stored:
+            continue # acknowledged between the two reads
+        user_stats.setdefault('quizzes', []).append(attempt)
+        user_stats['quiz_attempts'] = user_stats.get('quiz_attempts', 0) + 1
+        user_stats['correct_answers'] = user_stats.get('correct_answers', 0) + (1 if attempt.get('correct') else 0)
+    if QUIZ_HISTORY_LIMIT > 0:
+        user_stats['quizzes'] = user_stats['quizzes'][-QUIZ_HISTORY_LIMIT:]
+    return user_stats
+
+def _unflushed(ip_address: str) -> list[dict]:
+    return _stats_writer.unflushed(ip_address) if _stats_writer else []
 
 def persist_user_stats(ip_address: str, user_stats: dict[str, str]) -> bool:
     try:
-        with MongoClient(MONGODB_ATLAS_CLUSTER_URI) as client:
-            result = _get_user_stats_collection(client).update_one(
-                        {'ip_address': ip_address},
-                        {'$set': user_stats},
-                        upsert = True)
-            print(f'{COLLECTION_NAME} - {result}')
-            return result.modified_count == 1 or result.upserted_id is not None
+        store = get_store()
+        with span('stats_write', backend=store.name):
+            return store.persist(ip_address, user_stats)
     except Exception as e:
-        print(f'Error persisting user stats: {e}')
+        logger.error('Error persisting user stats: %s', e)
         return False
 
 def get_user_stats(ip_address: str) -> dict[str, str]:
+    '''The user's stats, including quiz attempts still queued in this process.'''
     try:
-        with MongoClient(MONGODB_ATLAS_CLUSTER_URI) as client:
-            user_stats = _get_user_stats_collection(client).find_one({'ip_address': ip_address})
-            if user_stats: # may be `None`
-                del user_stats['_id'] # caller doesn't care about this, uses `ip_address`
-            return user_stats
+        unflushed = _unflushed(ip_address)
+        store = get_store()
+        with span('stats_read', backend=store.name):
+            user_stats = store.get(ip_address)
+        return _with_unflushed(ip_address, user_stats, unflushed)
     except Exception as e:
-        print(f'Error retrieving user stats: {e}')
+        logger.error('Error retrieving user stats: %s', e)
         return None
+
+# progress reports: summaries computed by the store, and one page of attempts
+
+async def aget_stats_version(ip_address: str) -> str|None:
+    '''Changes whenever a quiz attempt is recorded for the user, also one still queued in this process; None if there are no stats.'''
+    unflushed = _unflushed(ip_address)
+    store = get_store()
+    with span('stats_read', backend=store.name):
+        version = await store.astats_version(ip_address)
+    if unflushed:
+        version = f'{version or ""}+{len(unflushed)}:{unflushed[-1]["attempt_id"]}'
+    return version
+
+async def aget_report_data(ip_address: str, page: int, page_size: int) -> dict:
+    '''
+    Per-article accuracy, attempts per day, the most missed questions and page `page` (1 = newest) of the
+    attempts, newest first. Only the summaries and one page leave the store, whatever the history length.
+    Attempts still queued in this process are added to the summaries and listed first on page 1.
+    '''
+    unflushed = _unflushed(ip_address)
+    store = get_store()
+    with span('stats_read', backend=store.name):
+        report = await store.areport_data(ip_address, page, page_size)
+    return _report_with_unflushed(report, unflushed)
+
+def _report_with_unflushed(report: dict, unflushed: list[dict]) -> dict:
+    listed = {quiz.get('attempt_id') for quiz in report['quizzes']}
+    unflushed = [attempt for attempt in unflushed if attempt['attempt_id'] not in listed] # else acknowledged since
+    if not unflushed:
+        return report
+    articles = {article['article']: dict(article) for article in report['articles']}
+    days = {day['day']: dict(day) for day in report['days']}
+    questions = {(question['article'], question['question']): dict(question) for question in report['most_missed']}
+    for attempt in unflushed:
+        correct = 1 if attempt.get('correct') else 0
+        day_key = time.strftime('%Y-%m-%d', time.gmtime(attempt['time_seconds']))
+        for counts in (articles.setdefault(attempt['article'], {'article': attempt['article'], 'attempts': 0, 'correct': 0}),
+                       days.setdefault(day_key, {'day': day_key, 'attempts': 0, 'correct': 0})):
+            counts['attempts'] += 1
+            counts['correct'] += correct
+        key = (attempt['article'], attempt['question'])
+        if key in questions or not correct: # a question outside the stored top list counts only its queued attempts
+            question = questions.setdefault(key, {'article': key[0], 'question': key[1], 'attempts': 0, 'missed': 0})
+            question['attempts'] += 1
+            question['missed'] += 1 - correct
+    return {**report,
+            'total': report['total'] + len(unflushed),
+            'correct': report['correct'] + sum(1 for attempt in unflushed if attempt.get('correct')),
+            'articles': sorted(articles.values(), key=lambda article: (-article['attempts'], article['article'])),
+            'days': sorted(days.values(), key=lambda day: day['day']),
+            'most_missed': sorted(questions.values(), key=lambda question: (-question['missed'], -question['attempts']))[:MOST_MISSED_QUESTIONS],
+            'quizzes': list(reversed(unflushed)) + report['quizzes'] if report['page'] == 1 else report['quizzes']}
+
+def iter_stats_versions(batch_size: int) -> Generator[tuple[str, str], None, None]:
+    '''(ip address, stats version) of every user, streamed.'''
+    return get_store().iter_stats_versions(batch_size)
+
+def iter_user_stats(ip_addresses: list[str], batch_size: int) -> Generator[dict, None, None]:
+    '''The stats of `ip_addresses`, streamed, each with its `version`.'''
+    return get_store().iter_user_stats(ip_addresses, batch_size)
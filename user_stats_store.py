@@ -0,0 +1,70 @@
+import asyncio
+import os
+
+from typing import Generator
+
+QUIZ_HISTORY_LIMIT = int(os.getenv('QUIZ_HISTORY_LIMIT', '0')) # most recent quiz attempts kept per user, 0 for all
+MOST_MISSED_QUESTIONS = 10 # listed in the progress report
+
+class PartialWriteError(Exception):
+    '''Raised by `record_attempts` when only the first `written` attempts of the batch were stored.'''
+
+    def __init__(self, written: int, message: str):
+        super().__init__(message)
+        self.written = written
+
+class UserStatsStore:
+    '''
+    Storage backend of `user_stats_service`. A user's stats are their `quizzes` (attempts, oldest first),
+    `quiz_attempts` / `correct_answers` counters and any other fields set with `persist`.
+    Backends implement the sync methods; the async ones default to running those in a thread.
+    '''
+
+    name = ''
+
+    def record_attempts(self, attempts: list[tuple[str, dict]]) -> None:
+        '''
+        Appends each (ip address, attempt) and bumps the user's counters, as one batch. An attempt whose
+        `attempt_id` is already stored is skipped, so a batch can be replayed.
+        '''
+        raise NotImplementedError
+
+    def persist(self, ip_address: str, user_stats: dict) -> bool:
+        '''Sets the given fields of the user's stats, replacing `quizzes` if given.'''
+        raise NotImplementedError
+
+    def get(self, ip_address: str) -> dict|None:
+        raise NotImplementedError
+
+    def stats_version(self, ip_address: str) -> str|None:
+        '''Changes whenever a quiz attempt is recorded for the user; None if there are no stats.'''
+        raise NotImplementedError
+
+    def report_data(self, ip_address: str, page: int, page_size: int) -> dict:
+        '''
+        Per-article accuracy, attempts per day, the most missed questions and page `page` (1 = newest) of the
+        attempts, newest first, computed by the backend: see `progress_report.summarize_quizzes` for the shape.
+        '''
+        raise NotImplementedError
+
+    def iter_stats_versions(self, batch_size: int) -> Generator[tuple[str, str], None, None]:
+        '''(ip address, stats version) of every user, streamed.'''
+        raise NotImplementedError
+
+    def iter_user_stats(self, ip_addresses: list[str], batch_size: int) -> Generator[dict, None, None]:
+        '''The full stats of `ip_addresses`, streamed, each with its `version`.'''
+        raise NotImplementedError
+
+    async def astats_version(self, ip_address: str) -> str|None:
+        return await asyncio.to_thread(self.stats_version, ip_address)
+
+    async def areport_data(self, ip_address: str, page: int, page_size: int) -> dict:
+        return await asyncio.to_thread(self.report_data, ip_address, page, page_size)
+
+def stats_version(quiz_attempts: int, quiz_count: int) -> str:
+    return f'{quiz_attempts}-{quiz_count}'
+
+def report_page(total: int, page: int, page_size: int) -> tuple[int, int]:
+    '''(page clamped to the pages there are, page count); there is always a first page.'''
+    pages = max((total + page_size - 1) // page_size, 1)
+    return min(max(page, 1), pages), pages
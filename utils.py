@@ -9,11 +9,15 @@ load_dotenv()
 
 import os
 
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
 DUMMY_IP_ADDRESS = os.getenv('DUMMY_IP_ADDRESS')
 
 def get_ip_address(request) -> str:
     headers = request.headers
-    print(f'{headers}')
+    logger.debug('headers: %s', headers)
     ip_address: str = headers.get('x-forwarded-for', DUMMY_IP_ADDRESS)
     return ip_address
 